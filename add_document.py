@@ -1,59 +1,321 @@
+import argparse
+import json
 import logging
 import os
-import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
 
 from dotenv import load_dotenv
 from langchain.text_splitter import CharacterTextSplitter
 from langchain_community.document_loaders import UnstructuredPDFLoader
 from langchain_openai import OpenAIEmbeddings
-from langchain_pinecone import PineconeVectorStore
 from langsmith import traceable
 
+from app.core.config import get_settings
+from app.services.embeddings import BatchedEmbeddings, EmbeddingCache, RateBudget
+from app.services.ingest import Pipeline, Stage, chunk_ids, expand_paths, parallel_map_stage
+from app.services.lexical_index import LexicalIndex
+from app.services.manifest import DocumentManifest, file_digest
+
 load_dotenv()
+settings = get_settings()
 
 # LangSmithの設定（公式ドキュメントに従った環境変数名）
 os.environ["LANGSMITH_TRACING"] = "true"
 os.environ["LANGCHAIN_PROJECT"] = os.getenv("LANGCHAIN_PROJECT", "chatbot-app")
 # LANGSMITH_API_KEYは.envファイルから読み込まれる
 
-logging.basicConfig(
-    format="%(asctime)s [%(levelname)s] %(message)s", level=logging.INFO
-)
+logging.basicConfig(format="%(asctime)s [%(levelname)s] %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+CHUNK_SIZE = 300
+CHUNK_OVERLAP = 30
+
+
 @traceable(name="initialize_vectorstore")
-def initialize_vectorstore():
-    index_name = os.environ["PINECONE_INDEX"]
-    embeddings = OpenAIEmbeddings(api_key=os.environ["OPENAI_API_KEY"])
+def initialize_vectorstore(embeddings=None):
+    """embeddingsを省略した場合はOpenAIEmbeddingsを使う。VECTORSTORE_BACKENDがlocalならローカルのベクトルストアを開く"""
+    if embeddings is None:
+        embeddings = OpenAIEmbeddings(model=settings.EMBEDDING_MODEL, api_key=os.environ["OPENAI_API_KEY"])
 
+    if settings.VECTORSTORE_BACKEND == "local":
+        from app.services.local_vectorstore import LocalVectorStore
+
+        return LocalVectorStore(
+            settings.LOCAL_VECTORSTORE_PATH, embeddings, dtype=settings.LOCAL_VECTORSTORE_DTYPE, nprobe=settings.LOCAL_VECTORSTORE_NPROBE
+        )
+
+    # ローカルのベクトルストアだけを使う場合はPineconeのパッケージがなくても動くようにここで読み込む
+    from langchain_pinecone import PineconeVectorStore
+
+    index_name = os.environ["PINECONE_INDEX"]
     return PineconeVectorStore(index_name=index_name, embedding=embeddings)
 
+
+def load_pdf(file_path: str):
+    """PDFファイルを読み込む（プロセスプールのワーカーで実行するためトップレベルに置く）"""
+    return UnstructuredPDFLoader(file_path).load()
+
+
+def parse_pdf(item):
+    """解析の段で使う（(パス, 内容のハッシュ)を受け取り、読み込んだドキュメントを加えて返す）"""
+    file_path, content_hash = item
+    return [(file_path, content_hash, load_pdf(file_path))]
+
+
+def create_batched_embeddings(
+    cache_path: str = settings.EMBEDDING_CACHE_PATH,
+    max_batch_tokens: int = settings.EMBEDDING_BATCH_MAX_TOKENS,
+    max_batch_items: int = settings.EMBEDDING_BATCH_MAX_ITEMS,
+    max_concurrency: int = settings.EMBEDDING_MAX_CONCURRENCY,
+    tokens_per_minute: int = settings.EMBEDDING_TOKENS_PER_MINUTE,
+):
+    """埋め込みのキャッシュを使い、キャッシュにないチャンクだけをトークン数でまとめて埋め込む"""
+    return BatchedEmbeddings(
+        OpenAIEmbeddings(model=settings.EMBEDDING_MODEL, api_key=os.environ["OPENAI_API_KEY"]),
+        model=settings.EMBEDDING_MODEL,
+        cache=EmbeddingCache(cache_path),
+        max_batch_tokens=max_batch_tokens,
+        max_batch_items=max_batch_items,
+        budget=RateBudget(tokens_per_minute, max_concurrency),
+    )
+
+
+def create_text_splitter():
+    return CharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+
+
 @traceable(name="load_and_split_documents")
 def load_and_split_documents(file_path: str):
     """PDFファイルを読み込み、チャンクに分割する"""
-    loader = UnstructuredPDFLoader(file_path)
-    raw_docs = loader.load()
+    raw_docs = load_pdf(file_path)
     logger.info("Loaded %d documents", len(raw_docs))
 
-    text_splitter = CharacterTextSplitter(chunk_size=300, chunk_overlap=30)
-    docs = text_splitter.split_documents(raw_docs)
+    docs = create_text_splitter().split_documents(raw_docs)
     logger.info("Split %d documents", len(docs))
 
     return docs
 
+
 @traceable(name="add_documents_to_vectorstore")
 def add_documents_to_vectorstore(docs, index_name: str):
     """ドキュメントをベクトルストアに追加する"""
+    from langchain_pinecone import PineconeVectorStore
+
     embeddings = OpenAIEmbeddings(api_key=os.environ["OPENAI_API_KEY"])
     PineconeVectorStore.from_documents(docs, embeddings, index_name=index_name)
     logger.info("Added %d documents to vectorstore", len(docs))
 
-if __name__ == "__main__":
-    file_path = sys.argv[1]
 
-    # ドキュメントの読み込みと分割
-    docs = load_and_split_documents(file_path)
+@traceable(name="ingest_documents")
+def ingest_documents(  # noqa: PLR0913, PLR0915
+    paths,
+    vectorstore,
+    embeddings,
+    manifest: DocumentManifest,
+    lexical_index: Optional[LexicalIndex] = None,
+    processes: int = 4,
+    embed_batch_size: int = 256,
+    upsert_batch_size: int = 100,
+    upsert_workers: int = 2,
+    queue_size: int = 64,
+):
+    """
+    確認 → 解析（プロセスプール） → 分割 → 埋め込み → 登録 をパイプラインで実行し、段ごとの統計を返す
+    マニフェストと内容のハッシュが同じファイルは解析せず、変わったファイルは新しいチャンクだけを登録し、消えたチャンクを削除する
+    埋め込みの段はキャッシュにないチャンクだけを埋め込み、登録の段はキャッシュ済みの埋め込みとチャンクのIDで登録する（冪等）
+    lexical_indexを渡すと登録したチャンクを語彙インデックスにも追加する
+    （マニフェストにはセグメントを書いてから記録するため、途中で止まっても語彙インデックスから漏れない）
+    内容が同じでも語彙インデックスにないチャンクがあるファイル（語彙インデックスより前に取り込んだものなど）は解析し直し、
+    そのチャンクを語彙インデックスにだけ追加する
+    解析・分割に失敗したファイルはログに残してfiles_failedに数え、残りのファイルの取り込みを続ける
+    processesが0の場合は解析も同じプロセスで行う
+    """
+    splitter = create_text_splitter()
+    counts = {"files_unchanged": 0, "files_indexed": 0, "files_failed": 0, "chunks_unchanged": 0, "chunks_deleted": 0, "chunks_backfilled": 0}
+    counts_lock = threading.Lock()
+    # 語彙インデックスのセグメントに書くまでマニフェストへの記録を待たせるチャンク
+    unflushed: list[tuple[str, str]] = []
+    flush_lock = threading.Lock()
 
-    # ベクトルストアへの追加
-    index_name = os.environ["PINECONE_INDEX"]
-    add_documents_to_vectorstore(docs, index_name)
+    def count(key: str, n: int = 1):
+        with counts_lock:
+            counts[key] += n
+
+    def skip_file(item, error: Exception):
+        # 壊れたPDFなど1ファイルの失敗で取り込み全体を止めない（マニフェストに記録しないため次回の実行で再試行する）
+        logger.warning("Failed to ingest %s: %s", item[0], error, exc_info=True)
+        count("files_failed")
+
+    def check(file_path):
+        content_hash = file_digest(file_path)
+        if manifest.is_unchanged(file_path, content_hash) and (lexical_index is None or not lexical_index.missing(manifest.chunk_ids(file_path))):
+            count("files_unchanged")
+            return []
+        return [(file_path, content_hash)]
+
+    def split(item):
+        file_path, content_hash, raw_docs = item
+        chunks = splitter.split_documents(raw_docs)
+        ids = chunk_ids(file_path, [chunk.page_content for chunk in chunks])
+        for chunk, chunk_id in zip(chunks, ids):
+            chunk.metadata["source"] = file_path
+            chunk.metadata["chunk_id"] = chunk_id
+        new_ids, stale_ids = manifest.diff(file_path, ids)
+        if stale_ids:
+            vectorstore.delete(ids=stale_ids)
+            if lexical_index is not None:
+                lexical_index.delete(stale_ids)
+            manifest.remove_chunks(file_path, stale_ids)
+            count("chunks_deleted", len(stale_ids))
+        count("chunks_unchanged", len(chunks) - len(new_ids))
+        new = set(new_ids)
+        if lexical_index is not None:
+            backfill = set(lexical_index.missing([chunk_id for chunk_id in ids if chunk_id not in new]))
+            backfilled = [chunk for chunk in chunks if chunk.metadata["chunk_id"] in backfill]
+            if backfilled:
+                # ベクトルストアとマニフェストには登録済みなので、語彙インデックスにだけ追加する
+                with flush_lock:
+                    lexical_index.add(
+                        [chunk.metadata["chunk_id"] for chunk in backfilled],
+                        [chunk.page_content for chunk in backfilled],
+                        [chunk.metadata for chunk in backfilled],
+                    )
+                flush_lexical_index()
+                count("chunks_backfilled", len(backfilled))
+        # 登録済みのチャンクは埋め込み・登録の段に流さない
+        manifest.begin(file_path, content_hash, new_ids)
+        if not new_ids:
+            count("files_indexed")
+        return [chunk for chunk in chunks if chunk.metadata["chunk_id"] in new]
+
+    def embed(batch):
+        embeddings.embed_documents([chunk.page_content for chunk in batch])
+        return batch
+
+    def record(added: list[tuple[str, str]]):
+        count("files_indexed", len(manifest.chunks_added(added)))
+
+    def flush_lexical_index(force: bool = False):
+        with flush_lock:
+            # 補完したチャンクはマニフェストに記録済みのため、unflushedが空でもバッファにあれば書く
+            if not (unflushed or lexical_index.buffered) or (not force and lexical_index.buffered < settings.LEXICAL_INDEX_FLUSH_DOCS):
+                return
+            lexical_index.flush()
+            flushed = list(unflushed)
+            unflushed.clear()
+        record(flushed)
+
+    def upsert(batch):
+        ids = [chunk.metadata["chunk_id"] for chunk in batch]
+        vectorstore.add_documents(batch, ids=ids)
+        added = [(chunk.metadata["source"], chunk.metadata["chunk_id"]) for chunk in batch]
+        if lexical_index is None:
+            record(added)
+            return batch
+        with flush_lock:
+            lexical_index.add(ids, [chunk.page_content for chunk in batch], [chunk.metadata for chunk in batch])
+            unflushed.extend(added)
+        flush_lexical_index()
+        return batch
+
+    embed_workers = embeddings.budget.max_concurrency if isinstance(embeddings, BatchedEmbeddings) else 1
+    executor = ProcessPoolExecutor(max_workers=processes) if processes > 0 else None
+    try:
+        parse = (
+            parallel_map_stage("parse", parse_pdf, executor, workers=processes, on_error=skip_file)
+            if executor
+            else Stage("parse", parse_pdf, on_error=skip_file)
+        )
+        pipeline = Pipeline(
+            [
+                Stage("check", check),
+                parse,
+                Stage("split", split, on_error=skip_file),
+                # 1回の呼び出しはほぼ1リクエストになるため、段のワーカーで同時実行数の分だけ並行に送る（流量の予算は共有する）
+                Stage("embed", embed, workers=embed_workers, batch_size=embed_batch_size),
+                Stage("upsert", upsert, workers=upsert_workers, batch_size=upsert_batch_size),
+            ],
+            queue_size=queue_size,
+        )
+        report = pipeline.run(paths)
+        if lexical_index is not None:
+            flush_lexical_index(force=True)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    report["manifest"] = counts
+    if lexical_index is not None:
+        report["lexical_index"] = lexical_index.stats()
+    if isinstance(embeddings, BatchedEmbeddings):
+        report["embeddings"] = embeddings.stats()
+    return report
+
+
+@traceable(name="prune_missing_files")
+def prune_missing_files(vectorstore, manifest: DocumentManifest, lexical_index: Optional[LexicalIndex] = None) -> int:
+    """
+    マニフェストにあってディスクから消えたファイルのチャンクをベクトルストア（と語彙インデックス）から削除し、削除したファイル数を返す
+    パスを正規化する前に記録された書き方（相対パスなど）のうち、正規化したパスで登録し直されたものも削除する
+    """
+    paths = manifest.paths()
+    known = set(paths)
+    pruned = 0
+    for file_path in paths:
+        normalized = os.path.realpath(file_path)
+        if os.path.exists(file_path) and (normalized == file_path or normalized not in known):
+            continue
+        ids = sorted(manifest.chunk_ids(file_path))
+        if ids:
+            vectorstore.delete(ids=ids)
+            if lexical_index is not None:
+                lexical_index.delete(ids)
+        manifest.forget(file_path)
+        pruned += 1
+    return pruned
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PDFを分割・埋め込みしてベクトルストアに登録する")
+    parser.add_argument("paths", nargs="+", help="PDFファイル・ディレクトリ（配下を再帰的に探す）・globパターン")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="PDFを解析するプロセス数（0で同じプロセス）")
+    parser.add_argument("--embed-batch-size", type=int, default=256, help="埋め込みの段に一度に渡すチャンク数")
+    parser.add_argument("--upsert-batch-size", type=int, default=100, help="1回の登録で送るチャンク数")
+    parser.add_argument("--upsert-workers", type=int, default=2, help="登録を同時に行う数")
+    parser.add_argument("--queue-size", type=int, default=64, help="段の間のキューの上限（メモリ使用量の上限になる）")
+    parser.add_argument("--manifest", default=settings.INGEST_MANIFEST_PATH, help="取り込み済みのファイルとチャンクの記録（SQLite）")
+    parser.add_argument("--prune", action="store_true", help="マニフェストにあってディスクから消えたファイルのチャンクも削除する")
+    parser.add_argument("--lexical-index", default=settings.LEXICAL_INDEX_PATH, help="ハイブリッド検索の語彙インデックス（BM25）")
+    parser.add_argument("--no-lexical-index", action="store_true", help="語彙インデックスを作らない")
+    parser.add_argument("--embedding-cache", default=settings.EMBEDDING_CACHE_PATH, help="埋め込みのキャッシュ（SQLite）")
+    parser.add_argument("--batch-tokens", type=int, default=settings.EMBEDDING_BATCH_MAX_TOKENS, help="1回の埋め込みリクエストのトークン数の上限")
+    parser.add_argument("--embed-concurrency", type=int, default=settings.EMBEDDING_MAX_CONCURRENCY, help="同時に送る埋め込みリクエスト数")
+    parser.add_argument("--tokens-per-minute", type=int, default=settings.EMBEDDING_TOKENS_PER_MINUTE, help="埋め込みの1分あたりのトークン数の上限")
+    args = parser.parse_args()
+
+    embeddings = create_batched_embeddings(
+        args.embedding_cache, max_batch_tokens=args.batch_tokens, max_concurrency=args.embed_concurrency, tokens_per_minute=args.tokens_per_minute
+    )
+    vectorstore = initialize_vectorstore(embeddings)
+    manifest = DocumentManifest(args.manifest)
+    lexical_index = None if args.no_lexical_index else LexicalIndex(args.lexical_index, max_segments=settings.LEXICAL_INDEX_MAX_SEGMENTS)
+    report = ingest_documents(
+        expand_paths(args.paths),
+        vectorstore,
+        embeddings,
+        manifest,
+        lexical_index,
+        processes=args.processes,
+        embed_batch_size=args.embed_batch_size,
+        upsert_batch_size=args.upsert_batch_size,
+        upsert_workers=args.upsert_workers,
+        queue_size=args.queue_size,
+    )
+    if args.prune:
+        report["manifest"]["files_pruned"] = prune_missing_files(vectorstore, manifest, lexical_index)
+    logger.info("Ingestion finished: %s", json.dumps(report, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
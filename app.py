@@ -7,12 +7,18 @@ import langsmith as ls
 import openai
 import streamlit as st
 from dotenv import load_dotenv
+from langchain_openai import OpenAIEmbeddings
 from langsmith import Client, traceable
 from langsmith.wrappers import wrap_openai
 
 from add_document import initialize_vectorstore
+from app.core.config import get_settings
+from app.services.lexical_index import LexicalIndex
+from app.services.retrieval import CachedQueryEmbeddings, CachedRetriever, HybridRetriever
+from app.services.thread_history import ThreadHistoryStore
 
 load_dotenv()
+settings = get_settings()
 
 os.environ["LANGSMITH_TRACING"] = "true"
 os.environ["LANGSMITH_ENDPOINT"] = os.getenv("LANGSMITH_ENDPOINT", "https://api.smith.langchain.com")
@@ -24,15 +30,57 @@ langsmith_client = Client()
 
 if "thread_id" not in st.session_state:
     st.session_state["thread_id"] = str(uuid.uuid4())
+    st.session_state["thread_is_new"] = True
 
 session_id = st.session_state["thread_id"]
 langsmith_extra = {"metadata": {"session_id": session_id}}
 
 
+@st.cache_resource
+def get_cached_retriever() -> CachedRetriever:
+    """
+    埋め込みクライアントとベクトルストアの接続はプロセスで1つだけ作り、Streamlitの再実行をまたいで使い回す
+    取り込み時に作った語彙インデックスがあればハイブリッド検索にする
+    """
+    embeddings = CachedQueryEmbeddings(
+        OpenAIEmbeddings(model=settings.EMBEDDING_MODEL, api_key=os.environ["OPENAI_API_KEY"]),
+        max_entries=settings.RETRIEVAL_QUERY_EMBEDDING_CACHE_SIZE,
+    )
+    vectorstore = initialize_vectorstore(embeddings)
+    if settings.RETRIEVAL_HYBRID_ENABLED and os.path.isdir(settings.LEXICAL_INDEX_PATH):
+        lexical_index = LexicalIndex(settings.LEXICAL_INDEX_PATH)
+        # 文書の入っていない語彙インデックス（ディレクトリだけがある場合など）ではベクトル検索だけを使う
+        if lexical_index.stats()["live_docs"] > 0:
+            vectorstore = HybridRetriever(vectorstore, lexical_index, candidates=settings.RETRIEVAL_HYBRID_CANDIDATES, rrf_k=settings.RETRIEVAL_RRF_K)
+        else:
+            lexical_index.close()
+    return CachedRetriever(vectorstore, max_entries=settings.RETRIEVAL_RESULT_CACHE_SIZE, ttl=settings.RETRIEVAL_RESULT_CACHE_TTL)
+
+
+@st.cache_resource
+def get_history_store() -> ThreadHistoryStore:
+    return ThreadHistoryStore(
+        settings.THREAD_HISTORY_SQLITE_PATH, max_messages=settings.THREAD_HISTORY_MAX_MESSAGES, cache_size=settings.THREAD_HISTORY_CACHE_SIZE
+    )
+
+
+def load_history(session_id: str, project_name: str) -> list:
+    """
+    ローカルの履歴を使い、記録のないスレッドのみLangSmithのrunから取り込む
+    """
+    store = get_history_store()
+    if st.session_state.pop("thread_is_new", False):
+        # このセッションで作ったスレッドにはLangSmithのrunがないため、取り込まずに確認済みにする
+        store.mark_checked(session_id)
+    if not settings.THREAD_HISTORY_LANGSMITH_BACKFILL:
+        return store.latest(session_id) or []
+    return store.get_or_backfill(session_id, lambda: get_thread_history(session_id, project_name))
+
+
 @traceable(run_type="retriever")
 def retriever(query: str):
-    vectorstore = initialize_vectorstore()
-    docs_with_scores = vectorstore.similarity_search_with_score(query)
+    # 同じ質問（正規化後）の検索結果はTTLの間再利用し、クエリの埋め込みも再計算しない
+    docs_with_scores = get_cached_retriever().search(query)
 
     # スコア情報をLangSmithに記録
     run_tree = ls.get_current_run_tree()
@@ -65,7 +113,7 @@ def rag(question: str, get_chat_history: bool = False):
     docs = retriever(question)
 
     if get_chat_history:
-        messages = get_thread_history(session_id, session_name)
+        messages = load_history(session_id, session_name)
         messages.append({"role": "user", "content": question})
     else:
         messages = [{"role": "user", "content": question}]
@@ -82,11 +130,14 @@ def rag(question: str, get_chat_history: bool = False):
 
     chat_messages = cast(list[ChatCompletionMessageParam], [{"role": m["role"], "content": m["content"]} for m in messages])
     chat_completion = client.chat.completions.create(model="gpt-4", messages=chat_messages)
+    answer = chat_completion.choices[0].message.content
 
-    return chat_completion.choices[0].message.content
+    get_history_store().append(session_id, [{"role": "user", "content": question}, {"role": "assistant", "content": answer or ""}])
+    return answer
 
 
 def get_thread_history(thread_id: str, project_name: str):
+    """LangSmithのrunから履歴を復元する（ローカルの履歴に記録のないスレッドの取り込み用）"""
     filter_string = f'and(in(metadata_key, ["session_id","conversation_id","thread_id"]), eq(metadata_value, "{thread_id}"))'
     runs = list(langsmith_client.list_runs(project_name=project_name, filter=filter_string, run_type="llm"))
     runs = sorted(runs, key=lambda run: run.start_time, reverse=True)
@@ -120,7 +171,8 @@ if prompt:
         st.markdown(prompt)
 
     with st.chat_message("assistant"):
-        response = rag(prompt, get_chat_history=True)
+        # session_idをrunのメタデータに渡し、スレッドごとの履歴を使う
+        response = rag(prompt, get_chat_history=True, langsmith_extra=langsmith_extra)
         st.markdown(response)
 
     st.session_state.messages.append({"role": "assistant", "content": response})
@@ -1,10 +1,32 @@
-from fastapi import APIRouter, HTTPException
+import logging
+
+from fastapi import APIRouter, HTTPException, Request
 from fastapi.responses import StreamingResponse
+from langchain.schema.messages import HumanMessage
+from starlette.background import BackgroundTask
 
 from app.api.schemas.schemas import BaseRequest
-from app.services.llm_service import create_chat_prompt, get_llm
+from app.core.config import get_settings
+from app.services.admission import AdmissionRejectedError
+from app.services.history import compact_history
+from app.services.llm_service import (
+    Coalescing,
+    StreamMetrics,
+    admit_stream,
+    astream_chat_shared,
+    compile_chat_prompt,
+    get_chain,
+    request_key,
+    to_langchain_messages,
+)
+from app.services.metrics import StageTimer, observe_stage
+from app.services.router import ROUTE_ASSISTANT, model_router
+from app.services.sessions import get_session_store, load_conversation
+from app.services.sse import CompletionMarkerFilter, format_sse
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
+settings = get_settings()
 
 ASSISTANT_PROMPT = """
 あなたは医学分野の専門家です。ユーザーの医療に関する質問に対して、科学的根拠に基づいた回答を提供します。
@@ -41,30 +63,130 @@ ASSISTANT_PROMPT = """
 - 表示の際、記号が文字化けすることがあるので留意して出力してください(react-markdownで表示しています)
 """
 
+ASSISTANT_CHAT_PROMPT = compile_chat_prompt(ASSISTANT_PROMPT)
+
 
 @router.post("/assistant-response")
-async def assistant_response(request: BaseRequest):
+async def assistant_response(request: BaseRequest, http_request: Request):  # noqa: PLR0915
     try:
-        # TODO: モデルをo3に変更すること
-        llm = get_llm(model_name="gpt-4o-mini", temperature=0.7)
+        # モデルはMODEL_ROUTESのassistantの候補から、直近の状態が正常なものを選ぶ
+        model_name = model_router.choose(ROUTE_ASSISTANT)
+        chain = get_chain(ASSISTANT_CHAT_PROMPT, model_name=model_name, temperature=0.7)
+
+        # session_idがあればサーバー側の履歴、なければmessage_logを使う
+        with observe_stage("history"):
+            session, message_log = await load_conversation(request.session_id, request.message_log, request.new_message)
+            compacted = await compact_history(message_log, settings.HISTORY_TOKEN_BUDGET_ASSISTANT)
+
+        with observe_stage("prompt"):
+            if session is not None and compacted is message_log:
+                # 圧縮が不要な場合はセッションが保持している変換済みのメッセージを再利用する
+                messages = [*session.langchain_messages, HumanMessage(content=request.new_message)]
+            else:
+                messages = to_langchain_messages(compacted)
+            # 同じ会話の同時リクエストは1本の上流ストリームを共有する（SSEはまとめ方が異なるため別扱い）
+            stream_key = request_key("assistant_response", ASSISTANT_CHAT_PROMPT, model_name, 0.7, compacted)
+        # 上流の枠はヘッダー送信前に取得し、空かなければ429を返す（判定・PubMedクエリより後回しになる）
+        sse = "text/event-stream" in http_request.headers.get("accept", "")
+        ticket = await admit_stream(chain, {"messages": messages}, f"{stream_key}:{'sse' if sse else 'text'}")
 
-        # メッセージリストを作成
-        message_log = [{"role": msg.role, "content": msg.content} for msg in request.message_log]
-        message_log.append({"role": "user", "content": request.new_message})
+        async def save_turn(metrics: StreamMetrics, reply: list):
+            # 最後まで生成できたターンだけをセッションに追記する
+            if session is not None and metrics.outcome == "completed":
+                await get_session_store().append(
+                    session, [{"role": "user", "content": request.new_message}, {"role": "assistant", "content": "".join(reply)}]
+                )
 
-        prompt = create_chat_prompt(ASSISTANT_PROMPT, message_log)
-        chain = prompt | llm
+        def finish(metrics: StreamMetrics):
+            # 上流の枠を返し、最初のトークンまでの時間と成否をルーティングに反映する
+            ticket.charge(metrics.deltas)
+            ticket.release()
+            if metrics.outcome == "error":
+                model_router.record(ROUTE_ASSISTANT, model_name, None, ok=False)
+            elif metrics.ttft is not None:
+                model_router.record(ROUTE_ASSISTANT, model_name, metrics.ttft, ok=True)
 
         async def generate():
+            metrics = StreamMetrics()
+            reply: list = []
+            serialize = StageTimer("serialize")
             try:
-                async for chunk in chain.astream({}):
-                    if hasattr(chunk, "content") and chunk.content:
-                        yield str(chunk.content).encode("utf-8")
+                # クライアントが切断したら上流の生成も止める
+                async for text in astream_chat_shared(
+                    chain, {"messages": messages}, f"{stream_key}:text", is_disconnected=http_request.is_disconnected, metrics=metrics
+                ):
+                    reply.append(text)
+                    with serialize.measure():
+                        chunk = text.encode("utf-8")
+                    yield chunk
+                await save_turn(metrics, reply)
             except Exception as e:
-                print(f"Streaming error: {e!s}")
+                logger.warning("Streaming error: %s", e, exc_info=True)
                 raise HTTPException(status_code=500, detail=str(e)) from e
+            finally:
+                finish(metrics)
+                serialize.record()
+
+        async def generate_sse():
+            metrics = StreamMetrics()
+            reply: list = []
+            marker = CompletionMarkerFilter()
+            coalescing = Coalescing(max_chars=settings.SSE_COALESCE_MAX_CHARS, max_delay=settings.SSE_COALESCE_MAX_DELAY)
+            # マーカーの除去とSSEへの整形にかかった時間（上流の待ち時間は含めない）
+            serialize = StageTimer("serialize")
+            try:
+                async for text in astream_chat_shared(
+                    chain,
+                    {"messages": messages},
+                    f"{stream_key}:sse",
+                    is_disconnected=http_request.is_disconnected,
+                    coalescing=coalescing,
+                    metrics=metrics,
+                ):
+                    reply.append(text)
+                    with serialize.measure():
+                        visible = marker.feed(text)
+                        frame = format_sse("delta", {"text": visible}) if visible else None
+                    if frame is not None:
+                        yield frame
+                with serialize.measure():
+                    rest = marker.flush()
+                    frames = [format_sse("delta", {"text": rest})] if rest else []
+                    if marker.found:
+                        frames.append(format_sse("completed", {}))
+                for frame in frames:
+                    yield frame
+                await save_turn(metrics, reply)
+            except Exception as e:
+                logger.warning("Streaming error: %s", e, exc_info=True)
+                yield format_sse("error", {"detail": str(e)})
+            finally:
+                finish(metrics)
+                serialize.record()
+            # 最後に計測値とトークン数を送る
+            yield format_sse(
+                "usage",
+                {
+                    "completion_tokens": metrics.deltas,
+                    "frames": metrics.frames,
+                    "ttft_ms": None if metrics.ttft is None else round(metrics.ttft * 1000, 1),
+                    "duration_ms": None if metrics.duration is None else round(metrics.duration * 1000, 1),
+                },
+            )
 
-        return StreamingResponse(generate(), media_type="text/plain; charset=utf-8")
+        # 本文を送る前にクライアントが切断した場合もbackgroundで枠を返す
+        release = BackgroundTask(ticket.release)
+        # Accept: text/event-stream の場合は型付きイベントのSSEで返す
+        if sse:
+            return StreamingResponse(
+                generate_sse(),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+                background=release,
+            )
+        return StreamingResponse(generate(), media_type="text/plain; charset=utf-8", background=release)
 
+    except AdmissionRejectedError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)}) from e
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e)) from e
@@ -0,0 +1,130 @@
+import asyncio
+import json
+import time
+from collections.abc import AsyncIterator, Awaitable
+from typing import Callable, TypeVar
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import StreamingResponse
+
+from app.api.endpoints.assistant_response import ASSISTANT_CHAT_PROMPT
+from app.api.endpoints.plan import make_plan
+from app.api.schemas.schemas import BaseRequest, BatchItem, BatchResult
+from app.core.config import get_settings
+from app.services.admission import PRIORITY_LOW, AdmissionRejectedError
+from app.services.batch import item_id, map_unordered
+from app.services.history import compact_history
+from app.services.llm_service import ainvoke_routed
+from app.services.resilience import CircuitOpenError
+from app.services.router import ROUTE_ASSISTANT
+from app.services.sessions import load_conversation
+from app.services.sse import COMPLETED_MARKER
+
+router = APIRouter()
+settings = get_settings()
+
+T = TypeVar("T")
+
+# 流量制御・サーキットブレーカーで拒否された場合にRetry-After秒待って再実行する回数（バッチは急がないため）
+REJECTED_RETRIES = 3
+# 1行（1件）の上限。改行のない巨大な入力をメモリにためないため
+MAX_LINE_BYTES = 1 << 20
+
+
+async def _retry_rejected(fn: Callable[[], Awaitable[T]]) -> T:
+    for attempt in range(REJECTED_RETRIES + 1):
+        try:
+            return await fn()
+        except (AdmissionRejectedError, CircuitOpenError) as e:
+            if attempt == REJECTED_RETRIES:
+                raise
+            await asyncio.sleep(e.retry_after)
+    raise AssertionError("unreachable")
+
+
+async def answer_item(item: dict, assistant: bool = True) -> dict:
+    """
+    1件の質問を 判定 → PubMedクエリ → 回答 の順に実行する。失敗した場合もerrorに理由を入れて返す
+    回答は通常のリクエストより低い優先度で上流の枠を取る
+    """
+    started = time.perf_counter()
+    output: dict = {"id": str(item.get("id"))}
+    try:
+        batch_item = BatchItem(**item)
+        request = BaseRequest(new_message=batch_item.new_message, message_log=batch_item.message_log)
+        plan_result = await _retry_rejected(lambda: make_plan(request))
+        output.update(result=plan_result.result, pubmed_query=plan_result.pubmed_query)
+
+        if assistant:
+            _, message_log = await load_conversation(None, request.message_log, request.new_message)
+            messages = await compact_history(message_log, settings.HISTORY_TOKEN_BUDGET_ASSISTANT)
+            text = await _retry_rejected(
+                lambda: ainvoke_routed(
+                    ROUTE_ASSISTANT, ASSISTANT_CHAT_PROMPT, messages, temperature=0.7, timeout=settings.LLM_REQUEST_TIMEOUT, priority=PRIORITY_LOW
+                )
+            )
+            output.update(response=text.replace(COMPLETED_MARKER, "").rstrip(), completed=COMPLETED_MARKER in text)
+    except asyncio.TimeoutError:
+        output["error"] = "LLM request timed out"
+    except Exception as e:
+        output["error"] = f"{type(e).__name__}: {e}"
+    return BatchResult(**output, elapsed_ms=round((time.perf_counter() - started) * 1000, 1)).model_dump()
+
+
+def _too_large(detail: str) -> HTTPException:
+    return HTTPException(status_code=413, detail=f"{detail}, use python -m app.services.batch")
+
+
+async def _lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """
+    受信したチャンクを行に分ける（本文全体をメモリに読み込まない）
+    """
+    pending = b""
+    async for chunk in chunks:
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            yield line
+        if len(pending) > MAX_LINE_BYTES:
+            raise _too_large(f"Line too long (max {MAX_LINE_BYTES} bytes)")
+    if pending:
+        yield pending
+
+
+async def _parse_items(chunks: AsyncIterator[bytes]) -> list[dict]:
+    """
+    JSONLを1行ずつ読み、BATCH_MAX_ITEMSを超えたら残りを読まずに413を返す
+    """
+    items: list[dict] = []
+    line_number = 0
+    async for raw in _lines(chunks):
+        line_number += 1
+        line = raw.decode("utf-8")
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid JSON on line {line_number}: {e}") from e
+        if not isinstance(record, dict):
+            raise HTTPException(status_code=400, detail=f"Line {line_number} is not a JSON object")
+        items.append({**record, "id": item_id(record, line_number)})
+        if len(items) > settings.BATCH_MAX_ITEMS:
+            raise _too_large(f"Too many items (max {settings.BATCH_MAX_ITEMS})")
+    return items
+
+
+@router.post("/batch")
+async def batch(http_request: Request, concurrency: int = settings.BATCH_MAX_CONCURRENCY, assistant: bool = True):
+    """
+    JSONL（1行に1件の {id, new_message, message_log}）の質問をまとめて実行し、終わった順に結果をJSONLで返す
+    同時実行数はBATCH_MAX_CONCURRENCYまで
+    """
+    items = await _parse_items(http_request.stream())
+    concurrency = max(1, min(concurrency, settings.BATCH_MAX_CONCURRENCY))
+
+    async def generate():
+        async for result in map_unordered(lambda item: answer_item(item, assistant=assistant), items, concurrency):
+            yield (json.dumps(result, ensure_ascii=False) + "\n").encode("utf-8")
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
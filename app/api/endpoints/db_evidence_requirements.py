@@ -1,9 +1,20 @@
+import asyncio
+
 from fastapi import APIRouter, HTTPException
 
 from app.api.schemas.schemas import BaseRequest, JudgeResponse
-from app.services.llm_service import create_chat_prompt, get_llm
+from app.core.config import get_settings
+from app.services.admission import AdmissionRejectedError
+from app.services.history import compact_history
+from app.services.judge_classifier import alog_judge_decision, judge_locally
+from app.services.llm_service import ainvoke_routed, compile_chat_prompt
+from app.services.metrics import observe_stage
+from app.services.resilience import CircuitOpenError
+from app.services.router import ROUTE_JUDGE
+from app.services.sessions import load_conversation
 
 router = APIRouter()
+settings = get_settings()
 
 ASSIST_JUDGE_PROMPT = """
 ## 指示
@@ -25,20 +36,33 @@ ASSIST_JUDGE_PROMPT = """
 - 「論文データベースの検索」が不要であると判断した場合は[DB_EVIDENCE:NOT]を返してください
 """
 
+ASSIST_JUDGE_CHAT_PROMPT = compile_chat_prompt(ASSIST_JUDGE_PROMPT)
+
 
 @router.post("/db_evidence_requirements", response_model=JudgeResponse)
 async def judge_db_evidence_requirement(request: BaseRequest):
     try:
-        llm = get_llm(model_name="gpt-4o-mini", temperature=0.7)
-        # message_logを辞書のリストに変換
-        message_log = [{"role": msg.role, "content": msg.content} for msg in request.message_log]
-        message_log.append({"role": "user", "content": request.new_message})
+        # ローカルの分類器が最新のメッセージだけで確信を持てる場合はLLMを呼ばずに返す
+        local = judge_locally(request.new_message)
+        if local is not None:
+            return JudgeResponse(result=local)
+
+        # session_idがあればサーバー側の履歴、なければmessage_logを使う
+        with observe_stage("history"):
+            _, message_log = await load_conversation(request.session_id, request.message_log, request.new_message)
+            message_log = await compact_history(message_log, settings.HISTORY_TOKEN_BUDGET_JUDGE)
 
-        prompt = create_chat_prompt(ASSIST_JUDGE_PROMPT, message_log)
-        chain = prompt | llm
-        response = chain.invoke({})
+        result = await ainvoke_routed(
+            ROUTE_JUDGE, ASSIST_JUDGE_CHAT_PROMPT, message_log, temperature=0.7, cache_namespace="db_evidence_requirements", hedge=True
+        )
+        await alog_judge_decision(request.new_message, result)
 
-        result = str(response.content).strip()
         return JudgeResponse(result=result)
+    except asyncio.TimeoutError as e:
+        raise HTTPException(status_code=504, detail="LLM request timed out") from e
+    except AdmissionRejectedError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)}) from e
+    except CircuitOpenError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)}) from e
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e)) from e
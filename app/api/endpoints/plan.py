@@ -0,0 +1,88 @@
+import asyncio
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException
+
+from app.api.endpoints.db_evidence_requirements import ASSIST_JUDGE_CHAT_PROMPT
+from app.api.endpoints.pubmed_query import PUBMED_QUERY_CHAT_PROMPT
+from app.api.schemas.schemas import BaseRequest, PlanResponse
+from app.core.config import get_settings
+from app.services.admission import AdmissionRejectedError
+from app.services.history import compact_history
+from app.services.judge_classifier import alog_judge_decision, judge_locally
+from app.services.llm_service import ainvoke_routed
+from app.services.metrics import observe_stage
+from app.services.resilience import CircuitOpenError
+from app.services.router import ROUTE_JUDGE, ROUTE_PUBMED_QUERY
+from app.services.sessions import load_conversation
+
+router = APIRouter()
+settings = get_settings()
+
+DB_EVIDENCE_NOT = "[DB_EVIDENCE:NOT]"
+
+
+async def _judge(new_message: str, message_log: list, local: Optional[str]) -> str:
+    if local is not None:
+        return local
+    messages = await compact_history(message_log, settings.HISTORY_TOKEN_BUDGET_JUDGE)
+    result = await ainvoke_routed(
+        ROUTE_JUDGE, ASSIST_JUDGE_CHAT_PROMPT, messages, temperature=0.7, cache_namespace="db_evidence_requirements", hedge=True
+    )
+    await alog_judge_decision(new_message, result)
+    return result
+
+
+async def _pubmed_query(message_log: list) -> str:
+    messages = await compact_history(message_log, settings.HISTORY_TOKEN_BUDGET_PUBMED_QUERY)
+    return await ainvoke_routed(ROUTE_PUBMED_QUERY, PUBMED_QUERY_CHAT_PROMPT, messages, temperature=0.7, cache_namespace="pubmed_query", hedge=True)
+
+
+async def make_plan(request: BaseRequest) -> PlanResponse:
+    """
+    DB検索要否の判定とPubMedクエリ生成を同時に実行する（例外はそのまま送出する）
+    判定が[DB_EVIDENCE:NOT]の場合はクエリ生成をキャンセルする
+    ローカルの分類器がNOTと判定した場合は履歴の読み込みもLLMの呼び出しも行わない
+    """
+    local = judge_locally(request.new_message)
+    if local is not None and DB_EVIDENCE_NOT in local:
+        return PlanResponse(result=local, pubmed_query=None)
+
+    # session_idがあればサーバー側の履歴、なければmessage_logを使う
+    with observe_stage("history"):
+        _, message_log = await load_conversation(request.session_id, request.message_log, request.new_message)
+
+    judge_task = asyncio.create_task(_judge(request.new_message, message_log, local))
+    query_task = asyncio.create_task(_pubmed_query(message_log))
+    try:
+        result = await judge_task
+        if DB_EVIDENCE_NOT in result:
+            query_task.cancel()
+            return PlanResponse(result=result, pubmed_query=None)
+
+        pubmed_query = await query_task
+        return PlanResponse(result=result, pubmed_query=pubmed_query)
+    finally:
+        # 例外やクライアント切断時に残ったタスクを止め、終わるまで待つ（待たないと例外が取り出されずに残る）
+        pending = [task for task in (judge_task, query_task) if not task.done()]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+@router.post("/plan", response_model=PlanResponse)
+async def plan(request: BaseRequest):
+    """
+    DB検索要否の判定とPubMedクエリ生成を同時に実行する
+    判定が[DB_EVIDENCE:NOT]の場合はクエリ生成をキャンセルする
+    """
+    try:
+        return await make_plan(request)
+    except asyncio.TimeoutError as e:
+        raise HTTPException(status_code=504, detail="LLM request timed out") from e
+    except AdmissionRejectedError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)}) from e
+    except CircuitOpenError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)}) from e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e)) from e
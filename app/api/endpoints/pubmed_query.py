@@ -1,9 +1,19 @@
+import asyncio
+
 from fastapi import APIRouter, HTTPException
 
 from app.api.schemas.schemas import BaseRequest, PubMedQueryResponse
-from app.services.llm_service import create_chat_prompt, get_llm
+from app.core.config import get_settings
+from app.services.admission import AdmissionRejectedError
+from app.services.history import compact_history
+from app.services.llm_service import ainvoke_routed, compile_chat_prompt
+from app.services.metrics import observe_stage
+from app.services.resilience import CircuitOpenError
+from app.services.router import ROUTE_PUBMED_QUERY
+from app.services.sessions import load_conversation
 
 router = APIRouter()
+settings = get_settings()
 
 PUBMED_QUERY_PROMPT = """
 #プロンプト
@@ -33,19 +43,27 @@ PUBMED_QUERY_PROMPT = """
    - 上記フォーマット外のテキスト(説明・理由・参考情報など)は **絶対に書かない**。
 """
 
+PUBMED_QUERY_CHAT_PROMPT = compile_chat_prompt(PUBMED_QUERY_PROMPT)
+
 
 @router.post("/pubmed-query", response_model=PubMedQueryResponse)
 async def generate_pubmed_query(request: BaseRequest):
     try:
-        llm = get_llm(model_name="gpt-4o-mini", temperature=0.7)
-        # message_logを辞書のリストに変換
-        message_log = [{"role": msg.role, "content": msg.content} for msg in request.message_log]
-        message_log.append({"role": "user", "content": request.new_message})
+        # session_idがあればサーバー側の履歴、なければmessage_logを使う
+        with observe_stage("history"):
+            _, message_log = await load_conversation(request.session_id, request.message_log, request.new_message)
+            message_log = await compact_history(message_log, settings.HISTORY_TOKEN_BUDGET_PUBMED_QUERY)
 
-        prompt = create_chat_prompt(PUBMED_QUERY_PROMPT, message_log)
-        chain = prompt | llm
-        response = chain.invoke({})
+        pubmed_query = await ainvoke_routed(
+            ROUTE_PUBMED_QUERY, PUBMED_QUERY_CHAT_PROMPT, message_log, temperature=0.7, cache_namespace="pubmed_query", hedge=True
+        )
 
-        return PubMedQueryResponse(pubmed_query=str(response.content).strip())
+        return PubMedQueryResponse(pubmed_query=pubmed_query)
+    except asyncio.TimeoutError as e:
+        raise HTTPException(status_code=504, detail="LLM request timed out") from e
+    except AdmissionRejectedError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)}) from e
+    except CircuitOpenError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)}) from e
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e)) from e
@@ -0,0 +1,30 @@
+from fastapi import APIRouter, HTTPException
+
+from app.api.schemas.schemas import Message, SessionResponse
+from app.services.sessions import get_session_store
+
+router = APIRouter()
+
+
+@router.post("/sessions", response_model=SessionResponse)
+async def create_session():
+    """
+    新しい会話セッションを作成する（以降のリクエストではsession_idとnew_messageだけを送る）
+    """
+    session = await get_session_store().create()
+    return SessionResponse(session_id=session.session_id, message_log=[])
+
+
+@router.get("/sessions/{session_id}", response_model=SessionResponse)
+async def get_session(session_id: str):
+    session = await get_session_store().get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return SessionResponse(session_id=session.session_id, message_log=[Message(**msg) for msg in session.messages])
+
+
+@router.delete("/sessions/{session_id}")
+async def delete_session(session_id: str):
+    if not await get_session_store().delete(session_id):
+        raise HTTPException(status_code=404, detail="Session not found")
+    return {"deleted": True}
@@ -1,3 +1,5 @@
+from typing import Optional
+
 from pydantic import BaseModel
 
 
@@ -8,7 +10,8 @@ class Message(BaseModel):
 
 class BaseRequest(BaseModel):
     new_message: str
-    message_log: list[Message]
+    message_log: list[Message] = []  # session_idを使う場合は省略できる
+    session_id: Optional[str] = None  # 指定するとサーバー側で保持した履歴を使う
 
 
 class JudgeResponse(BaseModel):
@@ -19,5 +22,31 @@ class PubMedQueryResponse(BaseModel):
     pubmed_query: str
 
 
+class PlanResponse(BaseModel):
+    result: str  # [DB_EVIDENCE:NEED] または [DB_EVIDENCE:NOT] を返す
+    pubmed_query: Optional[str] = None  # [DB_EVIDENCE:NOT] の場合は生成しない
+
+
+class SessionResponse(BaseModel):
+    session_id: str
+    message_log: list[Message]
+
+
 class AssistantResponse(BaseModel):
     response: str
+
+
+class BatchItem(BaseModel):
+    id: Optional[str] = None  # 省略時は行番号
+    new_message: str
+    message_log: list[Message] = []
+
+
+class BatchResult(BaseModel):
+    id: str
+    result: Optional[str] = None  # [DB_EVIDENCE:NEED] または [DB_EVIDENCE:NOT]
+    pubmed_query: Optional[str] = None
+    response: Optional[str] = None  # 回答（<<COMPLETED>>タグは除く）
+    completed: Optional[bool] = None  # 回答に<<COMPLETED>>タグが付いていたか
+    error: Optional[str] = None
+    elapsed_ms: float
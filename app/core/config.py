@@ -12,13 +12,137 @@ class Settings(BaseSettings):
 
     # OpenAI設定
     OPENAI_API_KEY: Optional[str] = os.getenv("OPENAI_API_KEY")
-    MODEL_NAME: str = "gpt-3.5-turbo"  # デフォルトのモデル
+    MODEL_NAME: str = "gpt-4o-mini"  # デフォルトのモデル（MODEL_ROUTESに指定のないエンドポイントで使う）
     TEMPERATURE: float = 0.7  # デフォルトの温度
+    OPENAI_BASE_URL: Optional[str] = None  # 互換サーバーを使う場合に指定
+    LLM_MODE: str = "live"  # live / record（応答を記録） / replay（記録から応答しネットワークを使わない）
+    LLM_CASSETTE_PATH: str = "llm_cassettes.sqlite3"
+    LLM_REPLAY_SPEED: float = 0.0  # 再生時に記録した待ち時間に掛ける係数（0で待たない、1で実時間）
+
+    # OpenAI HTTP接続プール設定
+    LLM_MAX_CONNECTIONS: int = 100  # プール全体の最大接続数
+    LLM_MAX_KEEPALIVE_CONNECTIONS: int = 20  # keep-aliveで保持する接続数
+    LLM_KEEPALIVE_EXPIRY: float = 60.0  # アイドル接続を保持する秒数
+    LLM_REQUEST_TIMEOUT: float = 120.0  # 1リクエストあたりのタイムアウト秒数
+    LLM_MAX_RETRIES: int = 2
+    LLM_CALL_TIMEOUT: float = 30.0  # 非ストリーミング呼び出し全体のタイムアウト秒数
+    STREAM_DISCONNECT_POLL_INTERVAL: float = 0.5  # ストリーミング中にクライアント切断を確認する間隔（秒）
+    SSE_COALESCE_MAX_CHARS: int = 32  # SSEモードでデルタをまとめる文字数のしきい値
+    SSE_COALESCE_MAX_DELAY: float = 0.05  # SSEモードでデルタをまとめる時間のしきい値（秒）
+    LLM_WARMUP_CONNECTIONS: int = 1  # 起動時に事前確立する接続数（0で無効）
+    SINGLE_FLIGHT_ENABLED: bool = True  # 実行中の同一リクエスト（判定・PubMedクエリ）を1回の上流呼び出しにまとめる
+    STREAM_FANOUT_ENABLED: bool = True  # 配信中の同一ストリーミング応答に後続のリクエストを相乗りさせる
+
+    # モデルのルーティング設定
+    # エンドポイント（assistant / judge / pubmed_query）ごとの候補モデル。先頭が優先で、不調なら次の候補に切り替える
+    # 例: {"assistant": ["o3", "gpt-4o"], "judge": ["gpt-4o-mini", "gpt-4.1-nano"]}
+    MODEL_ROUTES: dict[str, list[str]] = {}
+    MODEL_ROUTER_WINDOW: float = 60.0  # レイテンシ・エラー率を集計する直近の秒数
+    MODEL_ROUTER_MIN_SAMPLES: int = 10  # これより少ないモデルは正常とみなす
+    MODEL_ROUTER_MAX_ERROR_RATE: float = 0.2  # これを超えたモデルは不調とみなす
+    MODEL_ROUTER_LATENCY_PERCENTILE: float = 90.0
+    # エンドポイントごとのレイテンシ（ストリーミングは最初のトークンまで）の上限秒数。百分位がこれを超えたモデルは不調とみなす
+    MODEL_ROUTER_MAX_LATENCY: dict[str, float] = {"assistant": 10.0, "judge": 5.0, "pubmed_query": 5.0}
+
+    # 流量制御設定（OpenAIのレート制限を超えないようモデルごとに同時実行数とトークン数を制限する）
+    ADMISSION_ENABLED: bool = True
+    ADMISSION_MAX_CONCURRENCY: int = 64  # モデルごとの同時実行数の上限
+    ADMISSION_TOKENS_PER_MINUTE: int = 0  # モデルごとの1分あたりのトークン数の上限（0で無制限）
+    ADMISSION_MODEL_LIMITS: dict[str, dict[str, int]] = {}  # モデルごとの上書き 例: {"gpt-4o": {"max_concurrency": 8, "tokens_per_minute": 30000}}
+    ADMISSION_MAX_QUEUE: int = 256  # 空きを待てるリクエスト数（超えたら429）
+    ADMISSION_MAX_WAIT: float = 10.0  # 空きを待つ上限秒数（超えたら429）
+    ADMISSION_RATE_LIMIT_BACKOFF: float = 1.0  # 上流の429にRetry-Afterがない場合に新規呼び出しを止める秒数（連続すると倍にする）
+
+    # 非ストリーミング呼び出しの再試行・サーキットブレーカー設定（有効時はSDK内部の再試行を使わない）
+    LLM_RESILIENCE_ENABLED: bool = False
+    LLM_RETRY_ATTEMPTS: int = 2  # 一時的なエラー（接続エラー・5xx）時の再試行回数
+    LLM_RETRY_BASE_DELAY: float = 0.2  # 再試行の待ち時間の基準（秒）。attempt回目は0〜base*2^attemptの一様乱数
+    LLM_RETRY_MAX_DELAY: float = 2.0
+    LLM_BREAKER_FAILURE_THRESHOLD: int = 5  # 連続してこの回数失敗したモデルへの呼び出しを止める
+    LLM_BREAKER_RESET_TIMEOUT: float = 10.0  # 止めてから試行を1件だけ通すまでの秒数
+
+    # ヘッジ設定（判定・PubMedクエリ）。1本目が直近のレイテンシの百分位を超えても返らなければ2本目を送る
+    LLM_HEDGING_ENABLED: bool = False
+    LLM_HEDGE_PERCENTILE: float = 95.0
+    LLM_HEDGE_MIN_DELAY: float = 0.1  # ヘッジまでの最短の待ち時間（秒）
+    LLM_HEDGE_DEFAULT_DELAY: float = 1.0  # レイテンシのサンプルが足りないときの待ち時間（秒）
+    LLM_HEDGE_WINDOW: int = 200  # 百分位の計算に使う直近の呼び出し数
+
+    # DB検索要否の判定をローカルの分類器で先に行う設定（確信度が低い場合のみLLMで判定する）
+    JUDGE_CLASSIFIER_ENABLED: bool = False
+    JUDGE_CLASSIFIER_PATH: str = "judge_classifier.json"  # python -m app.services.judge_classifier train の出力
+    JUDGE_CLASSIFIER_NEED_THRESHOLD: float = 0.9  # NEEDの確率がこれ以上なら分類器の判定を返す
+    JUDGE_CLASSIFIER_NOT_THRESHOLD: float = 0.97  # NOTの確率がこれ以上なら分類器の判定を返す（誤るとエビデンスなしで回答するため高めにする）
+    JUDGE_DECISION_LOG_PATH: Optional[str] = None  # LLMの判定結果をJSONLで追記する（分類器の学習データ）
+
+    # まとめて実行する設定（/api/batch と python -m app.services.batch）
+    BATCH_MAX_CONCURRENCY: int = 8  # 同時に処理する質問数の上限（回答は流量制御で通常のリクエストより後回しになる）
+    BATCH_MAX_ITEMS: int = 1000  # /api/batch の1リクエストあたりの質問数の上限（これより多い場合はCLIを使う）
+
+    # 応答キャッシュ設定（判定・PubMedクエリ）
+    RESPONSE_CACHE_ENABLED: bool = False
+    RESPONSE_CACHE_BACKEND: str = "memory"  # memory / sqlite / redis
+    RESPONSE_CACHE_DETERMINISTIC: bool = True  # 有効時はtemperature=0で呼び出し、キャッシュ結果の妥当性を保つ
+    RESPONSE_CACHE_TTL: float = 3600.0  # 秒
+    RESPONSE_CACHE_MAX_ENTRIES: int = 10000
+    RESPONSE_CACHE_MAX_VALUE_BYTES: int = 64 * 1024
+    RESPONSE_CACHE_SQLITE_PATH: str = "response_cache.sqlite3"
+    RESPONSE_CACHE_REDIS_URL: str = "redis://localhost:6379/0"
+
+    # 会話履歴の圧縮設定（エンドポイントごとのトークン予算）
+    HISTORY_TOKEN_BUDGET_ASSISTANT: int = 8000
+    HISTORY_TOKEN_BUDGET_JUDGE: int = 1500
+    HISTORY_TOKEN_BUDGET_PUBMED_QUERY: int = 2000
+    HISTORY_SUMMARY_ENABLED: bool = True  # 無効時は予算を超えた古いターンを単に削除する
+    HISTORY_SUMMARY_MODEL: str = "gpt-4o-mini"
+    HISTORY_SUMMARY_RESERVE_TOKENS: int = 500  # 要約用に予算から確保しておくトークン数
+    HISTORY_SUMMARY_CACHE_SIZE: int = 1000
+    HISTORY_SUMMARY_CACHE_TTL: float = 86400.0  # 秒
+
+    # 会話セッション設定
+    SESSION_BACKEND: str = "memory"  # memory / sqlite
+    SESSION_MAX_SESSIONS: int = 10000  # 保持するセッション数の上限（古いものから削除）
+    SESSION_TTL: float = 86400.0  # 最終更新からの保持秒数
+    SESSION_CACHE_SIZE: int = 1000  # sqlite使用時にメモリ上にも保持するセッション数
+    SESSION_SQLITE_PATH: str = "sessions.sqlite3"
+
+    # メトリクス設定
+    METRICS_ENABLED: bool = True  # /metrics でPrometheus形式のメトリクスを公開する
 
     # Pinecone設定
     PINECONE_API_KEY: Optional[str] = None
     PINECONE_INDEX: Optional[str] = None
 
+    # ベクトルストア設定（add_document.pyとapp.pyで共通）
+    VECTORSTORE_BACKEND: str = "pinecone"  # pinecone / local
+    LOCAL_VECTORSTORE_PATH: str = "vector_index"  # ローカルのベクトルストアのディレクトリ
+    LOCAL_VECTORSTORE_DTYPE: str = "float32"  # float32 / int8（新規作成時のみ。int8はファイルが約1/4になる）
+    LOCAL_VECTORSTORE_NPROBE: int = 8  # IVFの学習後、1クエリで探す分割数
+
+    # PDFの取り込み（add_document.py）の埋め込み設定
+    EMBEDDING_MODEL: str = "text-embedding-ada-002"  # 取り込みと検索で同じモデルを使う
+    EMBEDDING_CACHE_PATH: str = "embedding_cache.sqlite3"  # (モデル, チャンクの本文) のハッシュをキーにした埋め込みのキャッシュ
+    EMBEDDING_BATCH_MAX_TOKENS: int = 50000  # 1回の埋め込みリクエストに含めるトークン数の上限
+    EMBEDDING_BATCH_MAX_ITEMS: int = 1000  # 1回の埋め込みリクエストに含めるチャンク数の上限
+    EMBEDDING_MAX_CONCURRENCY: int = 4  # 同時に送る埋め込みリクエスト数
+    EMBEDDING_TOKENS_PER_MINUTE: int = 1000000  # 埋め込みの1分あたりのトークン数の上限（0で無制限）
+    INGEST_MANIFEST_PATH: str = "ingest_manifest.sqlite3"  # 取り込み済みのファイルの内容のハッシュとチャンクのID
+
+    # RAG（app.py）の検索キャッシュ設定
+    RETRIEVAL_QUERY_EMBEDDING_CACHE_SIZE: int = 1024  # 埋め込みを保持するクエリ数
+    RETRIEVAL_RESULT_CACHE_SIZE: int = 1024  # 検索結果を保持するクエリ数
+    RETRIEVAL_RESULT_CACHE_TTL: float = 300.0  # 検索結果を再利用する秒数（インデックス更新の反映までの遅れの上限）
+    RETRIEVAL_HYBRID_ENABLED: bool = True  # 語彙インデックスがあればベクトル検索と組み合わせる
+    RETRIEVAL_HYBRID_CANDIDATES: int = 20  # 融合に使うベクトル検索・語彙インデックスそれぞれの件数
+    RETRIEVAL_RRF_K: int = 60  # 逆順位融合の定数（大きいほど下位の順位の差が小さくなる）
+    LEXICAL_INDEX_PATH: str = "lexical_index"  # 取り込み時に作る語彙インデックス（BM25）のディレクトリ
+    LEXICAL_INDEX_FLUSH_DOCS: int = 20000  # 取り込み時にこの件数ごとにセグメントを書く
+    LEXICAL_INDEX_MAX_SEGMENTS: int = 8  # セグメントがこれを超えたら1つに統合する
+    THREAD_HISTORY_SQLITE_PATH: str = "thread_history.sqlite3"  # RAGの会話履歴（追記のみ）
+    THREAD_HISTORY_MAX_MESSAGES: int = 50  # 質問に含める直近のメッセージ数
+    THREAD_HISTORY_CACHE_SIZE: int = 1000  # 直近のメッセージをメモリ上にも保持するスレッド数
+    THREAD_HISTORY_LANGSMITH_BACKFILL: bool = True  # 記録のないスレッドはLangSmithのrunから履歴を取り込む
+
     # LangSmith設定
     LANGSMITH_TRACING: bool = False
     LANGSMITH_ENDPOINT: Optional[str] = None
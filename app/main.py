@@ -1,19 +1,38 @@
+import asyncio
+from contextlib import asynccontextmanager
+
 from dotenv import load_dotenv
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 
-from app.api.endpoints import assistant_response, db_evidence_requirements, pubmed_query
+from app.api.endpoints import assistant_response, batch, db_evidence_requirements, plan, pubmed_query, sessions
 from app.core.config import get_settings
+from app.services.judge_classifier import load_judge_classifier
+from app.services.llm_service import close_llm_clients, warmup_llm_clients
+from app.services.metrics import MetricsMiddleware, registry
+from app.services.response_cache import close_response_cache
+from app.services.sessions import close_session_store
+from app.services.tokens import token_counter
 
 # ルートの .env を読み込む
 load_dotenv()
 
 settings = get_settings()
 
-app = FastAPI(
-    title=settings.APP_NAME,
-    debug=settings.DEBUG
-)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 起動時にOpenAIへの接続プールを準備し、終了時に閉じる
+    # トークナイザー（初回はダウンロードを伴う）と判定の分類器の読み込みもリクエスト前に済ませる
+    await asyncio.gather(warmup_llm_clients(), asyncio.to_thread(token_counter.load), asyncio.to_thread(load_judge_classifier))
+    yield
+    await close_llm_clients()
+    await close_response_cache()
+    await close_session_store()
+
+
+app = FastAPI(title=settings.APP_NAME, debug=settings.DEBUG, lifespan=lifespan)
 
 # CORS設定
 app.add_middleware(
@@ -24,10 +43,25 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# リクエストのレイテンシ計測（ストリーミング応答も最後まで計測する）
+if settings.METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
 # ルーターの登録
 app.include_router(pubmed_query.router, prefix="/api", tags=["pubmed_query"])
 app.include_router(db_evidence_requirements.router, prefix="/api", tags=["db_evidence"])
 app.include_router(assistant_response.router, prefix="/api", tags=["assistant_response"])
+app.include_router(plan.router, prefix="/api", tags=["plan"])
+app.include_router(sessions.router, prefix="/api", tags=["sessions"])
+app.include_router(batch.router, prefix="/api", tags=["batch"])
+
+
+if settings.METRICS_ENABLED:
+
+    @app.get("/metrics", include_in_schema=False)
+    async def metrics():
+        return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 
 @app.get("/")
 async def root():
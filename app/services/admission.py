@@ -0,0 +1,342 @@
+"""
+OpenAI上流の流量制御（アドミッション制御）
+モデルごとに同時実行数と1分あたりのトークン数を制限し、空きがない呼び出しは優先度付きの待ち行列で待たせる
+待ち行列が満杯か待ち時間が上限を超えた場合はAdmissionRejectedErrorを送出する（エンドポイントで429にする）
+上流から429が返った場合は新規の呼び出しを一時停止し、同時実行数を半分にしてから成功に応じて1ずつ戻す
+"""
+
+import asyncio
+import heapq
+import itertools
+import json
+import math
+import re
+import time
+import weakref
+from dataclasses import dataclass, field
+from typing import Optional
+
+import httpx
+
+from app.core.config import get_settings
+from app.services.metrics import CallbackMetric, Counter, Histogram, registry
+
+settings = get_settings()
+
+PRIORITY_HIGH = 0  # 判定・PubMedクエリ生成などの短い非ストリーミング呼び出し
+PRIORITY_NORMAL = 1  # 履歴の要約
+PRIORITY_LOW = 2  # アシスタントの長いストリーミング応答
+
+MAX_RATE_LIMIT_BACKOFF = 60.0
+_RESET_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_RESET_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+ADMISSION_WAIT = registry.register(Histogram("llm_admission_wait_seconds", "Time spent waiting for an upstream slot", ("model", "priority")))
+ADMISSION_REJECTIONS = registry.register(
+    Counter("llm_admission_rejections_total", "LLM calls rejected with 429 before reaching upstream", ("model", "reason"))
+)
+UPSTREAM_RATE_LIMITED = registry.register(Counter("llm_upstream_rate_limited_total", "429 responses received from upstream", ("model",)))
+
+
+class AdmissionRejectedError(Exception):
+    """
+    上流の枠が空かないため呼び出しを受け付けなかった（retry_afterは再試行までの秒数）
+    """
+
+    def __init__(self, model: str, retry_after: float, reason: str):
+        self.model = model
+        self.retry_after = max(1, math.ceil(retry_after))
+        self.reason = reason
+        super().__init__(f"LLM capacity exceeded for {model} ({reason}), retry after {self.retry_after}s")
+
+
+class Ticket:
+    """
+    取得した上流の実行枠。使い終わったらrelease()で返す（2回目以降の呼び出しは無視する）
+    """
+
+    def __init__(self, limiter: Optional["ModelLimiter"] = None):
+        self._limiter = limiter
+        self.released = limiter is None
+
+    def charge(self, tokens: int):
+        # 応答のトークン数など、後から分かった消費量をトークン数の枠から差し引く
+        if self._limiter is not None and not self.released:
+            self._limiter.charge(tokens)
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        self._limiter._release()
+
+
+@dataclass(order=True)
+class _Waiter:
+    priority: int
+    seq: int
+    tokens: int = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+
+
+class ModelLimiter:
+    """
+    1モデル分の同時実行数・トークン数の制限と優先度付きの待ち行列
+    優先度の数値が小さい呼び出しから順に、同じ優先度では到着順に実行枠を割り当てる
+    """
+
+    def __init__(self, model: str, max_concurrency: int, tokens_per_minute: int, max_queue: int, max_wait: float):  # noqa: PLR0913
+        self.model = model
+        self.max_concurrency = max(1, max_concurrency)
+        self.concurrency_limit = self.max_concurrency  # 上流の429で下がり、成功が続くと上限まで戻る
+        self.tokens_per_minute = tokens_per_minute
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.active = 0
+        self._tokens = float(tokens_per_minute)
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._backoff_streak = 0
+        self._successes = 0
+        self._waiters: list[_Waiter] = []
+        self._seq = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self, tokens: int, priority: int = PRIORITY_NORMAL) -> Ticket:
+        if self.tokens_per_minute > 0:
+            # 1分あたりの上限を超える呼び出しも、枠が満杯になるまで待てば通す
+            tokens = min(tokens, self.tokens_per_minute)
+        if not self._waiters and self._can_start(tokens):
+            ADMISSION_WAIT.observe(0.0, model=self.model, priority=str(priority))
+            return self._start(tokens)
+        if len(self._waiters) >= self.max_queue:
+            raise self._reject("queue_full")
+
+        started = time.perf_counter()
+        waiter = _Waiter(priority, next(self._seq), tokens, asyncio.get_running_loop().create_future())
+        heapq.heappush(self._waiters, waiter)
+        self._schedule_wakeup()
+        try:
+            ticket = await asyncio.wait_for(asyncio.shield(waiter.future), timeout=self.max_wait)
+        except asyncio.TimeoutError:
+            if not waiter.future.done():
+                self._leave(waiter)
+                raise self._reject("timeout") from None
+            ticket = waiter.future.result()
+        except asyncio.CancelledError:
+            self._leave(waiter)
+            raise
+        ADMISSION_WAIT.observe(time.perf_counter() - started, model=self.model, priority=str(priority))
+        return ticket
+
+    def charge(self, tokens: int):
+        if self.tokens_per_minute > 0:
+            self._refill()
+            self._tokens -= tokens
+
+    def on_rate_limited(self, retry_after: Optional[float]):
+        """
+        上流の429を受けて新規の呼び出しを止め、同時実行数を半分にする（同じ一時停止中の429では1回だけ）
+        """
+        UPSTREAM_RATE_LIMITED.inc(model=self.model)
+        now = time.monotonic()
+        if now >= self._paused_until:
+            self.concurrency_limit = max(1, self.concurrency_limit // 2)
+            self._backoff_streak += 1
+        self._successes = 0
+        if retry_after is None:
+            retry_after = min(settings.ADMISSION_RATE_LIMIT_BACKOFF * 2 ** (self._backoff_streak - 1), MAX_RATE_LIMIT_BACKOFF)
+        self._paused_until = max(self._paused_until, now + retry_after)
+        self._schedule_wakeup()
+
+    def retry_after(self) -> float:
+        """
+        クライアントに返すRetry-Afterの見積もり（秒）
+        """
+        now = time.monotonic()
+        wait = max(self._paused_until - now, 0.0)
+        if self.tokens_per_minute > 0:
+            self._refill()
+            if self._tokens < 0:
+                wait = max(wait, -self._tokens * 60 / self.tokens_per_minute)
+        return max(wait, 1.0)
+
+    def _reject(self, reason: str) -> AdmissionRejectedError:
+        ADMISSION_REJECTIONS.inc(model=self.model, reason=reason)
+        return AdmissionRejectedError(self.model, self.retry_after(), reason)
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(float(self.tokens_per_minute), self._tokens + (now - self._refilled_at) * self.tokens_per_minute / 60)
+        self._refilled_at = now
+
+    def _can_start(self, tokens: int) -> bool:
+        if time.monotonic() < self._paused_until or self.active >= self.concurrency_limit:
+            return False
+        if self.tokens_per_minute <= 0:
+            return True
+        self._refill()
+        return self._tokens >= tokens
+
+    def _start(self, tokens: int) -> Ticket:
+        self.active += 1
+        if self.tokens_per_minute > 0:
+            self._tokens -= tokens
+        return Ticket(self)
+
+    def _release(self):
+        self.active -= 1
+        self._successes += 1
+        # 加算的に同時実行数を戻す（現在の上限と同じ回数だけ完了したら1増やす）
+        if self.concurrency_limit < self.max_concurrency and self._successes >= self.concurrency_limit:
+            self.concurrency_limit += 1
+            self._successes = 0
+            if self.concurrency_limit == self.max_concurrency:
+                self._backoff_streak = 0
+        self._dispatch()
+
+    def _leave(self, waiter: _Waiter):
+        # 待機中にキャンセル・タイムアウトした呼び出しを待ち行列から外す
+        waiter.future.cancel()
+        self._waiters.remove(waiter)
+        heapq.heapify(self._waiters)
+        self._dispatch()
+
+    def _dispatch(self):
+        self._timer = None
+        while self._waiters and self._can_start(self._waiters[0].tokens):
+            waiter = heapq.heappop(self._waiters)
+            waiter.future.set_result(self._start(waiter.tokens))
+        self._schedule_wakeup()
+
+    def _schedule_wakeup(self):
+        # 一時停止の解除やトークンの補充を待っている場合は、その時刻に待ち行列を再確認する
+        # （同時実行数で待っている場合は_releaseから再確認される）
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._waiters:
+            return
+        now = time.monotonic()
+        if self._paused_until > now:
+            delay = self._paused_until - now
+        elif self.active < self.concurrency_limit and self.tokens_per_minute > 0:
+            self._refill()
+            delay = max(self._waiters[0].tokens - self._tokens, 0.0) * 60 / self.tokens_per_minute
+        else:
+            return
+        self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+
+
+def retry_after_from_headers(headers: httpx.Headers) -> Optional[float]:
+    """
+    上流の429応答のヘッダーから再試行までの秒数を読み取る
+    retry-after-ms / retry-after を優先し、なければ枠を使い切った側の x-ratelimit-reset-* を使う
+    """
+    for name, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        value = headers.get(name)
+        if value is not None:
+            try:
+                return float(value) * scale
+            except ValueError:
+                continue
+    waits = []
+    for kind in ("requests", "tokens"):
+        reset = headers.get(f"x-ratelimit-reset-{kind}")
+        if reset is not None and headers.get(f"x-ratelimit-remaining-{kind}") == "0":
+            waits.append(sum(float(amount) * _RESET_UNITS[unit] for amount, unit in _RESET_PATTERN.findall(reset)))
+    return max(waits) if waits else None
+
+
+class AdmissionController:
+    """
+    モデルごとのModelLimiterを管理する（待ち行列のFutureはイベントループに紐づくため、ループごとに分ける）
+    終了したループの状態（一時停止など）を引き継がないよう、ループへの弱参照で保持する
+    """
+
+    def __init__(self):
+        self._limiters: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[str, ModelLimiter]] = weakref.WeakKeyDictionary()
+
+    def limiter(self, model: str) -> ModelLimiter:
+        limiters = self._limiters.setdefault(asyncio.get_running_loop(), {})
+        limiter = limiters.get(model)
+        if limiter is None:
+            overrides = settings.ADMISSION_MODEL_LIMITS.get(model, {})
+            limiter = ModelLimiter(
+                model,
+                max_concurrency=overrides.get("max_concurrency", settings.ADMISSION_MAX_CONCURRENCY),
+                tokens_per_minute=overrides.get("tokens_per_minute", settings.ADMISSION_TOKENS_PER_MINUTE),
+                max_queue=settings.ADMISSION_MAX_QUEUE,
+                max_wait=settings.ADMISSION_MAX_WAIT,
+            )
+            limiters[model] = limiter
+        return limiter
+
+    async def acquire(self, model: str, tokens: int, priority: int = PRIORITY_NORMAL) -> Ticket:
+        """
+        実行枠を取得する。無効時は何もしないTicketを返す
+        """
+        if not settings.ADMISSION_ENABLED:
+            return Ticket()
+        return await self.limiter(model).acquire(tokens, priority)
+
+    def has_capacity(self, model: str) -> bool:
+        """
+        待たずに実行枠を取得できるか（ヘッジなど、空きがあるときだけ送る追加の呼び出し用）
+        """
+        if not settings.ADMISSION_ENABLED:
+            return True
+        limiter = self.limiter(model)
+        return limiter.queued == 0 and limiter.active < limiter.concurrency_limit
+
+    def on_rate_limited(self, model: str, headers: httpx.Headers):
+        if settings.ADMISSION_ENABLED:
+            self.limiter(model).on_rate_limited(retry_after_from_headers(headers))
+
+    def rejection(self, model: str, headers: httpx.Headers) -> AdmissionRejectedError:
+        """
+        SDKの再試行後も上流が429を返した場合に、クライアントへ返す例外を作る
+        """
+        retry_after = retry_after_from_headers(headers)
+        if settings.ADMISSION_ENABLED:
+            retry_after = max(retry_after or 0.0, self.limiter(model).retry_after())
+        ADMISSION_REJECTIONS.inc(model=model, reason="upstream_rate_limited")
+        return AdmissionRejectedError(model, retry_after or settings.ADMISSION_RATE_LIMIT_BACKOFF, "upstream_rate_limited")
+
+    def gauges(self) -> dict:
+        values: dict[tuple, float] = {}
+        for limiters in list(self._limiters.values()):
+            for limiter in limiters.values():
+                for state, value in (("active", limiter.active), ("queued", limiter.queued), ("limit", limiter.concurrency_limit)):
+                    values[(limiter.model, state)] = values.get((limiter.model, state), 0) + value
+        return values
+
+
+admission = AdmissionController()
+
+registry.register(
+    CallbackMetric(
+        "llm_admission_slots",
+        "Upstream slots in use (active), waiting calls (queued) and the adaptive concurrency limit",
+        "gauge",
+        admission.gauges,
+        ("model", "state"),
+    )
+)
+
+
+async def observe_upstream_response(response: httpx.Response):
+    """
+    OpenAIクライアントのhttpxイベントフック。SDK内部の再試行分も含めて上流の429を流量制御に伝える
+    """
+    if response.status_code != httpx.codes.TOO_MANY_REQUESTS:
+        return
+    try:
+        model = json.loads(response.request.content).get("model", "unknown")
+    except (ValueError, AttributeError):
+        model = "unknown"
+    admission.on_rate_limited(model, response.headers)
@@ -0,0 +1,193 @@
+"""
+JSONLの質問セットを 判定 → PubMedクエリ → 回答 の順にまとめて実行する
+入力は1行ずつ読み、同時実行数までしかタスクを持たないため、入力の件数によらずメモリ使用量は一定になる
+結果は終わった順に1行ずつ追記し、出力ファイル自体をチェックポイントとして中断後は未処理の行から再開する
+
+    python -m app.services.batch --input questions.jsonl --output results.jsonl --concurrency 8
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections.abc import AsyncIterator, Awaitable, Iterable, Iterator
+from typing import Callable, Optional, TextIO, TypeVar
+
+from app.core.config import get_settings
+
+settings = get_settings()
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# idの指定がない行に使うフィールド（requests.jsonl形式）。どれもなければ行番号を使う
+ID_FIELDS = ("id", "request_id")
+
+_END = object()
+
+
+async def map_unordered(fn: Callable[[T], Awaitable[R]], items: Iterable[T], concurrency: int) -> AsyncIterator[R]:
+    """
+    itemsの各要素にfnを最大concurrency件ずつ同時に適用し、終わった順に結果を返す
+    itemsは空きができた分だけ読み進める（先読みしない）。fnは例外を送出しないこと
+    """
+    iterator = iter(items)
+    pending: set = set()
+    try:
+        while True:
+            while len(pending) < concurrency:
+                item = next(iterator, _END)
+                if item is _END:
+                    break
+                pending.add(asyncio.ensure_future(fn(item)))
+            if not pending:
+                return
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def item_id(record: dict, line_number: int) -> str:
+    for field in ID_FIELDS:
+        if record.get(field) is not None:
+            return str(record[field])
+    return str(line_number)
+
+
+def read_items(path: str, text_field: str = "new_message", skip_ids: frozenset = frozenset()) -> Iterator[dict]:
+    """
+    入力のJSONLを1行ずつ読み、{id, new_message, message_log} にして返す（skip_idsのidは飛ばす）
+    text_fieldで質問文のフィールドを指定できる（requests.jsonlなら body）
+    """
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            record_id = item_id(record, line_number)
+            if record_id in skip_ids:
+                continue
+            yield {"id": record_id, "new_message": record.get(text_field), "message_log": record.get("message_log") or []}
+
+
+def count_lines(path: str) -> int:
+    with open(path, "rb") as f:
+        return sum(1 for line in f if line.strip())
+
+
+def load_checkpoint(path: str, retry_errors: bool = False) -> frozenset:
+    """
+    出力済みの結果のidを返す。retry_errorsなら失敗した行は未処理として扱う（再実行すると同じidの行が後ろに追記される）
+    クラッシュで最後の行が途中までしか書かれていない場合は、その行を切り詰めてから再開する
+    """
+    if not os.path.exists(path):
+        return frozenset()
+    done: set = set()
+    with open(path, "rb+") as f:
+        valid_end = 0
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            valid_end += len(line)
+            record = json.loads(line)
+            if retry_errors and record.get("error"):
+                done.discard(record["id"])
+            else:
+                done.add(record["id"])
+        f.truncate(valid_end)
+    return frozenset(done)
+
+
+class Progress:
+    """
+    処理済みの件数・失敗数・スループット・残り時間をinterval秒ごとに出力する
+    """
+
+    def __init__(self, total: Optional[int], interval: float = 5.0, stream: TextIO = sys.stderr):
+        self.total = total
+        self.interval = interval
+        self.stream = stream
+        self.done = 0
+        self.errors = 0
+        self._started = time.monotonic()
+        self._last_report = self._started
+
+    def update(self, ok: bool):
+        self.done += 1
+        self.errors += int(not ok)
+        now = time.monotonic()
+        if now - self._last_report >= self.interval or self.done == self.total:
+            self._last_report = now
+            self.report()
+
+    def summary(self) -> dict:
+        elapsed = time.monotonic() - self._started
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        remaining = None if self.total is None or rate == 0 else (self.total - self.done) / rate
+        return {"done": self.done, "total": self.total, "errors": self.errors, "rate": rate, "eta_seconds": remaining}
+
+    def report(self):
+        stats = self.summary()
+        total = "?" if stats["total"] is None else stats["total"]
+        eta = "-" if stats["eta_seconds"] is None else f"{stats['eta_seconds']:.0f}s"
+        print(f"{stats['done']}/{total} done ({stats['errors']} errors), {stats['rate']:.2f} items/s, ETA {eta}", file=self.stream, flush=True)
+
+
+async def run_batch_file(  # noqa: PLR0913
+    fn: Callable[[dict], Awaitable[dict]],
+    input_path: str,
+    output_path: str,
+    concurrency: int,
+    text_field: str = "new_message",
+    retry_errors: bool = False,
+    progress_interval: float = 5.0,
+) -> dict:
+    """
+    input_pathの未処理の行にfnを適用し、結果をoutput_pathに1行ずつ追記する（fnは失敗をerrorに入れて返すこと）
+    """
+    skip_ids = load_checkpoint(output_path, retry_errors)
+    progress = Progress(max(0, count_lines(input_path) - len(skip_ids)), interval=progress_interval)
+    with open(output_path, "a", encoding="utf-8") as out:
+        async for result in map_unordered(fn, read_items(input_path, text_field, skip_ids), concurrency):
+            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            # プロセスが落ちても書き終えた行は残るように1行ごとにフラッシュする
+            out.flush()
+            progress.update(ok=not result.get("error"))
+    return {**progress.summary(), "skipped": len(skip_ids)}
+
+
+async def _run_cli(args: argparse.Namespace) -> dict:
+    from app.api.endpoints.batch import answer_item
+    from app.services.llm_service import close_llm_clients
+
+    async def answer(item: dict) -> dict:
+        return await answer_item(item, assistant=not args.no_assistant)
+
+    try:
+        return await run_batch_file(answer, args.input, args.output, args.concurrency, args.text_field, args.retry_errors, args.progress_interval)
+    finally:
+        await close_llm_clients()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSONLの質問セットを 判定 → PubMedクエリ → 回答 の順にまとめて実行する")
+    parser.add_argument("--input", required=True, help="1行に1件の質問（new_message, message_log, id）を持つJSONL")
+    parser.add_argument("--output", required=True, help="結果のJSONL（既にあれば出力済みのidを飛ばして再開する）")
+    parser.add_argument("--concurrency", type=int, default=settings.BATCH_MAX_CONCURRENCY)
+    parser.add_argument("--text-field", default="new_message", help="質問文のフィールド（requests.jsonlなら body）")
+    parser.add_argument("--no-assistant", action="store_true", help="判定とPubMedクエリのみ実行し、回答は生成しない")
+    parser.add_argument("--retry-errors", action="store_true", help="失敗した行も再実行する")
+    parser.add_argument("--progress-interval", type=float, default=5.0, help="進捗を出力する間隔（秒）")
+    args = parser.parse_args()
+
+    summary = asyncio.run(_run_cli(args))
+    print(json.dumps(summary, ensure_ascii=False), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
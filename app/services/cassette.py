@@ -0,0 +1,241 @@
+"""
+LLM呼び出しの記録・再生 (LLM_MODE=record / replay)
+Chat Completions の create 呼び出しをリクエストのハッシュで記録し、再生時はネットワークを使わずに応答する
+ストリーミング応答はチャンクごとの到着時刻（リクエスト開始からの経過秒）も記録する
+"""
+
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from collections.abc import AsyncIterator, Iterator
+from typing import Any, Optional
+
+# ハッシュに含めないパラメーター（通信の設定で応答内容には影響しない）
+_IGNORED_PARAMS = {"timeout", "extra_headers", "extra_query", "extra_body"}
+
+
+class CassetteMissError(LookupError):
+    """
+    再生モードで記録されていないリクエストが来た
+    """
+
+
+def request_hash(params: dict) -> str:
+    canonical = json.dumps(
+        {key: value for key, value in params.items() if key not in _IGNORED_PARAMS},
+        ensure_ascii=False,
+        sort_keys=True,
+        separators=(",", ":"),
+        default=str,
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _compress(value: Any) -> bytes:
+    return zlib.compress(json.dumps(value, ensure_ascii=False, default=str).encode("utf-8"))
+
+
+class CassetteStore:
+    """
+    SQLite上の記録（応答はzlib圧縮したJSON）
+    一度読み込んだ記録はメモリに保持し、再生時のオーバーヘッドを抑える
+    """
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cassettes (key TEXT PRIMARY KEY, request BLOB NOT NULL, response BLOB NOT NULL, recorded_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+        self._cache: dict[str, dict] = {}
+
+    def get(self, key: str) -> Optional[dict]:
+        entry = self._cache.get(key)
+        if entry is not None:
+            return entry
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM cassettes WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        entry = json.loads(zlib.decompress(row[0]))
+        self._cache[key] = entry
+        return entry
+
+    def put(self, key: str, request: dict, response: dict):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cassettes (key, request, response, recorded_at) VALUES (?, ?, ?, ?)",
+                (key, _compress(request), _compress(response), time.time()),
+            )
+            self._conn.commit()
+        self._cache[key] = response
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cassettes").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def _chunk_dict(completion_id: str, model: str, delta: dict, finish_reason: Optional[str]) -> dict:
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": 0,
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "logprobs": None, "finish_reason": finish_reason}],
+    }
+
+
+class _StreamRecorder:
+    """
+    上流のストリームを中継しつつ、各チャンクの内容と到着時刻を記録する
+    最後まで読み切ったストリームのみ保存する（途中で閉じられた場合は保存しない）
+    """
+
+    def __init__(self, upstream: Any, store: CassetteStore, key: str, params: dict, started_at: float):  # noqa: PLR0913
+        self._upstream = upstream
+        self._store = store
+        self._key = key
+        self._params = params
+        self._started_at = started_at
+
+    async def __aiter__(self) -> AsyncIterator[Any]:
+        events = []
+        model = self._params.get("model", "")
+        async for chunk in self._upstream:
+            data = chunk if isinstance(chunk, dict) else chunk.model_dump()
+            model = data.get("model") or model
+            for choice in data.get("choices", []):
+                delta = choice.get("delta") or {}
+                events.append([round(time.monotonic() - self._started_at, 4), delta.get("content"), choice.get("finish_reason")])
+            yield chunk
+        await asyncio.to_thread(self._store.put, self._key, self._params, {"stream": True, "model": model, "events": events})
+
+    async def close(self):
+        await self._upstream.close()
+
+
+class CassetteCompletions:
+    """
+    chat.completions の代わりにChatOpenAIへ渡すラッパー
+    record: 上流を呼び出して記録する / replay: 記録から応答し、上流は呼ばない
+    replay_speedは記録した待ち時間に掛ける係数（0で待たずに返す）
+    """
+
+    def __init__(self, completions: Any, store: CassetteStore, mode: str, replay_speed: float = 0.0):
+        self._completions = completions
+        self._store = store
+        self.mode = mode
+        self.replay_speed = replay_speed
+
+    async def create(self, **params: Any) -> Any:
+        key = request_hash(params)
+        if self.mode == "replay":
+            return await self._replay(key, params)
+
+        started_at = time.monotonic()
+        response = await self._completions.create(**params)
+        if params.get("stream"):
+            return _StreamRecorder(response, self._store, key, params, started_at)
+        data = response if isinstance(response, dict) else response.model_dump()
+        entry = {"stream": False, "latency": round(time.monotonic() - started_at, 4), "response": data}
+        await asyncio.to_thread(self._store.put, key, params, entry)
+        return response
+
+    def _lookup(self, key: str, params: dict) -> dict:
+        entry = self._store.get(key)
+        if entry is None:
+            raise CassetteMissError(f"No recorded LLM response for request {key[:12]} (model={params.get('model')})")
+        return entry
+
+    async def _replay(self, key: str, params: dict) -> Any:
+        entry = self._lookup(key, params)
+        if not params.get("stream"):
+            if self.replay_speed > 0:
+                await asyncio.sleep(entry["latency"] * self.replay_speed)
+            return entry["response"] if not entry["stream"] else _collect_stream(entry)
+        return self._replay_stream(key, entry)
+
+    async def _replay_stream(self, key: str, entry: dict) -> AsyncIterator[dict]:
+        started_at = time.monotonic()
+        for chunk in _stream_chunks(key, entry):
+            offset = chunk.pop("_offset")
+            if self.replay_speed > 0:
+                delay = started_at + offset * self.replay_speed - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            yield chunk
+
+
+class SyncCassetteCompletions(CassetteCompletions):
+    """
+    同期クライアント用（記録は行わず、replayのみ記録から応答する）
+    """
+
+    def create(self, **params: Any) -> Any:  # type: ignore[override]
+        if self.mode != "replay":
+            return self._completions.create(**params)
+        key = request_hash(params)
+        entry = self._lookup(key, params)
+        if not params.get("stream"):
+            return entry["response"] if not entry["stream"] else _collect_stream(entry)
+        return self._iter_stream(key, entry)
+
+    @staticmethod
+    def _iter_stream(key: str, entry: dict) -> Iterator[dict]:
+        for chunk in _stream_chunks(key, entry):
+            chunk.pop("_offset")
+            yield chunk
+
+
+def _stream_chunks(key: str, entry: dict) -> Iterator[dict]:
+    if not entry["stream"]:
+        # 非ストリーミングで記録された応答は1チャンクとして返す
+        response = entry["response"]
+        choice = response["choices"][0]
+        chunk = _chunk_dict(f"replay-{key[:12]}", response.get("model", ""), {"role": "assistant", "content": choice["message"]["content"]}, None)
+        yield {**chunk, "_offset": entry["latency"]}
+        yield {**_chunk_dict(f"replay-{key[:12]}", response.get("model", ""), {}, choice.get("finish_reason") or "stop"), "_offset": entry["latency"]}
+        return
+    for offset, content, finish_reason in entry["events"]:
+        delta = {} if content is None else {"content": content}
+        yield {**_chunk_dict(f"replay-{key[:12]}", entry["model"], delta, finish_reason), "_offset": offset}
+
+
+def _collect_stream(entry: dict) -> dict:
+    # ストリーミングで記録された応答を非ストリーミングの形にまとめる
+    content = "".join(content for _, content, _ in entry["events"] if content)
+    finish_reason = next((reason for _, _, reason in reversed(entry["events"]) if reason), "stop")
+    return {
+        "id": "replay",
+        "object": "chat.completion",
+        "created": 0,
+        "model": entry["model"],
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "logprobs": None, "finish_reason": finish_reason}],
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+    }
+
+
+_cassette_store: dict[str, CassetteStore] = {}
+
+
+def get_cassette_store(path: str) -> CassetteStore:
+    store = _cassette_store.get(path)
+    if store is None:
+        store = CassetteStore(path)
+        _cassette_store[path] = store
+    return store
+
+
+def close_cassette_stores():
+    for store in _cassette_store.values():
+        store.close()
+    _cassette_store.clear()
@@ -0,0 +1,194 @@
+"""
+取り込み（add_document.py）で使う文書の埋め込み
+- (モデル, チャンクの本文) のハッシュをキーにしたディスク上のキャッシュ。同じチャンクは二度と埋め込まない
+- キャッシュにないチャンクはトークン数の上限でまとめたバッチにし、流量の予算内で同時に送る
+"""
+
+import hashlib
+import sqlite3
+import threading
+import time
+from array import array
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+from langchain_core.embeddings import Embeddings
+
+from app.services.tokens import TokenCounter
+
+
+def embedding_key(model: str, text: str) -> str:
+    return hashlib.sha256(f"{model}\0{text}".encode()).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    SQLite上の埋め込みのキャッシュ（ベクトルはfloat32のバイト列で保存する）
+    """
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+        self._conn.commit()
+
+    def get_many(self, keys: list[str]) -> dict[str, list[float]]:
+        found: dict[str, list[float]] = {}
+        # SQLiteの変数の上限を超えないよう分けて引く
+        for start in range(0, len(keys), 500):
+            part = keys[start : start + 500]
+            with self._lock:
+                rows = self._conn.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(part))})", part).fetchall()
+            for key, blob in rows:
+                found[key] = array("f", blob).tolist()
+        return found
+
+    def put_many(self, items: Iterable[tuple[str, list[float]]]):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)", ((key, array("f", vector).tobytes()) for key, vector in items)
+            )
+            self._conn.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def token_batches(counts: list[int], max_tokens: int, max_items: int) -> list[list[int]]:
+    """
+    トークン数の合計がmax_tokens、件数がmax_itemsを超えないように入力の添字をまとめる（1件でmax_tokensを超えるものは単独のバッチ）
+    """
+    batches: list[list[int]] = []
+    current: list[int] = []
+    current_tokens = 0
+    for index, count in enumerate(counts):
+        if current and (current_tokens + count > max_tokens or len(current) >= max_items):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(index)
+        current_tokens += count
+    if current:
+        batches.append(current)
+    return batches
+
+
+class RateBudget:
+    """
+    1分あたりのトークン数（トークンバケット、0で無制限）と同時実行数の上限
+    取り込みはスレッドで動くため同期APIで待つ
+    """
+
+    def __init__(self, tokens_per_minute: int, max_concurrency: int, clock: Callable[[], float] = time.monotonic):
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrency = max_concurrency
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._clock = clock
+        self._available = float(tokens_per_minute)
+        self._updated = clock()
+
+    def _wait_time(self, tokens: int) -> float:
+        # バケットの容量より大きい要求は満杯になるまで待って通す
+        tokens = min(tokens, self.tokens_per_minute)
+        with self._lock:
+            now = self._clock()
+            self._available = min(self.tokens_per_minute, self._available + (now - self._updated) * self.tokens_per_minute / 60)
+            self._updated = now
+            if self._available >= tokens:
+                self._available -= tokens
+                return 0.0
+            return (tokens - self._available) * 60 / self.tokens_per_minute
+
+    def acquire(self, tokens: int):
+        self._slots.acquire()
+        if self.tokens_per_minute <= 0:
+            return
+        try:
+            while True:
+                wait = self._wait_time(tokens)
+                if wait <= 0:
+                    return
+                time.sleep(wait)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self):
+        self._slots.release()
+
+
+class BatchedEmbeddings(Embeddings):
+    """
+    キャッシュ付きの文書の埋め込み。キャッシュにないチャンクだけをバッチにまとめ、同時にmax_concurrencyまで送る
+    同じ本文のチャンクは1回だけ埋め込む。クエリの埋め込みはキャッシュせずそのまま委譲する
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        embeddings: Embeddings,
+        model: str,
+        cache: EmbeddingCache,
+        max_batch_tokens: int = 50000,
+        max_batch_items: int = 1000,
+        budget: Optional[RateBudget] = None,
+    ):
+        self.embeddings = embeddings
+        self.model = model
+        self.cache = cache
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_items = max_batch_items
+        self.budget = budget or RateBudget(0, 4)
+        self.token_counter = TokenCounter(model)
+        self.hits = 0
+        self.misses = 0
+        self.requests = 0
+        self.tokens = 0
+        self._stats_lock = threading.Lock()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys = [embedding_key(self.model, text) for text in texts]
+        vectors = self.cache.get_many(list(dict.fromkeys(keys)))
+        missing = {key: text for key, text in zip(keys, texts) if key not in vectors}
+        with self._stats_lock:
+            self.hits += sum(1 for key in keys if key in vectors)
+            self.misses += len(missing)
+        if missing:
+            vectors.update(self._embed_missing(list(missing.items())))
+        return [vectors[key] for key in keys]
+
+    def _embed_missing(self, items: list[tuple[str, str]]) -> dict[str, list[float]]:
+        counts = [self.token_counter.count_text(text) for _, text in items]
+        batches = token_batches(counts, self.max_batch_tokens, self.max_batch_items)
+
+        def embed(batch: list[int]) -> list[tuple[str, list[float]]]:
+            tokens = sum(counts[index] for index in batch)
+            self.budget.acquire(tokens)
+            try:
+                result = self.embeddings.embed_documents([items[index][1] for index in batch])
+            finally:
+                self.budget.release()
+            with self._stats_lock:
+                self.requests += 1
+                self.tokens += tokens
+            embedded = [(items[index][0], vector) for index, vector in zip(batch, result)]
+            # 途中で失敗しても済んだバッチは次回に再利用できるよう、バッチごとに保存する
+            self.cache.put_many(embedded)
+            return embedded
+
+        if len(batches) == 1:
+            return dict(embed(batches[0]))
+        with ThreadPoolExecutor(max_workers=min(len(batches), self.budget.max_concurrency)) as executor:
+            return {key: vector for embedded in executor.map(embed, batches) for key, vector in embedded}
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embeddings.embed_query(text)
+
+    def stats(self) -> dict:
+        return {"cache_hits": self.hits, "cache_misses": self.misses, "requests": self.requests, "tokens": self.tokens}
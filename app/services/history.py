@@ -0,0 +1,156 @@
+"""
+会話履歴の圧縮
+トークン予算を超えた古いターンをローリング要約に置き換え、新しいターンはそのまま残す
+"""
+
+import hashlib
+import json
+import logging
+from collections.abc import Awaitable
+from typing import Callable, Optional
+
+from app.core.config import get_settings
+from app.services.admission import PRIORITY_NORMAL
+from app.services.llm_service import ainvoke_chat, compile_chat_prompt
+from app.services.response_cache import MemoryBackend
+from app.services.tokens import token_counter
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+# 要約を載せるメッセージのrole（クライアントから送られたsystemロールとは区別する）
+SUMMARY_ROLE = "summary"
+
+HISTORY_SUMMARY_PROMPT = """
+## 指示
+- あなたは医療相談の会話を記録する担当者です。
+- 「これまでの要約」と「追加の会話」をもとに、会話全体の要約を作成してください。
+
+## 要約のルール
+- 患者の背景（年齢・性別・既往歴・服薬など）、質問の主題、回答の要点、言及された論文のPMIDは必ず残す
+- 回答の根拠となった数値や薬剤名は省略しない
+- 箇条書きで簡潔にまとめ、要約以外の文章は書かない
+"""
+
+HISTORY_SUMMARY_CHAT_PROMPT = compile_chat_prompt(HISTORY_SUMMARY_PROMPT)
+
+
+def _chain_hash(previous: str, message: dict) -> str:
+    canonical = json.dumps({"role": message["role"], "content": message["content"]}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256((previous + canonical).encode("utf-8")).hexdigest()
+
+
+class HistoryCompactor:
+    """
+    トークン予算に収まるように会話履歴を圧縮する
+
+    - 最新のメッセージから順に、予算に収まる範囲のターンはそのまま残す
+    - 収まらない古いターンは要約1件に置き換える
+    - 要約は履歴の先頭部分（プレフィックス）のハッシュでキャッシュし、
+      以前の要約があればそれに新しく溢れたターンだけを追加して要約し直す（ローリング要約）
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        count_message: Callable[[dict], int],
+        summarize: Optional[Callable[[Optional[str], list], Awaitable[str]]],
+        summary_reserve_tokens: int,
+        cache_size: int,
+        cache_ttl: float,
+    ):
+        self.count_message = count_message
+        self.summarize = summarize
+        self.summary_reserve_tokens = summary_reserve_tokens
+        self.cache_ttl = cache_ttl
+        self._summaries = MemoryBackend(max_entries=cache_size)
+
+    def split(self, messages: list, budget: int) -> int:
+        """
+        そのまま残す最新ターンの開始位置を返す（最後のメッセージは必ず残す）
+        """
+        total = sum(self.count_message(msg) for msg in messages)
+        if total <= budget:
+            return 0
+
+        available = budget - self.summary_reserve_tokens
+        used = 0
+        start = len(messages)
+        for index in range(len(messages) - 1, -1, -1):
+            tokens = self.count_message(messages[index])
+            if used + tokens > available and start < len(messages):
+                break
+            used += tokens
+            start = index
+        return start
+
+    async def compact(self, messages: list, budget: int) -> list:
+        start = self.split(messages, budget)
+        if start == 0:
+            return messages
+
+        older, recent = messages[:start], messages[start:]
+        if self.summarize is None:
+            return recent
+
+        try:
+            summary = await self._rolling_summary(older)
+        except Exception as e:
+            # 要約に失敗した場合は古いターンを落として続行する
+            logger.warning("History summarization failed, dropping %d older messages: %s", len(older), e)
+            return recent
+        return [{"role": SUMMARY_ROLE, "content": summary}, *recent]
+
+    async def _rolling_summary(self, older: list) -> str:
+        assert self.summarize is not None
+        prefix_hashes = []
+        digest = ""
+        for msg in older:
+            digest = _chain_hash(digest, msg)
+            prefix_hashes.append(digest)
+
+        # 最も長くキャッシュ済みのプレフィックスの要約から続きを要約する
+        previous_summary: Optional[str] = None
+        resume_from = 0
+        for index in range(len(prefix_hashes) - 1, -1, -1):
+            cached = await self._summaries.get(prefix_hashes[index])
+            if cached is not None:
+                previous_summary, resume_from = cached, index + 1
+                break
+
+        if resume_from == len(older) and previous_summary is not None:
+            return previous_summary
+
+        summary = await self.summarize(previous_summary, older[resume_from:])
+        await self._summaries.set(prefix_hashes[-1], summary, self.cache_ttl)
+        return summary
+
+
+async def summarize_with_llm(previous_summary: Optional[str], messages: list) -> str:
+    """
+    これまでの要約と追加の会話から新しい要約をLLMで作る
+    """
+    transcript = "\n".join(f"{msg['role']}: {msg['content']}" for msg in messages)
+    content = f"## これまでの要約\n{previous_summary or 'なし'}\n\n## 追加の会話\n{transcript}"
+    return await ainvoke_chat(
+        HISTORY_SUMMARY_CHAT_PROMPT,
+        [{"role": "user", "content": content}],
+        model_name=settings.HISTORY_SUMMARY_MODEL,
+        temperature=0.0,
+        priority=PRIORITY_NORMAL,
+    )
+
+
+history_compactor = HistoryCompactor(
+    count_message=token_counter.count_message,
+    summarize=summarize_with_llm if settings.HISTORY_SUMMARY_ENABLED else None,
+    summary_reserve_tokens=settings.HISTORY_SUMMARY_RESERVE_TOKENS,
+    cache_size=settings.HISTORY_SUMMARY_CACHE_SIZE,
+    cache_ttl=settings.HISTORY_SUMMARY_CACHE_TTL,
+)
+
+
+async def compact_history(messages: list, budget: int) -> list:
+    """
+    エンドポイントごとのトークン予算に合わせて履歴を圧縮する
+    """
+    return await history_compactor.compact(messages, budget)
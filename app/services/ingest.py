@@ -0,0 +1,237 @@
+"""
+PDFの取り込み（add_document.py）のパイプライン
+解析 → 分割 → 埋め込み・登録 の各段をスレッドで並行に動かし、段の間は上限付きのキューでつなぐ
+後段が詰まると前段が待つ（背圧）ため、ファイル数によらずメモリ上にあるのはキューの上限分だけになる
+PDFの解析はCPUを使うためプロセスプールで並列に実行する
+"""
+
+import glob
+import hashlib
+import logging
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Executor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+def expand_paths(patterns: Iterable[str], extensions: tuple[str, ...] = (".pdf",)) -> Iterator[str]:
+    """
+    ファイル・ディレクトリ（配下を再帰的に探す）・globパターンを、対象の拡張子のファイルのパスに展開する（重複は除く）
+    パスはos.path.realpathで正規化する（チャンクのIDとマニフェストはパスで決まるため、
+    相対パスやシンボリックリンクなど書き方が違っても同じファイルは同じパスにする）
+    """
+    seen: set = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            candidates: Iterable[str] = (
+                os.path.join(root, name) for root, _, names in sorted(os.walk(pattern)) for name in sorted(names) if name.lower().endswith(extensions)
+            )
+        elif os.path.exists(pattern):
+            candidates = [pattern]
+        else:
+            candidates = sorted(glob.glob(pattern, recursive=True))
+        for candidate in candidates:
+            path = os.path.realpath(candidate)
+            if os.path.isfile(path) and path not in seen:
+                seen.add(path)
+                yield path
+
+
+def chunk_ids(source: str, texts: list[str]) -> list[str]:
+    """
+    チャンクのID。ソースと本文（同じ本文が複数あれば何番目か）だけから決まるため、
+    再実行しても同じIDになり登録は冪等になる。他のチャンクが変わっても変わらない
+    """
+    occurrences: Counter = Counter()
+    ids = []
+    for text in texts:
+        ids.append(hashlib.sha256(f"{source}\0{occurrences[text]}\0{text}".encode()).hexdigest()[:32])
+        occurrences[text] += 1
+    return ids
+
+
+@dataclass
+class StageStats:
+    """
+    段ごとの処理件数と、処理にかかった時間の合計（busy、ワーカーの合計）
+    """
+
+    name: str
+    workers: int
+    items_in: int = 0
+    items_out: int = 0
+    errors: int = 0
+    busy: float = 0.0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def record(self, items_out: int, elapsed: float):
+        with self._lock:
+            self.items_in += 1
+            self.items_out += items_out
+            self.busy += elapsed
+
+    def record_error(self, elapsed: float):
+        with self._lock:
+            self.items_in += 1
+            self.errors += 1
+            self.busy += elapsed
+
+    def as_dict(self, wall: float) -> dict:
+        return {
+            "items_in": self.items_in,
+            "items_out": self.items_out,
+            "errors": self.errors,
+            "busy_seconds": round(self.busy, 3),
+            # ワーカーが実際に処理していた時間あたりと、全体の経過時間あたりの件数
+            "items_per_busy_second": round(self.items_in / self.busy * self.workers, 2) if self.busy else None,
+            "items_per_second": round(self.items_in / wall, 2) if wall else None,
+            # 1に近いほどこの段が律速している
+            "utilization": round(self.busy / (wall * self.workers), 3) if wall else None,
+        }
+
+
+@dataclass
+class Stage:
+    """
+    fnは1件（batch_size指定時はbatch_size件のリスト）を受け取り、次の段に渡す要素を返す
+    on_errorを指定すると、fnが送出した例外はon_error(要素, 例外)に渡してその要素だけを捨て、処理を続ける
+    """
+
+    name: str
+    fn: Callable[[Any], Iterable[Any]]
+    workers: int = 1
+    batch_size: Optional[int] = None
+    on_error: Optional[Callable[[Any, Exception], None]] = None
+
+
+class Pipeline:
+    """
+    上限付きのキューでつないだ段をスレッドで並行に実行する
+    いずれかの段で例外が起きた場合は残りの処理を止め、run()から送出する（on_errorを指定した段の例外を除く）
+    """
+
+    def __init__(self, stages: list[Stage], queue_size: int = 64):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.stats = {stage.name: StageStats(stage.name, stage.workers) for stage in stages}
+        self._stopped = threading.Event()
+        self._error: Optional[BaseException] = None
+
+    def _put(self, q: queue.Queue, item: Any):
+        # 後段の停止時に待ち続けないよう、定期的に停止を確認しながら入れる
+        while not self._stopped.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _get(self, q: queue.Queue) -> Any:
+        while not self._stopped.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _run_stage(self, stage: Stage, inbox: queue.Queue, outbox: Optional[queue.Queue]):
+        stats = self.stats[stage.name]
+
+        def process(item: Any):
+            # 後段の空きを待つ時間は含めず、処理そのものの時間を記録する
+            started = time.perf_counter()
+            try:
+                outputs = list(stage.fn(item))
+            except Exception as e:
+                if stage.on_error is None:
+                    raise
+                stage.on_error(item, e)
+                stats.record_error(time.perf_counter() - started)
+                return
+            stats.record(len(outputs), time.perf_counter() - started)
+            if outbox is not None:
+                for output in outputs:
+                    self._put(outbox, output)
+
+        batch: list = []
+        try:
+            while True:
+                item = self._get(inbox)
+                if item is _DONE:
+                    # 他のワーカーにも終了を伝える
+                    self._put(inbox, _DONE)
+                    break
+                if stage.batch_size is None:
+                    process(item)
+                    continue
+                batch.append(item)
+                if len(batch) >= stage.batch_size:
+                    process(batch)
+                    batch = []
+            if batch and not self._stopped.is_set():
+                process(batch)
+        except BaseException as e:
+            if self._error is None:
+                self._error = e
+            self._stopped.set()
+
+    def run(self, source: Iterable[Any]) -> dict:
+        """
+        sourceの各要素を最初の段から順に流し、段ごとの統計を返す
+        """
+        started = time.perf_counter()
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        groups = []
+        for index, stage in enumerate(self.stages):
+            outbox = queues[index + 1] if index + 1 < len(queues) else None
+            threads = [
+                threading.Thread(target=self._run_stage, args=(stage, queues[index], outbox), name=f"ingest-{stage.name}-{n}", daemon=True)
+                for n in range(stage.workers)
+            ]
+            for thread in threads:
+                thread.start()
+            groups.append(threads)
+
+        try:
+            for item in source:
+                if self._stopped.is_set():
+                    break
+                self._put(queues[0], item)
+            self._put(queues[0], _DONE)
+            # 前の段のワーカーがすべて終わってから次の段に終了を伝える
+            for index, threads in enumerate(groups):
+                for thread in threads:
+                    thread.join()
+                if index + 1 < len(queues):
+                    self._put(queues[index + 1], _DONE)
+        except BaseException:
+            self._stopped.set()
+            raise
+        if self._error is not None:
+            raise self._error
+
+        wall = time.perf_counter() - started
+        return {"wall_seconds": round(wall, 3), "stages": {name: stats.as_dict(wall) for name, stats in self.stats.items()}}
+
+
+def parallel_map_stage(
+    name: str, fn: Callable[[Any], Any], executor: Executor, workers: int, on_error: Optional[Callable[[Any, Exception], None]] = None
+) -> Stage:
+    """
+    fn(item)をexecutor（プロセスプールなど）で実行する段。同時に投入するのはworkers件まで
+    fnは次の段に渡す要素のリストを返すこと
+    """
+
+    def run(item: Any) -> Iterable[Any]:
+        return executor.submit(fn, item).result()
+
+    return Stage(name, run, workers=workers, on_error=on_error)
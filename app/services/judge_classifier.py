@@ -0,0 +1,366 @@
+"""
+DB検索要否の判定（[DB_EVIDENCE:NEED] / [DB_EVIDENCE:NOT]）を先に行うローカルの分類器
+文字n-gramのTF-IDFとロジスティック回帰（純Python、1件あたり数十マイクロ秒）で、LLMの判定結果の記録から学習する
+確信度がしきい値以上の場合だけLLMを呼ばずに返し、それ以外はLLMの判定に任せる
+
+学習・評価:
+    python -m app.services.judge_classifier train --data judge_decisions.jsonl --output judge_classifier.json
+    python -m app.services.judge_classifier evaluate --model judge_classifier.json --data held_out.jsonl
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import random
+import sqlite3
+import threading
+import time
+import unicodedata
+import zlib
+from collections import Counter as TermCounter
+from collections.abc import Iterable, Iterator
+from typing import Optional
+
+from app.core.config import get_settings
+from app.services.metrics import Counter, registry
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+NEED_TAG = "[DB_EVIDENCE:NEED]"
+NOT_TAG = "[DB_EVIDENCE:NOT]"
+MODEL_VERSION = 1
+
+JUDGE_CLASSIFIER_DECISIONS = registry.register(
+    Counter(
+        "judge_classifier_decisions_total", "Judge requests answered by the local classifier (need / not) or sent to the LLM (fallback)", ("outcome",)
+    )
+)
+
+
+def label_of(result: str) -> Optional[int]:
+    """
+    LLMの判定結果を学習用のラベルにする（NEED=1, NOT=0, どちらでもなければNone）
+    """
+    if NOT_TAG in result:
+        return 0
+    if NEED_TAG in result:
+        return 1
+    return None
+
+
+def char_ngrams(text: str, ngram_min: int = 1, ngram_max: int = 3) -> Iterator[str]:
+    # 全角・半角と大文字・小文字の違いをならし、空白の連続を1つにまとめる
+    normalized = " " + " ".join(unicodedata.normalize("NFKC", text).lower().split()) + " "
+    for n in range(ngram_min, ngram_max + 1):
+        for i in range(len(normalized) - n + 1):
+            yield normalized[i : i + n]
+
+
+def _sigmoid(z: float) -> float:
+    if z >= 0:
+        return 1.0 / (1.0 + math.exp(-z))
+    e = math.exp(z)
+    return e / (1.0 + e)
+
+
+class JudgeClassifier:
+    """
+    TF-IDF（L2正規化）のベクトルに対するロジスティック回帰。predict_probaはNEEDの確率を返す
+    """
+
+    def __init__(self, idf: dict[str, float], weights: dict[str, float], bias: float, ngram_range: tuple[int, int] = (1, 3)):
+        self.idf = idf
+        self.weights = weights
+        self.bias = bias
+        self.ngram_range = ngram_range
+
+    def vectorize(self, text: str) -> dict[str, float]:
+        counts = TermCounter(gram for gram in char_ngrams(text, *self.ngram_range) if gram in self.idf)
+        vector = {gram: count * self.idf[gram] for gram, count in counts.items()}
+        norm = math.sqrt(sum(value * value for value in vector.values()))
+        return {gram: value / norm for gram, value in vector.items()} if norm else {}
+
+    def _score(self, vector: dict[str, float]) -> float:
+        return self.bias + sum(self.weights.get(gram, 0.0) * value for gram, value in vector.items())
+
+    def predict_proba(self, text: str) -> float:
+        return _sigmoid(self._score(self.vectorize(text)))
+
+    def decide(self, text: str, need_threshold: float, not_threshold: float) -> Optional[str]:
+        """
+        NEEDの確率がneed_threshold以上ならNEED、NOTの確率がnot_threshold以上ならNOT、どちらでもなければNone（LLMに任せる）
+        """
+        probability = self.predict_proba(text)
+        if probability >= need_threshold:
+            return NEED_TAG
+        if 1.0 - probability >= not_threshold:
+            return NOT_TAG
+        return None
+
+    def to_dict(self) -> dict:
+        return {
+            "version": MODEL_VERSION,
+            "ngram_range": list(self.ngram_range),
+            "bias": self.bias,
+            # 重みが0の特徴量も語彙（idf）としては必要なため両方を保存する
+            "features": {gram: [self.idf[gram], self.weights.get(gram, 0.0)] for gram in self.idf},
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "JudgeClassifier":
+        if data.get("version") != MODEL_VERSION:
+            raise ValueError(f"Unsupported judge classifier version: {data.get('version')}")
+        features = data["features"]
+        return cls(
+            idf={gram: idf for gram, (idf, _) in features.items()},
+            weights={gram: weight for gram, (_, weight) in features.items() if weight},
+            bias=data["bias"],
+            ngram_range=tuple(data["ngram_range"]),
+        )
+
+    def save(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, separators=(",", ":"))
+
+    @classmethod
+    def load(cls, path: str) -> "JudgeClassifier":
+        with open(path, encoding="utf-8") as f:
+            return cls.from_dict(json.load(f))
+
+
+def train(  # noqa: PLR0913
+    texts: list[str],
+    labels: list[int],
+    ngram_range: tuple[int, int] = (1, 3),
+    min_df: int = 2,
+    epochs: int = 20,
+    learning_rate: float = 0.5,
+    l2: float = 1e-5,
+    seed: int = 0,
+) -> JudgeClassifier:
+    """
+    確率的勾配降下法でロジスティック回帰を学習する
+    NEEDが大半を占めるため、クラスごとの件数の逆数で損失に重みを付ける
+    """
+    if not texts or len(set(labels)) < 2:  # noqa: PLR2004
+        raise ValueError("Training data must contain both NEED and NOT examples")
+    documents = [TermCounter(char_ngrams(text, *ngram_range)) for text in texts]
+    document_frequency = TermCounter(gram for document in documents for gram in document)
+    n = len(documents)
+    # sklearnのsmooth_idfと同じ式
+    idf = {gram: math.log((1 + n) / (1 + df)) + 1.0 for gram, df in document_frequency.items() if df >= min_df}
+    classifier = JudgeClassifier(idf, {}, 0.0, ngram_range)
+    vectors = [classifier.vectorize(text) for text in texts]
+
+    positives = sum(labels)
+    class_weight = {1: n / (2 * positives), 0: n / (2 * (n - positives))}
+    weights: dict[str, float] = {}
+    bias = 0.0
+    rng = random.Random(seed)
+    order = list(range(n))
+    for epoch in range(epochs):
+        rng.shuffle(order)
+        rate = learning_rate / (1 + epoch)
+        for i in order:
+            vector = vectors[i]
+            z = bias + sum(weights.get(gram, 0.0) * value for gram, value in vector.items())
+            gradient = (_sigmoid(z) - labels[i]) * class_weight[labels[i]]
+            for gram, value in vector.items():
+                weight = weights.get(gram, 0.0)
+                weights[gram] = weight - rate * (gradient * value + l2 * weight)
+            bias -= rate * gradient
+    classifier.weights = weights
+    classifier.bias = bias
+    return classifier
+
+
+def evaluate(classifier: JudgeClassifier, texts: list[str], labels: list[int], need_threshold: float, not_threshold: float) -> dict:
+    """
+    LLMの判定（labels）との一致率
+    coverage: 分類器が答えた割合 / agreement: 分類器が答えたうちLLMと一致した割合
+    false_not: LLMはNEEDだが分類器がNOTと答えた件数（エビデンスを付けずに回答してしまうため最も避けたい誤り）
+    """
+    started = time.perf_counter()
+    probabilities = [classifier.predict_proba(text) for text in texts]
+    elapsed = time.perf_counter() - started
+
+    answered = agreed = false_not = false_need = argmax_agreed = 0
+    for probability, label in zip(probabilities, labels):
+        argmax_agreed += int((probability >= 0.5) == bool(label))  # noqa: PLR2004
+        if probability >= need_threshold:
+            prediction = 1
+        elif 1.0 - probability >= not_threshold:
+            prediction = 0
+        else:
+            continue
+        answered += 1
+        agreed += int(prediction == label)
+        false_not += int(prediction == 0 and label == 1)
+        false_need += int(prediction == 1 and label == 0)
+
+    n = len(texts)
+    return {
+        "examples": n,
+        "need_ratio": sum(labels) / n if n else None,
+        "need_threshold": need_threshold,
+        "not_threshold": not_threshold,
+        "coverage": answered / n if n else None,
+        "agreement": agreed / answered if answered else None,
+        "false_not": false_not,
+        "false_need": false_need,
+        # しきい値を使わず、すべてを分類器で答えた場合の一致率
+        "argmax_agreement": argmax_agreed / n if n else None,
+        "mean_latency_us": elapsed / n * 1e6 if n else None,
+    }
+
+
+# 判定結果の記録（学習データ）
+_log_lock = threading.Lock()
+
+
+def log_judge_decision(text: str, result: str):
+    """
+    LLMの判定結果をJUDGE_DECISION_LOG_PATHにJSONLで追記する（未設定なら何もしない）
+    """
+    if not settings.JUDGE_DECISION_LOG_PATH or label_of(result) is None:
+        return
+    line = json.dumps({"text": text, "result": result.strip(), "ts": time.time()}, ensure_ascii=False)
+    with _log_lock, open(settings.JUDGE_DECISION_LOG_PATH, "a", encoding="utf-8") as f:
+        f.write(line + "\n")
+
+
+async def alog_judge_decision(text: str, result: str):
+    """
+    log_judge_decisionと同じだが、ファイルへの書き込みは別スレッドで行いイベントループを止めない
+    """
+    if settings.JUDGE_DECISION_LOG_PATH:
+        await asyncio.to_thread(log_judge_decision, text, result)
+
+
+def read_decisions(path: str) -> Iterator[tuple[str, int]]:
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            label = label_of(record["result"]) if "result" in record else record.get("label")
+            if label is not None:
+                yield record["text"], int(label)
+
+
+def read_cassette_decisions(path: str, marker: str = NEED_TAG) -> Iterator[tuple[str, int]]:
+    """
+    LLM_MODE=recordで記録した判定の呼び出し（システムプロンプトにmarkerを含むもの）から、最新のユーザーメッセージと判定結果を取り出す
+    """
+    conn = sqlite3.connect(path)
+    try:
+        rows = conn.execute("SELECT request, response FROM cassettes").fetchall()
+    finally:
+        conn.close()
+    for request_blob, response_blob in rows:
+        request = json.loads(zlib.decompress(request_blob))
+        response = json.loads(zlib.decompress(response_blob))
+        messages = request.get("messages") or []
+        if response.get("stream") or not messages or marker not in str(messages[0].get("content", "")):
+            continue
+        user_messages = [message for message in messages if message.get("role") == "user"]
+        choices = response.get("choices") or []
+        if not user_messages or not choices:
+            continue
+        label = label_of((choices[0].get("message") or {}).get("content") or "")
+        if label is not None:
+            yield str(user_messages[-1]["content"]), label
+
+
+def split_held_out(examples: Iterable[tuple[str, int]], test_fraction: float, seed: int) -> tuple[list, list]:
+    # 同じ文が学習と評価の両方に入らないよう、重複を除いてから分ける
+    unique = list(dict(examples).items())
+    random.Random(seed).shuffle(unique)
+    n_test = int(len(unique) * test_fraction)
+    return unique[n_test:], unique[:n_test]
+
+
+# サーバーで使う分類器（読み込んだパスごとに保持し、ファイルがない場合はNoneを保持する）
+_classifiers: dict[str, Optional[JudgeClassifier]] = {}
+_load_lock = threading.Lock()
+
+
+def load_judge_classifier() -> Optional[JudgeClassifier]:
+    """
+    JUDGE_CLASSIFIER_PATHの分類器を読み込む（無効・ファイルがない場合はNone）
+    """
+    if not settings.JUDGE_CLASSIFIER_ENABLED:
+        return None
+    path = settings.JUDGE_CLASSIFIER_PATH
+    with _load_lock:
+        if path not in _classifiers:
+            try:
+                _classifiers[path] = JudgeClassifier.load(path)
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning("Judge classifier is not available (%s), using the LLM for every judge request", e)
+                _classifiers[path] = None
+        return _classifiers[path]
+
+
+def judge_locally(text: str) -> Optional[str]:
+    """
+    最新のユーザーメッセージを分類器で判定し、確信度が高ければ判定結果のタグを返す（それ以外はNone）
+    """
+    classifier = load_judge_classifier()
+    if classifier is None:
+        return None
+    result = classifier.decide(text, settings.JUDGE_CLASSIFIER_NEED_THRESHOLD, settings.JUDGE_CLASSIFIER_NOT_THRESHOLD)
+    JUDGE_CLASSIFIER_DECISIONS.inc(outcome="fallback" if result is None else ("not" if result == NOT_TAG else "need"))
+    return result
+
+
+def _load_examples(args: argparse.Namespace) -> list[tuple[str, int]]:
+    examples: list[tuple[str, int]] = []
+    for path in args.data or []:
+        examples.extend(read_decisions(path))
+    for path in args.cassettes or []:
+        examples.extend(read_cassette_decisions(path))
+    return examples
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DB検索要否の判定を行うローカル分類器の学習・評価")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for name in ("train", "evaluate"):
+        sub = subparsers.add_parser(name)
+        sub.add_argument("--data", nargs="*", help="判定結果のJSONL（JUDGE_DECISION_LOG_PATHの出力、または {text, label} の行）")
+        sub.add_argument("--cassettes", nargs="*", help="LLM_MODE=recordで記録したSQLite")
+        sub.add_argument("--need-threshold", type=float, default=settings.JUDGE_CLASSIFIER_NEED_THRESHOLD)
+        sub.add_argument("--not-threshold", type=float, default=settings.JUDGE_CLASSIFIER_NOT_THRESHOLD)
+        sub.add_argument("--report", default=None, help="評価結果を書き出すJSONのパス")
+    train_parser = subparsers.choices["train"]
+    train_parser.add_argument("--output", default=settings.JUDGE_CLASSIFIER_PATH)
+    train_parser.add_argument("--test-fraction", type=float, default=0.2, help="評価用に取り分ける割合")
+    train_parser.add_argument("--seed", type=int, default=0)
+    train_parser.add_argument("--min-df", type=int, default=2)
+    train_parser.add_argument("--epochs", type=int, default=20)
+    subparsers.choices["evaluate"].add_argument("--model", default=settings.JUDGE_CLASSIFIER_PATH)
+    args = parser.parse_args()
+
+    examples = _load_examples(args)
+    if args.command == "train":
+        train_set, held_out = split_held_out(examples, args.test_fraction, args.seed)
+        classifier = train([text for text, _ in train_set], [label for _, label in train_set], min_df=args.min_df, epochs=args.epochs, seed=args.seed)
+        classifier.save(args.output)
+        print(f"Trained on {len(train_set)} examples, {len(classifier.idf)} features -> {args.output}")
+    else:
+        classifier = JudgeClassifier.load(args.model)
+        held_out = list(dict(examples).items())
+
+    report = evaluate(classifier, [text for text, _ in held_out], [label for _, label in held_out], args.need_threshold, args.not_threshold)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
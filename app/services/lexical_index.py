@@ -0,0 +1,430 @@
+"""
+RAGのハイブリッド検索で使う語彙インデックス（BM25）
+- 語: NFKC・小文字化した本文の英数字の並び（薬剤名・遺伝子記号・PMIDなど）はそのまま1語、
+  それ以外の文字の並び（日本語など）は文字bigram（1文字だけなら1文字）。形態素解析を使わない
+- 取り込み（add_document.py）のたびに追加分を不変のセグメントファイルとして書き、削除はSQLiteの削除済みの記録にする
+  セグメントがmax_segmentsを超えたら1つに統合する
+- セグメントは 語の一覧・語ごとの転置リスト（文書番号uint32・出現回数uint16の配列）・本文とメタデータ をまとめた1ファイルで、
+  読み込みは語の辞書を作るだけにし、転置リストは検索時に必要な語の分だけ取り出す
+書き込むのは1プロセス（add_document.py）だけとする
+"""
+
+import contextlib
+import heapq
+import json
+import math
+import os
+import re
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import unicodedata
+from array import array
+from collections import Counter
+from collections.abc import Iterable
+from dataclasses import dataclass, field
+from itertools import accumulate
+from typing import Any, Optional
+
+from langchain_core.documents import Document
+
+MAGIC = b"LXS1"
+FORMAT_VERSION = 1
+MAX_TF = 65535
+DF_CUTOFF_MIN_DOCS = 1000  # これより小さいインデックスではありふれた語も使う
+LOAD_ATTEMPTS = 3  # 読み込み中にセグメントが消えたときに版を読み直す回数
+
+_RUNS = re.compile(r"[0-9a-z]+|[^\W0-9a-z_]+")
+
+
+def terms(text: str) -> list[str]:
+    """
+    英数字の並びは1語、それ以外の文字の並びは文字bigram（1文字の並びは1文字）に分ける
+    """
+    result = []
+    for run in _RUNS.findall(unicodedata.normalize("NFKC", text).lower()):
+        if run.isascii() or len(run) == 1:
+            result.append(run)
+        else:
+            result.extend(run[i : i + 2] for i in range(len(run) - 1))
+    return result
+
+
+def write_segment(path: str, ids: list[str], lengths: list[int], docs: list[tuple[str, dict]], postings: dict[str, tuple[array, array]]):
+    """
+    セグメントファイルを書く（一時ファイルに書いてから置き換える）
+    postingsは語 -> (文書番号の昇順の配列, 出現回数の配列)
+    """
+    blobs = [json.dumps([text, metadata], ensure_ascii=False, default=str).encode() for text, metadata in docs]
+    term_list = sorted(postings)
+    postings_docs, postings_tfs = array("I"), array("H")
+    postings_offsets = array("Q", [0])
+    for term in term_list:
+        doc_numbers, tfs = postings[term]
+        postings_docs.extend(doc_numbers)
+        postings_tfs.extend(tfs)
+        postings_offsets.append(len(postings_docs))
+    sections = [
+        ("ids", "\0".join(ids).encode()),
+        ("lengths", array("I", lengths).tobytes()),
+        ("doc_offsets", array("Q", accumulate((len(blob) for blob in blobs), initial=0)).tobytes()),
+        ("docs", b"".join(blobs)),
+        ("terms", "\0".join(term_list).encode()),
+        ("postings_offsets", postings_offsets.tobytes()),
+        ("postings_docs", postings_docs.tobytes()),
+        ("postings_tfs", postings_tfs.tobytes()),
+    ]
+    offsets = accumulate((len(data) for _, data in sections), initial=0)
+    header = {
+        "version": FORMAT_VERSION,
+        "byteorder": sys.byteorder,
+        "docs": len(ids),
+        "terms": len(term_list),
+        "sections": {name: [offset, len(data)] for (name, data), offset in zip(sections, offsets)},
+    }
+    header_bytes = json.dumps(header).encode()
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC + struct.pack("<I", len(header_bytes)) + header_bytes)
+        for _, data in sections:
+            f.write(data)
+    os.replace(tmp_path, path)
+
+
+class Segment:
+    """
+    読み取り専用のセグメント。語の辞書と文書の長さだけを読み込み時に展開する
+    """
+
+    def __init__(self, name: str, path: str):
+        self.name = name
+        with open(path, "rb") as f:
+            data = f.read()
+        if data[:4] != MAGIC:
+            raise ValueError(f"not a lexical index segment: {path}")
+        (header_size,) = struct.unpack("<I", data[4:8])
+        header = json.loads(data[8 : 8 + header_size])
+        if header["version"] != FORMAT_VERSION or header["byteorder"] != sys.byteorder:
+            raise ValueError(f"unsupported segment format: {path}")
+        view = memoryview(data)[8 + header_size :]
+        sections = {name: view[offset : offset + size] for name, (offset, size) in header["sections"].items()}
+
+        def decode_array(name: str, typecode: str) -> array:
+            values = array(typecode)
+            values.frombytes(sections[name])
+            return values
+
+        self.size = header["docs"]
+        self.ids = bytes(sections["ids"]).decode().split("\0") if self.size else []
+        self.lengths = decode_array("lengths", "I")
+        self._doc_offsets = decode_array("doc_offsets", "Q")
+        self._docs = sections["docs"]
+        term_list = bytes(sections["terms"]).decode().split("\0") if header["terms"] else []
+        self.terms = {term: index for index, term in enumerate(term_list)}
+        self._postings_offsets = decode_array("postings_offsets", "Q")
+        self._postings_docs = sections["postings_docs"].cast("I")
+        self._postings_tfs = sections["postings_tfs"].cast("H")
+
+    def postings_at(self, index: int) -> tuple[memoryview, memoryview]:
+        start, stop = self._postings_offsets[index], self._postings_offsets[index + 1]
+        return self._postings_docs[start:stop], self._postings_tfs[start:stop]
+
+    def postings(self, term: str) -> Optional[tuple[memoryview, memoryview]]:
+        index = self.terms.get(term)
+        return None if index is None else self.postings_at(index)
+
+    def document(self, number: int) -> Document:
+        text, metadata = json.loads(bytes(self._docs[self._doc_offsets[number] : self._doc_offsets[number + 1]]))
+        return Document(page_content=text, metadata=metadata)
+
+
+@dataclass
+class _Snapshot:
+    version: int
+    segments: list[Segment]
+    deleted: dict[str, set]  # セグメント名 -> 削除済みの文書番号
+    live_docs: int
+    avg_length: float
+    _locations: Optional[dict[str, tuple[int, int]]] = field(default=None, repr=False)
+
+    @property
+    def locations(self) -> dict[str, tuple[int, int]]:
+        """
+        削除されていないID -> (セグメントの位置, 文書番号)（書き込み時のみ使うため必要になってから作る）
+        """
+        if self._locations is None:
+            locations = {}
+            for position, segment in enumerate(self.segments):
+                deleted = self.deleted.get(segment.name, set())
+                for number, chunk_id in enumerate(segment.ids):
+                    if number not in deleted:
+                        locations[chunk_id] = (position, number)
+            self._locations = locations
+        return self._locations
+
+
+class LexicalIndex:
+    """
+    セグメントに分けたBM25の転置インデックス
+    add()は追加をメモリ上にためてflush()で1つのセグメントとして書く。delete()はその場で記録する
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        path: str,
+        k1: float = 1.2,
+        b: float = 0.75,
+        max_df_ratio: float = 0.25,
+        max_segments: int = 8,
+        refresh_interval: float = 1.0,
+    ):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.max_df_ratio = max_df_ratio
+        self.max_segments = max_segments
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(path, "index.sqlite3"), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS segments (name TEXT PRIMARY KEY)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS tombstones (segment TEXT NOT NULL, number INTEGER NOT NULL, PRIMARY KEY (segment, number))")
+        self._conn.executemany("INSERT OR IGNORE INTO meta (key, value) VALUES (?, 0)", (("version",), ("next_segment",)))
+        self._conn.commit()
+        self._buffer: dict[str, tuple[str, dict]] = {}
+        self._segments: dict[str, Segment] = {}
+        self._snapshot: Optional[_Snapshot] = None
+        self._checked = 0.0
+
+    # ---- 読み込み ----
+
+    def _version(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+
+    def _load(self) -> _Snapshot:
+        """
+        SQLiteから読んだ版のセグメントを開く。読んでから開くまでの間に書き手のmerge()で消えていたら新しい版を読み直す
+        """
+        for _ in range(LOAD_ATTEMPTS - 1):
+            with contextlib.suppress(FileNotFoundError):
+                return self._load_version()
+        return self._load_version()
+
+    def _load_version(self) -> _Snapshot:
+        with self._lock:
+            version = self._conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+            names = [name for (name,) in self._conn.execute("SELECT name FROM segments ORDER BY name")]
+            tombstones = self._conn.execute("SELECT segment, number FROM tombstones").fetchall()
+        # セグメントは不変なので、前の版で読み込んだものを使い回す
+        self._segments = {name: self._segments.get(name) or Segment(name, os.path.join(self.path, name)) for name in names}
+        segments = [self._segments[name] for name in names]
+        deleted: dict[str, set] = {}
+        for name, number in tombstones:
+            deleted.setdefault(name, set()).add(number)
+        live_docs = sum(segment.size for segment in segments) - len(tombstones)
+        live_length = sum(sum(segment.lengths) for segment in segments) - sum(
+            self._segments[name].lengths[number] for name, number in tombstones if name in self._segments
+        )
+        return _Snapshot(version, segments, deleted, live_docs, live_length / live_docs if live_length else 1.0)
+
+    def snapshot(self, force: bool = False) -> _Snapshot:
+        """
+        現在の版のビュー。他のプロセスの書き込みはrefresh_interval秒ごとに版を確認して反映する
+        """
+        now = time.monotonic()
+        snapshot = self._snapshot
+        if snapshot is None or force or now - self._checked >= self.refresh_interval:
+            self._checked = now
+            if snapshot is None or snapshot.version != self._version():
+                try:
+                    snapshot = self._snapshot = self._load()
+                except FileNotFoundError:
+                    # 読み直しても開けなければ前の版を使い続け、次の確認でまた読み込む
+                    if snapshot is None:
+                        raise
+        return snapshot
+
+    # ---- 書き込み ----
+
+    @property
+    def buffered(self) -> int:
+        return len(self._buffer)
+
+    def add(self, ids: list[str], texts: list[str], metadatas: Optional[list[dict]] = None):
+        """
+        チャンクを追加する（flush()まで検索には現れない）。既存のIDはflush()時に置き換える
+        """
+        metadatas = metadatas or [{} for _ in texts]
+        with self._write_lock:
+            for chunk_id, text, metadata in zip(ids, texts, metadatas):
+                self._buffer.pop(chunk_id, None)
+                self._buffer[chunk_id] = (text, metadata)
+
+    def missing(self, ids: Iterable[str]) -> list[str]:
+        """
+        インデックスにも追加待ちにもないIDを返す（語彙インデックスより前に取り込んだチャンクの補完に使う）
+        """
+        locations = self.snapshot().locations
+        with self._write_lock:
+            return [chunk_id for chunk_id in ids if chunk_id not in locations and chunk_id not in self._buffer]
+
+    def delete(self, ids: Iterable[str]):
+        with self._write_lock:
+            ids = list(ids)
+            for chunk_id in ids:
+                self._buffer.pop(chunk_id, None)
+            snapshot = self.snapshot(force=True)
+            self._commit(self._tombstones(snapshot, ids))
+
+    def _tombstones(self, snapshot: _Snapshot, ids: Iterable[str]) -> list[tuple[str, int]]:
+        locations = snapshot.locations
+        return [(snapshot.segments[locations[chunk_id][0]].name, locations[chunk_id][1]) for chunk_id in ids if chunk_id in locations]
+
+    def _commit(self, tombstones: list[tuple[str, int]], added: Optional[str] = None, removed: Iterable[str] = ()):
+        with self._lock:
+            if added is not None:
+                self._conn.execute("INSERT INTO segments (name) VALUES (?)", (added,))
+            for name in removed:
+                self._conn.execute("DELETE FROM segments WHERE name = ?", (name,))
+                self._conn.execute("DELETE FROM tombstones WHERE segment = ?", (name,))
+            self._conn.executemany("INSERT OR IGNORE INTO tombstones (segment, number) VALUES (?, ?)", tombstones)
+            self._conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+            self._conn.commit()
+        self._checked = -math.inf
+
+    def _next_segment_name(self) -> str:
+        with self._lock:
+            seq = self._conn.execute("SELECT value FROM meta WHERE key = 'next_segment'").fetchone()[0]
+            self._conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'next_segment'")
+            self._conn.commit()
+        # 名前の順がセグメントを書いた順になる
+        return f"segment-{seq:08d}.lex"
+
+    def flush(self):
+        """
+        ためた追加を1つのセグメントとして書き、同じIDの古い文書を削除済みにする
+        """
+        with self._write_lock:
+            if not self._buffer:
+                return
+            ids, docs = list(self._buffer), list(self._buffer.values())
+            postings: dict[str, tuple[array, array]] = {}
+            lengths = []
+            for number, (text, _) in enumerate(docs):
+                counts = Counter(terms(text))
+                lengths.append(sum(counts.values()))
+                for term, tf in counts.items():
+                    entry = postings.get(term)
+                    if entry is None:
+                        entry = postings[term] = (array("I"), array("H"))
+                    entry[0].append(number)
+                    entry[1].append(min(tf, MAX_TF))
+            name = self._next_segment_name()
+            write_segment(os.path.join(self.path, name), ids, lengths, docs, postings)
+            snapshot = self.snapshot(force=True)
+            self._commit(self._tombstones(snapshot, ids), added=name)
+            self._buffer.clear()
+            if len(snapshot.segments) + 1 > self.max_segments:
+                self._merge()
+
+    def merge(self):
+        """
+        すべてのセグメントを削除済みの文書を除いて1つにまとめる
+        """
+        with self._write_lock:
+            self._merge()
+
+    def _merge(self):
+        snapshot = self.snapshot(force=True)
+        if not snapshot.segments:
+            return
+        ids: list[str] = []
+        lengths: list[int] = []
+        docs: list[tuple[str, dict]] = []
+        renumbered: list[dict[int, int]] = []
+        for segment in snapshot.segments:
+            deleted = snapshot.deleted.get(segment.name, set())
+            mapping = {}
+            for number in range(segment.size):
+                if number in deleted:
+                    continue
+                mapping[number] = len(ids)
+                ids.append(segment.ids[number])
+                lengths.append(segment.lengths[number])
+                document = segment.document(number)
+                docs.append((document.page_content, document.metadata))
+            renumbered.append(mapping)
+        postings: dict[str, tuple[array, array]] = {}
+        # セグメントの順に足すため、まとめた転置リストも文書番号の昇順になる
+        for segment, mapping in zip(snapshot.segments, renumbered):
+            for term, index in segment.terms.items():
+                doc_numbers, tfs = segment.postings_at(index)
+                entry = postings.get(term)
+                for number, tf in zip(doc_numbers, tfs):
+                    new_number = mapping.get(number)
+                    if new_number is None:
+                        continue
+                    if entry is None:
+                        entry = postings[term] = (array("I"), array("H"))
+                    entry[0].append(new_number)
+                    entry[1].append(tf)
+        name = self._next_segment_name()
+        write_segment(os.path.join(self.path, name), ids, lengths, docs, postings)
+        removed = [segment.name for segment in snapshot.segments]
+        self._commit([], added=name, removed=removed)
+        # 古いセグメントを読み込み済みの読み手はそのまま使い続けられる（POSIX）
+        for old in removed:
+            with contextlib.suppress(OSError):
+                os.remove(os.path.join(self.path, old))
+
+    # ---- 検索 ----
+
+    def search(self, query: str, k: int = 20) -> list[tuple[str, float, Document]]:
+        """
+        BM25のスコアの大きい順に (ID, スコア, ドキュメント) を返す
+        DF_CUTOFF_MIN_DOCS件以上のインデックスでは、文書の割合でmax_df_ratioを超える語（「治療」などのありふれたbigram）は
+        寄与が小さく転置リストが長いため使わない
+        """
+        snapshot = self.snapshot()
+        if not snapshot.live_docs:
+            return []
+        scores: dict[tuple[int, int], float] = {}
+        for term in set(terms(query)):
+            found = [(position, postings) for position, segment in enumerate(snapshot.segments) if (postings := segment.postings(term)) is not None]
+            df = sum(len(postings[0]) for _, postings in found)
+            if not df or (snapshot.live_docs >= DF_CUTOFF_MIN_DOCS and df > snapshot.live_docs * self.max_df_ratio):
+                continue
+            # 削除済みの文書も数えているため文書数を上限にする
+            df = min(df, snapshot.live_docs)
+            idf = math.log(1 + (snapshot.live_docs - df + 0.5) / (df + 0.5))
+            for position, (doc_numbers, tfs) in found:
+                segment = snapshot.segments[position]
+                deleted = snapshot.deleted.get(segment.name)
+                lengths = segment.lengths
+                for number, tf in zip(doc_numbers, tfs):
+                    if deleted and number in deleted:
+                        continue
+                    norm = self.k1 * (1 - self.b + self.b * lengths[number] / snapshot.avg_length)
+                    key = (position, number)
+                    scores[key] = scores.get(key, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return [(snapshot.segments[position].ids[number], score, snapshot.segments[position].document(number)) for (position, number), score in best]
+
+    def stats(self) -> dict[str, Any]:
+        snapshot = self.snapshot(force=True)
+        return {
+            "segments": len(snapshot.segments),
+            "live_docs": snapshot.live_docs,
+            "terms": sum(len(segment.terms) for segment in snapshot.segments),
+            "bytes": sum(os.path.getsize(os.path.join(self.path, segment.name)) for segment in snapshot.segments),
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
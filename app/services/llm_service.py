@@ -1,29 +1,751 @@
+import asyncio
+import contextlib
+import hashlib
+import logging
+import time
+from collections.abc import AsyncIterator, Awaitable
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+import httpx
+import openai
 from langchain.prompts import (
     ChatPromptTemplate,
+    MessagesPlaceholder,
     SystemMessagePromptTemplate,
 )
-from langchain.schema.messages import AIMessage, HumanMessage
+from langchain.schema.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+from langchain_core.runnables import Runnable
 from langchain_openai import ChatOpenAI
 
 from app.core.config import get_settings
+from app.services.admission import PRIORITY_HIGH, PRIORITY_LOW, Ticket, admission, observe_upstream_response
+from app.services.cassette import CassetteCompletions, SyncCassetteCompletions, close_cassette_stores, get_cassette_store
+from app.services.metrics import (
+    LLM_COMPLETION_TOKENS,
+    LLM_ERRORS,
+    LLM_PROMPT_TOKENS,
+    LLM_REQUEST_DURATION,
+    LLM_STREAMS,
+    LLM_STREAMS_IN_FLIGHT,
+    LLM_TOKENS_PER_SECOND,
+    LLM_TTFT,
+    CallbackMetric,
+    current_endpoint,
+    observe_stage,
+    record_stage,
+    registry,
+)
+from app.services.resilience import resilience
+from app.services.response_cache import ResponseCache, get_response_cache
+from app.services.router import model_router
+from app.services.single_flight import SingleFlight, StreamFanout
+from app.services.tokens import MESSAGE_OVERHEAD_TOKENS, token_counter
 
 settings = get_settings()
+logger = logging.getLogger(__name__)
+
+
+# astream_chatの実行中に開かれた上流のストリーミング応答
+_open_upstream_streams: ContextVar[Optional[list]] = ContextVar("open_upstream_streams", default=None)
+
+
+class _TrackedCompletions:
+    """
+    chat.completionsのラッパー
+    ストリーミング応答を現在のコンテキストに登録し、途中で打ち切る際に確実に閉じられるようにする
+    """
+
+    def __init__(self, completions):
+        self._completions = completions
+
+    async def create(self, **kwargs):
+        response = await self._completions.create(**kwargs)
+        streams = _open_upstream_streams.get()
+        if streams is not None and isinstance(response, openai.AsyncStream):
+            streams.append(response)
+        return response
+
+
+def _running_loop() -> Optional[asyncio.AbstractEventLoop]:
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+async def _aclose_quietly(http_client: httpx.AsyncClient):
+    try:
+        await http_client.aclose()
+    except Exception as e:
+        # 閉じたループに紐づく接続は閉じられないことがある（ソケットはGCで解放される）
+        logger.debug("Failed to close a discarded HTTP client: %s", e)
+
+
+class LLMClientRegistry:
+    """
+    プロセス全体で共有するOpenAIクライアントとChatOpenAIのレジストリ
+    すべてのChatOpenAIはkeep-alive付きの同じ接続プールを利用する
+    """
+
+    def __init__(self):
+        self._http_client: Optional[httpx.AsyncClient] = None
+        self._sync_http_client: Optional[httpx.Client] = None
+        self._openai_client: Optional[openai.AsyncOpenAI] = None
+        self._sync_openai_client: Optional[openai.OpenAI] = None
+        self._llms: dict[tuple[str, float, bool, str, bool], ChatOpenAI] = {}
+        self._chains: dict[tuple[int, str, float, bool, str, bool], Runnable] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # 破棄したクライアントを閉じるタスク（完了前にGCされないよう保持する）
+        self._closing: set[asyncio.Future] = set()
+
+    @staticmethod
+    def _limits() -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=settings.LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.LLM_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=settings.LLM_KEEPALIVE_EXPIRY,
+        )
+
+    @property
+    def openai_client(self) -> openai.AsyncOpenAI:
+        if self._openai_client is None:
+            http_client = httpx.AsyncClient(
+                limits=self._limits(), timeout=settings.LLM_REQUEST_TIMEOUT, event_hooks={"response": [observe_upstream_response]}
+            )
+            self._openai_client = openai.AsyncOpenAI(
+                api_key=settings.OPENAI_API_KEY,
+                base_url=settings.OPENAI_BASE_URL,
+                timeout=settings.LLM_REQUEST_TIMEOUT,
+                max_retries=settings.LLM_MAX_RETRIES,
+                http_client=http_client,
+            )
+            self._http_client = http_client
+            self._loop = _running_loop()
+        return self._openai_client
+
+    @property
+    def sync_openai_client(self) -> openai.OpenAI:
+        if self._sync_openai_client is None:
+            http_client = httpx.Client(limits=self._limits(), timeout=settings.LLM_REQUEST_TIMEOUT)
+            self._sync_openai_client = openai.OpenAI(
+                api_key=settings.OPENAI_API_KEY,
+                base_url=settings.OPENAI_BASE_URL,
+                timeout=settings.LLM_REQUEST_TIMEOUT,
+                max_retries=settings.LLM_MAX_RETRIES,
+                http_client=http_client,
+            )
+            self._sync_http_client = http_client
+        return self._sync_openai_client
+
+    def get(self, model_name: str, temperature: float, streaming: bool) -> ChatOpenAI:
+        # 非同期の接続はイベントループに紐づくため、ループが変わった場合は作り直す
+        # （TestClientをwithなしで使うとリクエストごとに新しいループになる）
+        loop = _running_loop()
+        if self._openai_client is not None and loop is not None and self._loop is not None and loop is not self._loop:
+            self._discard_async_client(loop)
+        key = (model_name, temperature, streaming, settings.LLM_MODE, settings.LLM_RESILIENCE_ENABLED)
+        llm = self._llms.get(key)
+        if llm is None:
+            client, async_client = self._completions(streaming)
+            llm = ChatOpenAI(
+                model=model_name,
+                temperature=temperature,
+                # 再生モードではAPIキーを使わないが、ChatOpenAIの検証を通すためにダミーを渡す
+                openai_api_key=settings.OPENAI_API_KEY or ("replay" if settings.LLM_MODE == "replay" else None),
+                streaming=streaming,
+                client=client,
+                async_client=async_client,
+            )
+            self._llms[key] = llm
+        return llm
+
+    def _discard_async_client(self, loop: asyncio.AbstractEventLoop):
+        """
+        以前のループで作った非同期クライアントを破棄し、接続プールを閉じる
+        以前のループが別のスレッドで動いていればそのループで閉じ、止まっていれば現在のループから閉じられる範囲で閉じる
+        """
+        http_client, old_loop = self._http_client, self._loop
+        self._llms.clear()
+        self._chains.clear()
+        self._http_client = self._openai_client = None
+        self._loop = None
+        if http_client is None:
+            return
+        if old_loop is not None and old_loop.is_running():
+            future: asyncio.Future = asyncio.wrap_future(asyncio.run_coroutine_threadsafe(_aclose_quietly(http_client), old_loop), loop=loop)
+        else:
+            future = loop.create_task(_aclose_quietly(http_client))
+        self._closing.add(future)
+        future.add_done_callback(self._closing.discard)
+
+    def _completions(self, streaming: bool) -> tuple:
+        """
+        LLM_MODEに応じてChatOpenAIに渡す chat.completions を返す
+        live: 上流をそのまま呼ぶ / record: 上流を呼び記録する / replay: 記録から応答し上流は呼ばない
+        LLM_RESILIENCE_ENABLED時の非ストリーミング呼び出しは再試行をresilienceで行うため、SDK内部の再試行を止める
+        """
+        mode = settings.LLM_MODE
+        if mode not in ("live", "record", "replay"):
+            raise ValueError(f"Unknown LLM_MODE: {mode}")
+        if mode == "replay":
+            store = get_cassette_store(settings.LLM_CASSETTE_PATH)
+            return (
+                SyncCassetteCompletions(None, store, mode),
+                CassetteCompletions(None, store, mode, replay_speed=settings.LLM_REPLAY_SPEED),
+            )
+        client = self.sync_openai_client.chat.completions
+        openai_client = self.openai_client
+        if not streaming and settings.LLM_RESILIENCE_ENABLED:
+            openai_client = openai_client.with_options(max_retries=0)
+        async_client = _TrackedCompletions(openai_client.chat.completions)
+        if mode == "record":
+            async_client = CassetteCompletions(async_client, get_cassette_store(settings.LLM_CASSETTE_PATH), mode)
+        return client, async_client
+
+    def get_chain(self, prompt: ChatPromptTemplate, model_name: str, temperature: float, streaming: bool) -> Runnable:
+        llm = self.get(model_name, temperature, streaming)
+        key = (id(prompt), model_name, temperature, streaming, settings.LLM_MODE, settings.LLM_RESILIENCE_ENABLED)
+        chain = self._chains.get(key)
+        if chain is None:
+            chain = prompt | llm
+            self._chains[key] = chain
+        return chain
+
+    async def warmup(self, connections: int):
+        """
+        接続プールを作成し、TLSハンドシェイクを事前に済ませておく
+        失敗しても起動は継続する
+        """
+        if settings.LLM_MODE == "replay":
+            return
+        try:
+            client = self.openai_client
+        except openai.OpenAIError as e:
+            logger.warning("LLM client initialization skipped: %s", e)
+            return
+        if connections <= 0:
+            return
+        results = await asyncio.gather(*(client.models.list() for _ in range(connections)), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.warning("LLM connection warm-up failed: %s", result)
+
+    async def close(self):
+        """
+        共有クライアントを閉じ、レジストリを空にする
+        """
+        self._llms.clear()
+        self._chains.clear()
+        if self._http_client is not None:
+            await self._http_client.aclose()
+        if self._sync_http_client is not None:
+            self._sync_http_client.close()
+        self._http_client = self._sync_http_client = None
+        self._openai_client = self._sync_openai_client = None
+        self._loop = None
+        close_cassette_stores()
+
+
+llm_registry = LLMClientRegistry()
+llm_single_flight = SingleFlight()
+stream_fanout = StreamFanout(poll_interval=settings.STREAM_DISCONNECT_POLL_INTERVAL)
+
 
-def get_llm(model_name: str = settings.MODEL_NAME, temperature: float = settings.TEMPERATURE):
-    return ChatOpenAI(
-        model = model_name,
-        temperature = temperature,
-        openai_api_key = settings.OPENAI_API_KEY,
-        streaming = True
+def get_llm(model_name: str = settings.MODEL_NAME, temperature: float = settings.TEMPERATURE, streaming: bool = True) -> ChatOpenAI:
+    return llm_registry.get(model_name, temperature, streaming)
+
+
+async def warmup_llm_clients(connections: Optional[int] = None):
+    await llm_registry.warmup(settings.LLM_WARMUP_CONNECTIONS if connections is None else connections)
+
+
+async def close_llm_clients():
+    await llm_registry.close()
+
+
+def get_chain(prompt: ChatPromptTemplate, model_name: str, temperature: float, streaming: bool = True) -> Runnable:
+    """
+    コンパイル済みプロンプトとLLMをつないだチェーンを返す（エンドポイントごとに一度だけ構築）
+    """
+    return llm_registry.get_chain(prompt, model_name, temperature, streaming)
+
+
+def compile_chat_prompt(system_prompt: str) -> ChatPromptTemplate:
+    """
+    システムプロンプトを一度だけ解析し、会話履歴を "messages" 変数で受け取るテンプレートを作る
+    エンドポイントのモジュール読み込み時に呼び出すこと
+    """
+    prompt = ChatPromptTemplate.from_messages(
+        [
+            SystemMessagePromptTemplate.from_template(system_prompt),
+            MessagesPlaceholder(variable_name="messages"),
+        ]
     )
+    # プロンプト本文のハッシュをバージョンとし、変更時にキャッシュが無効になるようにする
+    prompt.metadata = {"prompt_version": hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()[:16]}
+    return prompt
 
-def create_chat_prompt(system_prompt: str, messages: list):
-    prompt_messages = [SystemMessagePromptTemplate.from_template(system_prompt)]
 
+def to_langchain_messages(messages: list) -> list[BaseMessage]:
+    """
+    role/contentの辞書リストをLangChainのメッセージに変換する
+    """
+    converted: list[BaseMessage] = []
     for msg in messages:
         if msg["role"] == "user":
-            prompt_messages.append(HumanMessage(content=msg["content"]))
+            converted.append(HumanMessage(content=msg["content"]))
         elif msg["role"] == "assistant":
-            prompt_messages.append(AIMessage(content=msg["content"]))
+            converted.append(AIMessage(content=msg["content"]))
+        elif msg["role"] == "summary":
+            # 履歴圧縮で古いターンを置き換えた要約
+            converted.append(SystemMessage(content=f"これまでの会話の要約:\n{msg['content']}"))
+    return converted
+
+
+async def ainvoke_chat(  # noqa: PLR0913
+    prompt: ChatPromptTemplate,
+    messages: list,
+    model_name: str,
+    temperature: float,
+    timeout: Optional[float] = None,
+    cache_namespace: Optional[str] = None,
+    priority: int = PRIORITY_HIGH,
+    hedge: bool = False,
+) -> str:
+    """
+    非ストリーミングのチャット呼び出しをイベントループを止めずに実行する
+    タイムアウト時はasyncio.TimeoutErrorを送出し、上流のリクエストもキャンセルされる
+    cache_namespaceを指定し応答キャッシュが有効な場合は、同一リクエストの結果を再利用する
+    上流の枠が空かない場合や上流が429を返した場合はAdmissionRejectedErrorを送出する
+    hedgeを指定するとLLM_HEDGING_ENABLED時に遅い応答をヘッジする（短い応答の呼び出し向け）
+    """
+
+    async def upstream() -> str:
+        return await resilience.call(
+            model_name,
+            cache_namespace or model_name,
+            lambda: _ainvoke_chat(prompt, messages, model_name, temperature, timeout, priority),
+            hedged=hedge,
+            can_hedge=lambda: admission.has_capacity(model_name),
+        )
+
+    cache = get_response_cache() if cache_namespace is not None else None
+    if cache_namespace is None or (cache is None and not settings.SINGLE_FLIGHT_ENABLED):
+        return await upstream()
+
+    if cache is not None and settings.RESPONSE_CACHE_DETERMINISTIC:
+        temperature = 0.0
+    key = request_key(cache_namespace, prompt, model_name, temperature, messages)
+    if cache is not None:
+        cached = await cache.get(key)
+        if cached is not None:
+            return cached
+
+    async def call() -> str:
+        result = await upstream()
+        if cache is not None:
+            await cache.set(key, result)
+        return result
+
+    # 同じリクエストが実行中なら上流を呼ばずにその結果を共有する
+    if settings.SINGLE_FLIGHT_ENABLED:
+        return await llm_single_flight.do(key, call)
+    return await call()
+
+
+async def ainvoke_routed(  # noqa: PLR0913
+    route: str,
+    prompt: ChatPromptTemplate,
+    messages: list,
+    temperature: float,
+    cache_namespace: Optional[str] = None,
+    hedge: bool = False,
+    timeout: Optional[float] = None,
+    priority: int = PRIORITY_HIGH,
+) -> str:
+    """
+    ainvoke_chatと同じだが、モデルはMODEL_ROUTESのrouteの候補から選び、一時的なエラーでは次の候補で再実行する
+    """
+    return await model_router.call(
+        route,
+        lambda model_name: ainvoke_chat(
+            prompt,
+            messages,
+            model_name=model_name,
+            temperature=temperature,
+            timeout=timeout,
+            cache_namespace=cache_namespace,
+            priority=priority,
+            hedge=hedge,
+        ),
+    )
+
+
+def request_key(namespace: str, prompt: ChatPromptTemplate, model_name: str, temperature: float, messages: list) -> str:
+    """
+    キャッシュ・single-flightで使うリクエストの正規化ハッシュ
+    """
+    prompt_version = (prompt.metadata or {}).get("prompt_version", "")
+    return ResponseCache.make_key(namespace, prompt_version, model_name, temperature, messages)
+
+
+async def _ainvoke_chat(  # noqa: PLR0913
+    prompt: ChatPromptTemplate, messages: list, model_name: str, temperature: float, timeout: Optional[float], priority: int
+) -> str:
+    chain = get_chain(prompt, model_name=model_name, temperature=temperature, streaming=False)
+    endpoint = current_endpoint()
+    # プロンプトの組み立てと上流の応答待ちを別の段階として記録するため、チェーンの前後を分けて呼ぶ
+    with observe_stage("prompt"):
+        langchain_messages = to_langchain_messages(messages)
+        prompt_messages = chain.first.format_messages(messages=langchain_messages)
+        prompt_tokens = count_prompt_tokens(prompt, langchain_messages)
+    # 上流の枠が空くまで待つ（待ち時間はLLM_CALL_TIMEOUTに含めない）
+    ticket = await admission.acquire(model_name, prompt_tokens, priority)
+    try:
+        started = time.perf_counter()
+        try:
+            with observe_stage("upstream"):
+                response = await asyncio.wait_for(
+                    chain.last.ainvoke(prompt_messages),
+                    timeout=settings.LLM_CALL_TIMEOUT if timeout is None else timeout,
+                )
+        except openai.RateLimitError as e:
+            LLM_ERRORS.inc(endpoint=endpoint, model=model_name, error=type(e).__name__)
+            raise admission.rejection(model_name, e.response.headers) from e
+        except Exception as e:
+            LLM_ERRORS.inc(endpoint=endpoint, model=model_name, error=type(e).__name__)
+            raise
+        content = str(response.content).strip()
+        completion_tokens = token_counter.count_text(content)
+        ticket.charge(completion_tokens)
+    finally:
+        ticket.release()
+    LLM_REQUEST_DURATION.observe(time.perf_counter() - started, endpoint=endpoint, model=model_name, kind="invoke")
+    LLM_PROMPT_TOKENS.inc(prompt_tokens, endpoint=endpoint, model=model_name)
+    LLM_COMPLETION_TOKENS.inc(completion_tokens, endpoint=endpoint, model=model_name)
+    return content
+
+
+def count_prompt_tokens(prompt: Optional[ChatPromptTemplate], messages: list[BaseMessage]) -> int:
+    """
+    システムプロンプトと会話履歴のトークン数（メトリクス用の見積もり）
+    """
+    total = sum(token_counter.count_text(str(msg.content)) + MESSAGE_OVERHEAD_TOKENS for msg in messages)
+    system = prompt.messages[0] if prompt is not None and prompt.messages else None
+    if isinstance(system, SystemMessagePromptTemplate):
+        total += token_counter.count_text(system.prompt.template) + MESSAGE_OVERHEAD_TOKENS
+    return total
+
+
+@dataclass
+class StreamStats:
+    """
+    ストリーミング応答の統計（チャンク数はおおよそトークン数に対応する）
+    """
+
+    completed_streams: int = 0
+    completed_chunks: int = 0
+    aborted_streams: int = 0
+    aborted_chunks: int = 0
+    tokens_saved: int = 0  # 完了したストリームの平均長から推定した、切断により生成を止めたトークン数
 
-    return ChatPromptTemplate.from_messages(prompt_messages)
+    def record(self, outcome: str, chunks: int):
+        if outcome == "completed":
+            self.record_completed(chunks)
+        elif outcome == "aborted":
+            self.record_aborted(chunks)
+
+    def record_completed(self, chunks: int):
+        self.completed_streams += 1
+        self.completed_chunks += chunks
+
+    def record_aborted(self, chunks: int):
+        self.aborted_streams += 1
+        self.aborted_chunks += chunks
+        if self.completed_streams:
+            self.tokens_saved += max(0, round(self.completed_chunks / self.completed_streams - chunks))
+
+
+stream_stats = StreamStats()
+
+
+@dataclass
+class Coalescing:
+    """
+    ストリーミングのデルタをまとめるしきい値
+    """
+
+    max_chars: int  # バッファがこの文字数に達したら送出する
+    max_delay: float  # 最初のデルタからこの秒数が経過したら送出する
+
+
+@dataclass
+class StreamMetrics:
+    """
+    1ストリーム分の計測値（時刻はtime.monotonic）
+    """
+
+    started_at: float = 0.0
+    first_token_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    deltas: int = 0  # 上流から受け取ったデルタ数（おおよそ生成トークン数）
+    frames: int = 0  # 呼び出し側に返したチャンク数
+    outcome: Optional[str] = None  # completed / aborted / error（終了後に設定）
+
+    @property
+    def ttft(self) -> Optional[float]:
+        return None if self.first_token_at is None else self.first_token_at - self.started_at
+
+    @property
+    def duration(self) -> Optional[float]:
+        return None if self.finished_at is None else self.finished_at - self.started_at
+
+
+_STREAM_END = object()
+_DISCONNECTED = object()
+
+
+class _CoalescingQueue:
+    """
+    デルタをしきい値までバッファしてからキューに入れる（coalescingがNoneならそのまま入れる）
+    """
+
+    def __init__(self, queue: asyncio.Queue, coalescing: Optional[Coalescing]):
+        self._queue = queue
+        self._coalescing = coalescing
+        self._buffer: list[str] = []
+        self._buffered_chars = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def push(self, text: str):
+        if self._coalescing is None:
+            self._queue.put_nowait(text)
+            return
+        self._buffer.append(text)
+        self._buffered_chars += len(text)
+        if self._buffered_chars >= self._coalescing.max_chars:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self._coalescing.max_delay, self.flush)
+
+    def flush(self):
+        self.cancel_timer()
+        if self._buffer:
+            self._queue.put_nowait("".join(self._buffer))
+            self._buffer.clear()
+            self._buffered_chars = 0
+
+    def cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+
+async def _watch_disconnect(is_disconnected: Callable[[], Awaitable[bool]], queue: asyncio.Queue):
+    while not await is_disconnected():
+        await asyncio.sleep(settings.STREAM_DISCONNECT_POLL_INTERVAL)
+    queue.put_nowait(_DISCONNECTED)
+
+
+async def _close_upstream(upstream_streams: list, pump_task: asyncio.Task):
+    # 上流のHTTPストリームを先に閉じて接続を確実に切断し、その後読み込みタスクを止める
+    # （読み込み中のタスクをキャンセルするだけでは接続の後始末が中断されることがある）
+    for upstream in upstream_streams:
+        try:
+            await upstream.close()
+        except Exception as e:
+            logger.warning("Failed to close upstream stream: %s", e)
+    if not pump_task.done():
+        pump_task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await pump_task
+
+
+def _model_name(chain: Runnable) -> str:
+    return getattr(getattr(chain, "last", None), "model_name", "unknown")
+
+
+def _record_stream_start(chain: Runnable, inputs: dict) -> tuple[str, str]:
+    endpoint, model_name = current_endpoint(), _model_name(chain)
+    LLM_STREAMS_IN_FLIGHT.inc(endpoint=endpoint)
+    LLM_PROMPT_TOKENS.inc(count_prompt_tokens(getattr(chain, "first", None), inputs.get("messages", [])), endpoint=endpoint, model=model_name)
+    return endpoint, model_name
+
+
+def _record_stream_end(endpoint: str, model_name: str, metrics: StreamMetrics):
+    LLM_STREAMS_IN_FLIGHT.dec(endpoint=endpoint)
+    LLM_STREAMS.inc(endpoint=endpoint, outcome=metrics.outcome or "aborted")
+    LLM_COMPLETION_TOKENS.inc(metrics.deltas, endpoint=endpoint, model=model_name)
+    if metrics.duration is not None:
+        LLM_REQUEST_DURATION.observe(metrics.duration, endpoint=endpoint, model=model_name, kind="stream")
+    if metrics.ttft is not None:
+        LLM_TTFT.observe(metrics.ttft, endpoint=endpoint, model=model_name)
+        record_stage("ttft", metrics.ttft, endpoint)
+        if metrics.finished_at is not None:
+            record_stage("streaming", metrics.finished_at - metrics.first_token_at, endpoint)
+    if metrics.outcome == "completed" and metrics.first_token_at is not None and metrics.finished_at is not None and metrics.deltas > 1:
+        generation_time = metrics.finished_at - metrics.first_token_at
+        if generation_time > 0:
+            LLM_TOKENS_PER_SECOND.observe((metrics.deltas - 1) / generation_time, endpoint=endpoint, model=model_name)
+
+
+async def astream_chat(
+    chain: Runnable,
+    inputs: dict,
+    is_disconnected: Optional[Callable[[], Awaitable[bool]]] = None,
+    coalescing: Optional[Coalescing] = None,
+    metrics: Optional[StreamMetrics] = None,
+) -> AsyncIterator[str]:
+    """
+    チェーンのストリーミング出力をテキストとして返す
+    上流の読み込みは別タスクで行い、クライアントの切断を検知するか呼び出し側がキャンセル・クローズした時点で
+    上流のHTTPストリームを即座に閉じて生成を止める
+    coalescingを指定すると、細かいデルタを文字数・時間のしきい値でまとめてから返す
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    upstream_streams: list = []
+    metrics = metrics if metrics is not None else StreamMetrics()
+    metrics.started_at = time.monotonic()
+    endpoint, model_name = _record_stream_start(chain, inputs)
+    output = _CoalescingQueue(queue, coalescing)
+
+    async def pump():
+        # pumpタスク内で開かれた上流のストリームを記録する（タスクのコンテキスト内のみ有効）
+        _open_upstream_streams.set(upstream_streams)
+        try:
+            async for chunk in chain.astream(inputs):
+                if chunk.content:
+                    if metrics.first_token_at is None:
+                        metrics.first_token_at = time.monotonic()
+                    metrics.deltas += 1
+                    output.push(str(chunk.content))
+            output.flush()
+            queue.put_nowait(_STREAM_END)
+        except Exception as e:
+            output.flush()
+            queue.put_nowait(e)
+        finally:
+            output.cancel_timer()
+
+    pump_task = asyncio.create_task(pump())
+    watch_task = asyncio.create_task(_watch_disconnect(is_disconnected, queue)) if is_disconnected is not None else None
+    outcome = "aborted"
+    try:
+        while True:
+            item = await queue.get()
+            if item is _DISCONNECTED:
+                break
+            if item is _STREAM_END:
+                outcome = "completed"
+                break
+            if isinstance(item, Exception):
+                outcome = "error"
+                raise item
+            metrics.frames += 1
+            yield item
+    finally:
+        if watch_task is not None:
+            watch_task.cancel()
+        # 呼び出し側がキャンセルされていても後始末が中断されないようshieldする
+        cleanup = asyncio.ensure_future(_close_upstream(upstream_streams, pump_task))
+        with contextlib.suppress(asyncio.CancelledError):
+            await asyncio.shield(cleanup)
+        metrics.finished_at = time.monotonic()
+        metrics.outcome = outcome
+        stream_stats.record(outcome, metrics.deltas)
+        _record_stream_end(endpoint, model_name, metrics)
+
+
+async def admit_stream(chain: Runnable, inputs: dict, key: Optional[str] = None) -> Ticket:
+    """
+    ストリーミング応答を始める前に上流の枠を取得する（優先度は最も低い）
+    レスポンスヘッダーを送る前に呼び、枠が空かなければAdmissionRejectedErrorで429を返せるようにする
+    keyで配信中のストリームに相乗りできる場合は上流を呼ばないため枠を取らない
+    """
+    if key is not None and settings.STREAM_FANOUT_ENABLED and stream_fanout.is_streaming(key):
+        return Ticket()
+    prompt_tokens = count_prompt_tokens(getattr(chain, "first", None), inputs.get("messages", []))
+    return await admission.acquire(_model_name(chain), prompt_tokens, PRIORITY_LOW)
+
+
+async def astream_chat_shared(  # noqa: PLR0913
+    chain: Runnable,
+    inputs: dict,
+    key: str,
+    is_disconnected: Optional[Callable[[], Awaitable[bool]]] = None,
+    coalescing: Optional[Coalescing] = None,
+    metrics: Optional[StreamMetrics] = None,
+) -> AsyncIterator[str]:
+    """
+    astream_chatと同じだが、同じキーで配信中のストリームがあれば上流を呼ばずに相乗りする
+    途中から参加した場合はそれまでの出力を先に受け取り、その後はライブで受け取る
+    """
+    if not settings.STREAM_FANOUT_ENABLED:
+        async for text in astream_chat(chain, inputs, is_disconnected=is_disconnected, coalescing=coalescing, metrics=metrics):
+            yield text
+        return
+
+    metrics = metrics if metrics is not None else StreamMetrics()
+    metrics.started_at = time.monotonic()
+
+    def source(context: dict) -> AsyncIterator[str]:
+        context["metrics"] = StreamMetrics()
+        return astream_chat(chain, inputs, coalescing=coalescing, metrics=context["metrics"])
+
+    subscription = stream_fanout.subscribe(key, source, is_disconnected=is_disconnected)
+    try:
+        async for text in subscription:
+            if metrics.first_token_at is None:
+                metrics.first_token_at = time.monotonic()
+            metrics.frames += 1
+            yield text
+    finally:
+        shared = subscription.context.get("metrics")
+        metrics.deltas = shared.deltas if shared is not None else 0
+        metrics.finished_at = time.monotonic()
+        metrics.outcome = subscription.outcome
+
+
+def _response_cache_lookups() -> dict:
+    cache = get_response_cache()
+    if cache is None:
+        return {}
+    return {("hit",): cache.hits, ("miss",): cache.misses, ("error",): cache.errors}
+
+
+def _response_cache_hit_ratio() -> dict:
+    cache = get_response_cache()
+    return {} if cache is None else {(): cache.stats()["hit_rate"]}
+
+
+# 他の仕組みが持つ統計値は /metrics の出力時に読み取る
+registry.register(CallbackMetric("response_cache_lookups_total", "Response cache lookups by result", "counter", _response_cache_lookups, ("result",)))
+registry.register(CallbackMetric("response_cache_hit_ratio", "Response cache hit ratio since start", "gauge", _response_cache_hit_ratio))
+registry.register(
+    CallbackMetric(
+        "single_flight_calls_total",
+        "Non-streaming LLM calls by whether they reached upstream (leader) or shared an in-flight call",
+        "counter",
+        lambda: {("leader",): llm_single_flight.leaders, ("shared",): llm_single_flight.shared},
+        ("role",),
+    )
+)
+registry.register(
+    CallbackMetric(
+        "stream_fanout_subscriptions_total",
+        "Streaming responses by whether they opened an upstream stream (leader) or joined one",
+        "counter",
+        lambda: {("leader",): stream_fanout.leaders, ("joiner",): stream_fanout.joiners},
+        ("role",),
+    )
+)
+registry.register(
+    CallbackMetric(
+        "llm_stream_tokens_saved_total",
+        "Estimated completion tokens not generated because streams were aborted",
+        "counter",
+        lambda: {(): stream_stats.tokens_saved},
+    )
+)
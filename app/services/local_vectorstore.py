@@ -0,0 +1,491 @@
+"""
+Pineconeの代わりに使えるローカルのベクトルストア（LangChainのVectorStore）
+- 埋め込みは正規化してfloat32（またはベクトルごとのスケール付きint8）でファイルに追記し、メモリマップで読む
+  同じファイルを開いた複数のワーカープロセスはOSのページキャッシュを共有する
+- 検索はブロックごとのNumPyの行列積（コサイン類似度）で、複数クエリもまとめて計算する
+- train_ivf()でk-meansの粗い分割（IVF）を作ると、クエリに近いnprobe個の分割だけを探す
+- 本文・メタデータ・ID・削除済みの行はSQLiteに置き、書き込みのたびに版を上げる。読む側は版が変わったら開き直す
+書き込むのは1プロセス（add_document.py）だけとする
+
+    python -m app.services.local_vectorstore train-ivf --nlist 256
+    python -m app.services.local_vectorstore compact
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections.abc import Iterable
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+DTYPES = {"float32": np.float32, "int8": np.int8}
+SEARCH_BLOCK_ROWS = 65536  # 行列積を計算する行数の単位（一時メモリの上限）
+INT8_MAX = 127
+LOAD_ATTEMPTS = 3  # 読み込み中にファイルが消えたときに版を読み直す回数
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def quantize_int8(vectors: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    ベクトルごとの対称スケールでint8に量子化する（元の値 ≒ 量子化した値 * スケール）
+    """
+    scales = np.abs(vectors).max(axis=1) / INT8_MAX
+    scales[scales == 0] = 1.0
+    quantized = np.clip(np.rint(vectors / scales[:, None]), -INT8_MAX, INT8_MAX).astype(np.int8)
+    return quantized, scales.astype(np.float32)
+
+
+def top_k(scores: np.ndarray, rows: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    各クエリ（行）についてスコアの大きい順にk件の (スコア, 行番号) を返す
+    """
+    if scores.shape[1] > k:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, part, axis=1)
+        rows = np.take_along_axis(rows, part, axis=1)
+    order = np.argsort(-scores, axis=1, kind="stable")
+    return np.take_along_axis(scores, order, axis=1), np.take_along_axis(rows, order, axis=1)
+
+
+@dataclass
+class _Snapshot:
+    """
+    ある版の読み取り専用のビュー。検索中に書き込みがあっても差し替えるだけで変更しない
+    """
+
+    version: int
+    count: int
+    dim: int
+    vectors: np.ndarray
+    scales: Optional[np.ndarray]
+    deleted: np.ndarray
+    data_gen: str  # 行番号の世代（compact()で行番号を詰め直すと変わる）
+    centroids: Optional[np.ndarray] = None
+    assign: Optional[np.ndarray] = None  # 行ごとの分割の番号
+    list_rows: Optional[np.ndarray] = None  # 分割ごとに並べた行番号
+    list_offsets: Optional[np.ndarray] = None  # 分割iの行はlist_rows[offsets[i]:offsets[i+1]]
+
+    def block(self, rows: Any) -> np.ndarray:
+        vectors = np.asarray(self.vectors[rows], dtype=np.float32)
+        if self.scales is not None:
+            vectors *= self.scales[rows][:, None]
+        return vectors
+
+
+class LocalVectorStore(VectorStore):
+    """
+    メモリマップしたファイル上のベクトルストア（コサイン類似度、スコアは大きいほど近い）
+    dtypeは新規作成時のみ有効（既存のストアは作成時のdtypeを使う）
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        path: str,
+        embedding: Optional[Embeddings] = None,
+        dtype: str = "float32",
+        nprobe: int = 8,
+        refresh_interval: float = 1.0,
+    ):
+        if dtype not in DTYPES:
+            raise ValueError(f"unsupported dtype: {dtype}")
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.embedding = embedding
+        self.nprobe = nprobe
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        # 書き込み（metaの読み込みからファイルへの追記・コミットまで）を1つずつ行う
+        self._write_lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(path, "documents.sqlite3"), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS documents (row INTEGER PRIMARY KEY, id TEXT NOT NULL UNIQUE, text TEXT NOT NULL, metadata TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS tombstones (row INTEGER PRIMARY KEY)")
+        self._conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('dtype', ?)", (dtype,))
+        for key in ("version", "count", "dim", "data_gen", "ivf_gen", "nlist"):
+            self._conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES (?, '0')", (key,))
+        self._conn.commit()
+        self.dtype = self._meta()["dtype"]
+        self._snapshot: Optional[_Snapshot] = None
+        self._checked = 0.0
+
+    @property
+    def embeddings(self) -> Optional[Embeddings]:
+        return self.embedding
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        # 正規化したベクトルの内積（コサイン類似度）を[0, 1]に写す
+        return lambda score: (score + 1.0) / 2.0
+
+    # ---- ファイルとメタデータ ----
+
+    def _file(self, name: str, gen: Any) -> str:
+        return os.path.join(self.path, f"{name}-{gen}.bin")
+
+    def _meta(self) -> dict[str, str]:
+        with self._lock:
+            return dict(self._conn.execute("SELECT key, value FROM meta").fetchall())
+
+    def _set_meta(self, values: dict[str, Any]):
+        self._conn.executemany("UPDATE meta SET value = ? WHERE key = ?", ((str(value), key) for key, value in values.items()))
+
+    @staticmethod
+    def _map(path: str, dtype: Any, shape: tuple) -> np.ndarray:
+        if shape[0] == 0:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode="r", shape=shape)
+
+    @staticmethod
+    def _append(path: str, data: np.ndarray, offset: int):
+        # 前回の書き込みが途中で止まった場合に版に含まれない末尾を捨ててから追記する
+        with open(path, "ab") as f:
+            if f.tell() != offset:
+                f.truncate(offset)
+            f.write(data.tobytes())
+
+    def _load(self) -> _Snapshot:
+        """
+        SQLiteから読んだ版のファイルを開く。読んでから開くまでの間に書き手のcompact()で消えていたら新しい版を読み直す
+        """
+        for _ in range(LOAD_ATTEMPTS - 1):
+            with contextlib.suppress(FileNotFoundError):
+                return self._load_version()
+        return self._load_version()
+
+    def _load_version(self) -> _Snapshot:
+        meta = self._meta()
+        count, dim = int(meta["count"]), int(meta["dim"])
+        data_gen, ivf_gen, nlist = meta["data_gen"], meta["ivf_gen"], int(meta["nlist"])
+        vectors = self._map(self._file("vectors", data_gen), DTYPES[self.dtype], (count, dim))
+        scales = self._map(self._file("scales", data_gen), np.float32, (count,)) if self.dtype == "int8" else None
+        deleted = np.zeros(count, dtype=bool)
+        with self._lock:
+            tombstones = [row for (row,) in self._conn.execute("SELECT row FROM tombstones")]
+        deleted[[row for row in tombstones if row < count]] = True
+        snapshot = _Snapshot(int(meta["version"]), count, dim, vectors, scales, deleted, data_gen)
+        if nlist:
+            snapshot.centroids = np.fromfile(self._file("centroids", ivf_gen), dtype=np.float32).reshape(nlist, dim)
+            snapshot.assign = self._map(self._file("assign", ivf_gen), np.int32, (count,))
+            snapshot.list_rows = np.argsort(snapshot.assign, kind="stable").astype(np.int64)
+            snapshot.list_offsets = np.searchsorted(np.asarray(snapshot.assign)[snapshot.list_rows], np.arange(nlist + 1))
+        return snapshot
+
+    def snapshot(self, force: bool = False) -> _Snapshot:
+        """
+        現在の版のビュー。他のプロセスの書き込みはrefresh_interval秒ごとに版を確認して反映する
+        """
+        now = time.monotonic()
+        snapshot = self._snapshot
+        if snapshot is None or force or now - self._checked >= self.refresh_interval:
+            self._checked = now
+            with self._lock:
+                version = int(self._conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0])
+            if snapshot is None or snapshot.version != version:
+                try:
+                    snapshot = self._snapshot = self._load()
+                except FileNotFoundError:
+                    # 読み直しても開けなければ前の版を使い続け、次の確認でまた読み込む
+                    if snapshot is None:
+                        raise
+        return snapshot
+
+    # ---- 書き込み ----
+
+    def add_embeddings(
+        self, texts: list[str], embeddings: list[list[float]], metadatas: Optional[list[dict]] = None, ids: Optional[list[str]] = None
+    ) -> list[str]:
+        """
+        埋め込み済みのチャンクを追加する。既存のIDは古い行を削除済みにして置き換える（upsert）
+        """
+        if not texts:
+            return []
+        metadatas = metadatas or [{} for _ in texts]
+        ids = ids or [uuid.uuid4().hex for _ in texts]
+        # 同じ呼び出しの中で重複するIDは最後のものを使う
+        last = {chunk_id: index for index, chunk_id in enumerate(ids)}
+        keep = sorted(last.values())
+        vectors = normalize_rows(np.asarray(embeddings, dtype=np.float32)[keep])
+
+        # metaの件数から追記する位置と行番号を決めるため、コミットまで他の書き込みを待たせる
+        with self._write_lock:
+            meta = self._meta()
+            count, dim = int(meta["count"]), int(meta["dim"]) or vectors.shape[1]
+            if vectors.shape[1] != dim:
+                raise ValueError(f"embedding dimension {vectors.shape[1]} does not match the store ({dim})")
+            data_gen, ivf_gen, nlist = meta["data_gen"], meta["ivf_gen"], int(meta["nlist"])
+            if self.dtype == "int8":
+                quantized, scales = quantize_int8(vectors)
+                self._append(self._file("vectors", data_gen), quantized, count * dim)
+                self._append(self._file("scales", data_gen), scales, count * 4)
+            else:
+                self._append(self._file("vectors", data_gen), vectors, count * dim * 4)
+            if nlist:
+                centroids = np.fromfile(self._file("centroids", ivf_gen), dtype=np.float32).reshape(nlist, dim)
+                self._append(self._file("assign", ivf_gen), np.argmax(vectors @ centroids.T, axis=1).astype(np.int32), count * 4)
+
+            kept_ids = [ids[index] for index in keep]
+            with self._lock:
+                replaced = self._rows_of(kept_ids)
+                self._conn.executemany("INSERT OR IGNORE INTO tombstones (row) VALUES (?)", ((row,) for row in replaced))
+                self._conn.executemany("DELETE FROM documents WHERE row = ?", ((row,) for row in replaced))
+                self._conn.executemany(
+                    "INSERT INTO documents (row, id, text, metadata) VALUES (?, ?, ?, ?)",
+                    (
+                        (count + offset, ids[index], texts[index], json.dumps(metadatas[index], ensure_ascii=False, default=str))
+                        for offset, index in enumerate(keep)
+                    ),
+                )
+                self._set_meta({"count": count + len(keep), "dim": dim, "version": int(meta["version"]) + 1})
+                self._conn.commit()
+            self._checked = -np.inf
+            return list(ids)
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[list[dict]] = None, ids: Optional[list[str]] = None, **kwargs: Any) -> list[str]:
+        if self.embedding is None:
+            raise ValueError("embedding is required to add texts")
+        texts = list(texts)
+        return self.add_embeddings(texts, self.embedding.embed_documents(texts), metadatas, ids)
+
+    def delete(self, ids: Optional[list[str]] = None, **kwargs: Any) -> Optional[bool]:
+        if not ids:
+            return False
+        with self._write_lock, self._lock:
+            rows = self._rows_of(ids)
+            self._conn.executemany("INSERT OR IGNORE INTO tombstones (row) VALUES (?)", ((row,) for row in rows))
+            self._conn.executemany("DELETE FROM documents WHERE row = ?", ((row,) for row in rows))
+            self._conn.execute("UPDATE meta SET value = CAST(value AS INTEGER) + 1 WHERE key = 'version'")
+            self._conn.commit()
+        self._checked = -np.inf
+        return True
+
+    def _rows_of(self, ids: list[str]) -> list[int]:
+        rows = []
+        for start in range(0, len(ids), 500):
+            part = ids[start : start + 500]
+            rows.extend(row for (row,) in self._conn.execute(f"SELECT row FROM documents WHERE id IN ({','.join('?' * len(part))})", part))
+        return rows
+
+    def train_ivf(self, nlist: int, iterations: int = 10, sample_size: Optional[int] = None, seed: int = 0):
+        """
+        削除されていない行（最大sample_size件）でk-means（球面）を学習し、全行を最も近い分割に割り当てる
+        以降に追加した行は追加時に割り当てる
+        """
+        with self._write_lock:
+            snapshot = self.snapshot(force=True)
+            live = np.flatnonzero(~snapshot.deleted)
+            if len(live) < nlist:
+                raise ValueError(f"need at least {nlist} vectors to train {nlist} lists (have {len(live)})")
+            rng = np.random.default_rng(seed)
+            sample = np.sort(rng.choice(live, min(len(live), sample_size or nlist * 64), replace=False))
+            data = normalize_rows(snapshot.block(sample))
+            centroids = data[rng.choice(len(data), nlist, replace=False)]
+            for _ in range(iterations):
+                assign = np.argmax(data @ centroids.T, axis=1)
+                sums = np.zeros_like(centroids)
+                np.add.at(sums, assign, data)
+                filled = np.bincount(assign, minlength=nlist) > 0
+                # 空になった分割は前の中心を残す
+                centroids[filled] = normalize_rows(sums[filled])
+
+            assign = np.empty(snapshot.count, dtype=np.int32)
+            for start in range(0, snapshot.count, SEARCH_BLOCK_ROWS):
+                block = snapshot.block(slice(start, start + SEARCH_BLOCK_ROWS))
+                assign[start : start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+            meta = self._meta()
+            ivf_gen = int(meta["ivf_gen"]) + 1
+            centroids.astype(np.float32).tofile(self._file("centroids", ivf_gen))
+            assign.tofile(self._file("assign", ivf_gen))
+            with self._lock:
+                self._set_meta({"ivf_gen": ivf_gen, "nlist": nlist, "version": int(meta["version"]) + 1})
+                self._conn.commit()
+            self._checked = -np.inf
+            self._remove_files(("centroids", "assign"), meta["ivf_gen"])
+
+    def compact(self):
+        """
+        削除済みの行を除いてファイルを書き直す（upsertや再取り込みで増えた削除済みの行の分だけ小さくなる）
+        """
+        with self._write_lock:
+            snapshot = self.snapshot(force=True)
+            live = np.flatnonzero(~snapshot.deleted)
+            meta = self._meta()
+            data_gen, ivf_gen = int(meta["data_gen"]) + 1, int(meta["ivf_gen"]) + 1
+            np.asarray(snapshot.vectors[live]).tofile(self._file("vectors", data_gen))
+            if snapshot.scales is not None:
+                np.asarray(snapshot.scales[live]).tofile(self._file("scales", data_gen))
+            if snapshot.centroids is not None:
+                snapshot.centroids.tofile(self._file("centroids", ivf_gen))
+                np.asarray(snapshot.assign[live]).tofile(self._file("assign", ivf_gen))
+            with self._lock:
+                # 行番号を詰める（liveは昇順なので、新しい番号の方が常に小さく衝突しない）
+                self._conn.executemany("UPDATE documents SET row = ? WHERE row = ?", ((new, int(old)) for new, old in enumerate(live)))
+                self._conn.execute("DELETE FROM tombstones")
+                self._set_meta({"count": len(live), "data_gen": data_gen, "ivf_gen": ivf_gen, "version": int(meta["version"]) + 1})
+                self._conn.commit()
+            self._checked = -np.inf
+            self._remove_files(("vectors", "scales"), meta["data_gen"])
+            self._remove_files(("centroids", "assign"), meta["ivf_gen"])
+
+    def _remove_files(self, names: tuple[str, ...], gen: str):
+        # 古い世代のファイルを開いている読み手はそのまま読み続けられる（POSIX）
+        for name in names:
+            with contextlib.suppress(OSError):
+                os.remove(self._file(name, gen))
+
+    # ---- 検索 ----
+
+    def search_vectors(self, queries: np.ndarray, k: int = 4, nprobe: Optional[int] = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        複数のクエリベクトル (b, dim) に対してスコアの大きい順の (スコア, 行番号) をそれぞれ (b, k) で返す
+        件数がkに満たない場合は行番号-1・スコア-infで埋める
+        """
+        return self._search(self.snapshot(), queries, k, nprobe)
+
+    def _search(self, snapshot: _Snapshot, queries: np.ndarray, k: int, nprobe: Optional[int]) -> tuple[np.ndarray, np.ndarray]:
+        queries = normalize_rows(np.atleast_2d(queries))
+        nprobe = nprobe or self.nprobe
+        if snapshot.centroids is not None and nprobe < len(snapshot.centroids):
+            results = [self._search_ivf(snapshot, query, k, nprobe) for query in queries]
+            return np.stack([scores for scores, _ in results]), np.stack([rows for _, rows in results])
+        return self._search_exact(snapshot, queries, k)
+
+    @staticmethod
+    def _pad(scores: np.ndarray, rows: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        missing = k - scores.shape[1]
+        if missing > 0:
+            scores = np.pad(scores, ((0, 0), (0, missing)), constant_values=-np.inf)
+            rows = np.pad(rows, ((0, 0), (0, missing)), constant_values=-1)
+        return scores, rows
+
+    def _search_exact(self, snapshot: _Snapshot, queries: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        for start in range(0, snapshot.count, SEARCH_BLOCK_ROWS):
+            stop = min(start + SEARCH_BLOCK_ROWS, snapshot.count)
+            scores = queries @ np.asarray(snapshot.vectors[start:stop], dtype=np.float32).T
+            if snapshot.scales is not None:
+                scores *= snapshot.scales[start:stop]
+            scores[:, snapshot.deleted[start:stop]] = -np.inf
+            rows = np.broadcast_to(np.arange(start, stop), scores.shape)
+            best_scores, best_rows = top_k(np.concatenate([best_scores, scores], axis=1), np.concatenate([best_rows, rows], axis=1), k)
+        return self._pad(best_scores, best_rows, k)
+
+    def _search_ivf(self, snapshot: _Snapshot, query: np.ndarray, k: int, nprobe: int) -> tuple[np.ndarray, np.ndarray]:
+        probes = np.argpartition(-(snapshot.centroids @ query), nprobe - 1)[:nprobe]
+        rows = np.sort(np.concatenate([snapshot.list_rows[snapshot.list_offsets[p] : snapshot.list_offsets[p + 1]] for p in probes]))
+        rows = rows[~snapshot.deleted[rows]]
+        scores = snapshot.block(rows) @ query
+        best_scores, best_rows = self._pad(*top_k(scores[None, :], rows[None, :], k), k)
+        return best_scores[0], best_rows[0]
+
+    def _documents(self, rows: Iterable[int]) -> tuple[str, dict[int, Document]]:
+        """
+        行番号の世代と、その世代での行番号 -> ドキュメント を同じ読み取りトランザクションで返す
+        """
+        rows = [int(row) for row in rows if row >= 0]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                data_gen = self._conn.execute("SELECT value FROM meta WHERE key = 'data_gen'").fetchone()[0]
+                found = self._conn.execute(f"SELECT row, text, metadata FROM documents WHERE row IN ({','.join('?' * len(rows))})", rows).fetchall()
+            finally:
+                self._conn.execute("COMMIT")
+        return data_gen, {row: Document(page_content=text, metadata=json.loads(metadata)) for row, text, metadata in found}
+
+    def similarity_search_by_vector_with_score(self, embedding: list[float], k: int = 4) -> list[tuple[Document, float]]:
+        query = np.asarray([embedding], dtype=np.float32)
+        snapshot = self.snapshot()
+        for _ in range(LOAD_ATTEMPTS):
+            scores, rows = self._search(snapshot, query, k, None)
+            data_gen, documents = self._documents(rows[0])
+            if data_gen == snapshot.data_gen:
+                # 検索後に削除された行は除く
+                return [(documents[int(row)], float(score)) for score, row in zip(scores[0], rows[0]) if int(row) in documents]
+            # 検索に使った版の後にcompact()で行番号が詰め直された（別の文書を指す）ため、新しい版で検索し直す
+            snapshot = self.snapshot(force=True)
+        return []
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> list[tuple[Document, float]]:
+        if self.embedding is None:
+            raise ValueError("embedding is required to search by text")
+        return self.similarity_search_by_vector_with_score(self.embedding.embed_query(query), k)
+
+    def similarity_search_by_vector(self, embedding: list[float], k: int = 4, **kwargs: Any) -> list[Document]:
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k)]
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> list[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k)]
+
+    @classmethod
+    def from_texts(  # noqa: PLR0913
+        cls,
+        texts: list[str],
+        embedding: Embeddings,
+        metadatas: Optional[list[dict]] = None,
+        ids: Optional[list[str]] = None,
+        path: str = "vector_index",
+        **kwargs: Any,
+    ) -> "LocalVectorStore":
+        store = cls(path, embedding, **kwargs)
+        store.add_texts(texts, metadatas, ids=ids)
+        return store
+
+    def stats(self) -> dict:
+        snapshot = self.snapshot(force=True)
+        return {
+            "dtype": self.dtype,
+            "count": snapshot.count,
+            "live": int(snapshot.count - snapshot.deleted.sum()),
+            "dim": snapshot.dim,
+            "nlist": 0 if snapshot.centroids is None else len(snapshot.centroids),
+        }
+
+    def close(self):
+        self._snapshot = None
+        with self._lock:
+            self._conn.close()
+
+
+def main():
+    from app.core.config import get_settings
+
+    settings = get_settings()
+    parser = argparse.ArgumentParser(description="ローカルのベクトルストアの保守")
+    parser.add_argument("--path", default=settings.LOCAL_VECTORSTORE_PATH)
+    commands = parser.add_subparsers(dest="command", required=True)
+    train = commands.add_parser("train-ivf", help="IVFの分割を学習する")
+    train.add_argument("--nlist", type=int, required=True, help="分割数（目安は件数の平方根）")
+    train.add_argument("--iterations", type=int, default=10)
+    train.add_argument("--sample-size", type=int, default=None, help="学習に使う件数（既定はnlist*64）")
+    commands.add_parser("compact", help="削除済みの行を除いてファイルを書き直す")
+    commands.add_parser("stats", help="件数などを表示する")
+    args = parser.parse_args()
+
+    store = LocalVectorStore(args.path)
+    if args.command == "train-ivf":
+        store.train_ivf(args.nlist, iterations=args.iterations, sample_size=args.sample_size)
+    elif args.command == "compact":
+        store.compact()
+    print(json.dumps(store.stats(), ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+取り込み（add_document.py）のマニフェスト
+ファイルごとに内容のハッシュと登録済みのチャンクのIDをSQLiteに記録し、再実行時の差分だけを処理する
+- 内容が変わっていないファイルは解析もしない
+- 変わったファイルは新しく現れたチャンクだけを埋め込み・登録し、消えたチャンクのベクトルを削除する
+ファイルのハッシュは、そのファイルの新しいチャンクがすべて登録されてから記録する
+途中で止まっても登録済みのチャンクは記録されているため、次の実行では残りだけを処理する
+"""
+
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from collections.abc import Iterable
+
+
+def file_digest(path: str, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(chunk_size):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class DocumentManifest:
+    """
+    SQLite上の (ファイル, 内容のハッシュ) と (ファイル, チャンクのID) の記録
+    取り込みの段はスレッドで動くため同期APIでロックを取る
+    """
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, content_hash TEXT NOT NULL, indexed_at REAL NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS chunks (path TEXT NOT NULL, chunk_id TEXT NOT NULL, PRIMARY KEY (path, chunk_id))")
+        self._conn.commit()
+        # 登録待ちのチャンクがあるファイル: path -> (内容のハッシュ, 未登録のチャンクのID)
+        self._pending: dict[str, tuple[str, set]] = {}
+
+    def is_unchanged(self, path: str, content_hash: str) -> bool:
+        with self._lock:
+            row = self._conn.execute("SELECT content_hash FROM files WHERE path = ?", (path,)).fetchone()
+        return row is not None and row[0] == content_hash
+
+    def chunk_ids(self, path: str) -> set:
+        with self._lock:
+            return {row[0] for row in self._conn.execute("SELECT chunk_id FROM chunks WHERE path = ?", (path,))}
+
+    def paths(self) -> list[str]:
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT path FROM files ORDER BY path")]
+
+    def diff(self, path: str, ids: list[str]) -> tuple[list[str], list[str]]:
+        """
+        ファイルの新しいチャンクのID一覧を受け取り、(登録が必要なID, 削除すべきID) を返す
+        """
+        indexed = self.chunk_ids(path)
+        new = [chunk_id for chunk_id in dict.fromkeys(ids) if chunk_id not in indexed]
+        return new, sorted(indexed.difference(ids))
+
+    def begin(self, path: str, content_hash: str, new_ids: list[str]):
+        """
+        new_idsがすべて登録されたらファイルを登録済みとして記録する（空ならその場で記録する）
+        """
+        with self._lock:
+            if new_ids:
+                self._pending[path] = (content_hash, set(new_ids))
+                return
+            self._mark_indexed(path, content_hash)
+            self._conn.commit()
+
+    def remove_chunks(self, path: str, ids: Iterable[str]):
+        """
+        ベクトルストアから削除したチャンクの記録を消す
+        """
+        with self._lock:
+            self._conn.executemany("DELETE FROM chunks WHERE path = ? AND chunk_id = ?", ((path, chunk_id) for chunk_id in ids))
+            self._conn.commit()
+
+    def chunks_added(self, items: Iterable[tuple[str, str]]) -> list[str]:
+        """
+        ベクトルストアに登録した (ファイル, チャンクのID) を記録し、すべてのチャンクが登録済みになったファイルを返す
+        """
+        by_path: dict[str, list[str]] = defaultdict(list)
+        for path, chunk_id in items:
+            by_path[path].append(chunk_id)
+        completed = []
+        with self._lock:
+            for path, ids in by_path.items():
+                self._conn.executemany("INSERT OR IGNORE INTO chunks (path, chunk_id) VALUES (?, ?)", ((path, chunk_id) for chunk_id in ids))
+                pending = self._pending.get(path)
+                if pending is None:
+                    continue
+                pending[1].difference_update(ids)
+                if not pending[1]:
+                    self._mark_indexed(path, pending[0])
+                    del self._pending[path]
+                    completed.append(path)
+            self._conn.commit()
+        return completed
+
+    def forget(self, path: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM chunks WHERE path = ?", (path,))
+            self._conn.execute("DELETE FROM files WHERE path = ?", (path,))
+            self._conn.commit()
+
+    def _mark_indexed(self, path: str, content_hash: str):
+        self._conn.execute("INSERT OR REPLACE INTO files (path, content_hash, indexed_at) VALUES (?, ?, ?)", (path, content_hash, time.time()))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
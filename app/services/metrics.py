@@ -0,0 +1,265 @@
+"""
+Prometheusテキスト形式のメトリクス
+外部ライブラリに依存しない最小限のCounter / Gauge / Histogramと、HTTPリクエストを計測するASGIミドルウェア
+イベントループ上からのみ更新する前提のため、ロックは取らない
+"""
+
+import bisect
+import time
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Optional, TypeVar
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKENS_PER_SECOND_BUCKETS = (1, 5, 10, 20, 40, 60, 80, 100, 150, 200, 400)
+
+
+def _format_labels(labelnames: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def samples(self) -> Iterable[str]:
+        for key, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1.0, **labels: str):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str):
+        self._values[self._key(labels)] = value
+
+
+class CallbackMetric(Metric):
+    """
+    出力時にコールバックから値を取得するメトリクス（他モジュールが持つ統計値の公開用）
+    コールバックは {ラベル値のタプル: 値} を返す
+    """
+
+    def __init__(self, name: str, documentation: str, kind: str, callback: Callable[[], dict], labelnames: Iterable[str] = ()):  # noqa: PLR0913
+        super().__init__(name, documentation, labelnames)
+        self.kind = kind
+        self._callback = callback
+
+    def samples(self) -> Iterable[str]:
+        for key, value in self._callback().items():
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets: Iterable[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # ラベルごとに [バケットごとの件数（累積しない）..., 合計, 件数]
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            self._values[key] = state
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    def count(self, **labels: str) -> int:
+        state = self._values.get(self._key(labels))
+        return 0 if state is None else state[-1]
+
+    def samples(self) -> Iterable[str]:
+        for key, state in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, float("inf")), state[:-2]):
+                cumulative += bucket_count
+                le = 'le="' + _format_value(bound) + '"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(state[-2])}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {state[-1]}"
+
+
+M = TypeVar("M", bound=Metric)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: dict[str, Metric] = {}
+
+    def register(self, metric: M) -> M:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+registry = MetricsRegistry()
+
+HTTP_REQUEST_DURATION = registry.register(
+    Histogram("http_request_duration_seconds", "HTTP request latency until the last body byte is sent", ("endpoint", "method", "status"))
+)
+HTTP_TIME_TO_FIRST_BYTE = registry.register(
+    Histogram("http_time_to_first_byte_seconds", "Time until the first body byte is sent (handler + serialization)", ("endpoint", "method"))
+)
+HTTP_REQUESTS_IN_FLIGHT = registry.register(Gauge("http_requests_in_flight", "HTTP requests currently being processed"))
+STAGE_DURATION = registry.register(Histogram("app_stage_duration_seconds", "Time spent in each request stage", ("endpoint", "stage")))
+LLM_REQUEST_DURATION = registry.register(
+    Histogram("llm_request_duration_seconds", "Upstream LLM call latency (whole response or whole stream)", ("endpoint", "model", "kind"))
+)
+LLM_TTFT = registry.register(Histogram("llm_time_to_first_token_seconds", "Time to the first streamed token", ("endpoint", "model")))
+LLM_TOKENS_PER_SECOND = registry.register(
+    Histogram("llm_tokens_per_second", "Streaming generation speed after the first token", ("endpoint", "model"), buckets=TOKENS_PER_SECOND_BUCKETS)
+)
+LLM_PROMPT_TOKENS = registry.register(Counter("llm_prompt_tokens_total", "Prompt tokens sent upstream (estimated locally)", ("endpoint", "model")))
+LLM_COMPLETION_TOKENS = registry.register(Counter("llm_completion_tokens_total", "Completion tokens received", ("endpoint", "model")))
+LLM_ERRORS = registry.register(Counter("llm_errors_total", "Failed upstream LLM calls", ("endpoint", "model", "error")))
+LLM_STREAMS_IN_FLIGHT = registry.register(Gauge("llm_streams_in_flight", "Upstream LLM streams currently open", ("endpoint",)))
+LLM_STREAMS = registry.register(Counter("llm_streams_total", "Finished upstream LLM streams by outcome", ("endpoint", "outcome")))
+
+# 現在処理中のリクエストのASGI scope（ルーティング後にエンドポイントのパスを取り出す）
+_request_scope: ContextVar[Optional[dict]] = ContextVar("request_scope", default=None)
+
+
+def current_endpoint() -> str:
+    """
+    処理中のリクエストのルートのパス（例: /api/plan）。リクエスト外では "background"
+    """
+    scope = _request_scope.get()
+    if scope is None:
+        return "background"
+    route = scope.get("route")
+    return getattr(route, "path", "unmatched")
+
+
+class MetricsMiddleware:
+    """
+    リクエスト全体のレイテンシ、最初のバイトまでの時間、処理中のリクエスト数を記録するASGIミドルウェア
+    ストリーミング応答も最後のチャンクを送り終えるまでを計測する
+    """
+
+    def __init__(self, app, exclude_paths: Iterable[str] = ("/metrics",)):
+        self.app = app
+        self.exclude_paths = set(exclude_paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.exclude_paths:
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        token = _request_scope.set(scope)
+        state = {"status": 500, "first_byte": False}
+        HTTP_REQUESTS_IN_FLIGHT.inc()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                state["status"] = message["status"]
+            elif message["type"] == "http.response.body" and not state["first_byte"]:
+                state["first_byte"] = True
+                HTTP_TIME_TO_FIRST_BYTE.observe(time.perf_counter() - started, endpoint=current_endpoint(), method=scope["method"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_REQUESTS_IN_FLIGHT.dec()
+            HTTP_REQUEST_DURATION.observe(
+                time.perf_counter() - started, endpoint=current_endpoint(), method=scope["method"], status=str(state["status"])
+            )
+            _request_scope.reset(token)
+
+
+@contextmanager
+def observe_stage(stage: str) -> Iterator[None]:
+    """
+    with observe_stage("history"): ... でリクエスト内の処理段階の時間を記録する
+    段階: history（履歴の読み込み・圧縮） / prompt（プロンプトの組み立て） / upstream（非ストリーミングの上流の応答待ち）
+    / ttft・streaming（ストリームの最初のトークンまでとその後） / serialize（応答の整形）
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started)
+
+
+def record_stage(stage: str, seconds: float, endpoint: Optional[str] = None):
+    """
+    別々に測った時間の合計など、withで囲めない処理段階の時間を記録する
+    """
+    STAGE_DURATION.observe(seconds, endpoint=endpoint or current_endpoint(), stage=stage)
+
+
+class StageTimer:
+    """
+    ストリームのチャンクごとの整形など、細切れの処理時間を合計してから1回分として記録する
+    """
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.seconds = 0.0
+        self._endpoint = current_endpoint()
+
+    @contextmanager
+    def measure(self) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds += time.perf_counter() - started
+
+    def record(self):
+        record_stage(self.stage, self.seconds, self._endpoint)
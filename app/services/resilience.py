@@ -0,0 +1,285 @@
+"""
+短い非ストリーミング呼び出し（判定・PubMedクエリ）のテールレイテンシ対策
+- ヘッジ: 1本目が直近のレイテンシの百分位を超えても返らなければ同じリクエストをもう1本送り、先に返った方を使う
+- 再試行: 接続エラー・5xxは指数バックオフ（full jitter）で再試行する
+- サーキットブレーカー: 連続して失敗したモデルへの呼び出しを一定時間止め、上流を待たずにCircuitOpenErrorを返す
+"""
+
+import asyncio
+import math
+import random
+import time
+import weakref
+from collections import deque
+from collections.abc import Awaitable
+from dataclasses import dataclass, field
+from typing import Callable, Optional, TypeVar
+
+import openai
+
+from app.core.config import get_settings
+from app.services.metrics import CallbackMetric, Counter, Histogram, registry
+
+settings = get_settings()
+
+T = TypeVar("T")
+
+MIN_LATENCY_SAMPLES = 20  # これより少ない場合はLLM_HEDGE_DEFAULT_DELAYを使う
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+HEDGES = registry.register(Counter("llm_hedges_total", "Hedged requests fired and which attempt answered first", ("namespace", "outcome")))
+HEDGE_DELAY = registry.register(Histogram("llm_hedge_delay_seconds", "Wait before firing the hedged request", ("namespace",)))
+HEDGE_SAVED = registry.register(
+    Histogram(
+        "llm_hedge_saved_seconds",
+        "Estimated latency saved when the hedge answered first (mean recent latency above the elapsed time, minus the elapsed time)",
+        ("namespace",),
+    )
+)
+RETRIES = registry.register(Counter("llm_retries_total", "Retries after transient upstream errors", ("model", "error")))
+CIRCUIT_REJECTIONS = registry.register(Counter("llm_circuit_rejections_total", "Calls rejected because the circuit breaker was open", ("model",)))
+
+
+class CircuitOpenError(Exception):
+    """
+    サーキットブレーカーが開いているため上流を呼ばなかった（retry_afterは再試行までの秒数）
+    """
+
+    def __init__(self, model: str, retry_after: float):
+        self.model = model
+        self.retry_after = max(1, math.ceil(retry_after))
+        super().__init__(f"LLM upstream for {model} is failing, retry after {self.retry_after}s")
+
+
+def is_transient(error: BaseException) -> bool:
+    """
+    再試行で回復しうるエラーか（接続エラー・タイムアウトを含む接続系と5xx）
+    """
+    return isinstance(error, (openai.APIConnectionError, openai.InternalServerError))
+
+
+def backoff_delay(attempt: int, base_delay: float, max_delay: float, rng: Optional[random.Random] = None) -> float:
+    """
+    attempt回目（0始まり）の再試行までの待ち時間。0〜min(max_delay, base*2^attempt)の一様乱数 (full jitter)
+    """
+    uniform = rng.uniform if rng is not None else random.uniform
+    return uniform(0, min(max_delay, base_delay * 2**attempt))
+
+
+class LatencyTracker:
+    """
+    直近の呼び出しのレイテンシ（秒）を保持し、百分位を返す
+    """
+
+    def __init__(self, window: int):
+        self._samples: deque = deque(maxlen=window)
+
+    def observe(self, latency: float):
+        self._samples.append(latency)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if len(self._samples) < MIN_LATENCY_SAMPLES:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))]
+
+    def mean_above(self, threshold: float) -> Optional[float]:
+        # threshold秒を超えた呼び出しの平均レイテンシ（該当がなければNone）
+        slow = [latency for latency in self._samples if latency > threshold]
+        return sum(slow) / len(slow) if slow else None
+
+
+class CircuitBreaker:
+    """
+    closed: 通常 / open: reset_timeoutの間すべて拒否 / half_open: 試行を1件だけ通し、成功すればclosedに戻す
+    """
+
+    def __init__(self, model: str, failure_threshold: int, reset_timeout: float):
+        self.model = model
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+
+    def before_call(self):
+        if self.state == OPEN:
+            remaining = self._opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0:
+                CIRCUIT_REJECTIONS.inc(model=self.model)
+                raise CircuitOpenError(self.model, remaining)
+            self.state = HALF_OPEN
+            self._trial_in_flight = False
+        if self.state == HALF_OPEN:
+            if self._trial_in_flight:
+                CIRCUIT_REJECTIONS.inc(model=self.model)
+                raise CircuitOpenError(self.model, self.reset_timeout)
+            self._trial_in_flight = True
+
+    def record_success(self):
+        self.state = CLOSED
+        self.failures = 0
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = OPEN
+            self._opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+    def record_cancel(self):
+        # 結果が出る前にキャンセルされた試行は成功とも失敗とも数えない
+        self._trial_in_flight = False
+
+
+async def hedge(fn: Callable[[], Awaitable[T]], delay: Optional[float], can_hedge: Callable[[], bool] = lambda: True) -> tuple[T, str]:
+    """
+    fnを呼び、delay秒以内に返らなければもう1本呼んで先に成功した方の結果を返す（もう一方はキャンセルする）
+    片方が失敗した場合はもう一方を待ち、両方失敗した場合は1本目のエラーを送出する
+    戻り値は (結果, "primary" / "hedge")
+    """
+    primary = asyncio.ensure_future(fn())
+    attempts = {primary: "primary"}
+    try:
+        if delay is not None:
+            await asyncio.wait({primary}, timeout=delay)
+        if delay is None or primary.done() or not can_hedge():
+            return await primary, "primary"
+
+        attempts[asyncio.ensure_future(fn())] = "hedge"
+        pending = set(attempts)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result(), attempts[task]
+        return primary.result(), "primary"
+    finally:
+        for task in attempts:
+            if not task.done():
+                task.cancel()
+
+
+@dataclass
+class _LoopState:
+    breakers: dict = field(default_factory=dict)
+    latencies: dict = field(default_factory=dict)
+
+
+class ResiliencePolicy:
+    """
+    モデルごとのサーキットブレーカーと、呼び出しの種類ごとのレイテンシを保持して呼び出しを実行する
+    状態はイベントループごとに分ける（終了したループのブレーカーの状態を引き継がない）
+    """
+
+    def __init__(self):
+        self._states: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, _LoopState] = weakref.WeakKeyDictionary()
+
+    def _state(self) -> _LoopState:
+        return self._states.setdefault(asyncio.get_running_loop(), _LoopState())
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        breakers = self._state().breakers
+        if model not in breakers:
+            breakers[model] = CircuitBreaker(model, settings.LLM_BREAKER_FAILURE_THRESHOLD, settings.LLM_BREAKER_RESET_TIMEOUT)
+        return breakers[model]
+
+    def latency(self, namespace: str) -> LatencyTracker:
+        latencies = self._state().latencies
+        if namespace not in latencies:
+            latencies[namespace] = LatencyTracker(settings.LLM_HEDGE_WINDOW)
+        return latencies[namespace]
+
+    def hedge_delay(self, namespace: str) -> float:
+        observed = self.latency(namespace).percentile(settings.LLM_HEDGE_PERCENTILE)
+        return max(settings.LLM_HEDGE_DEFAULT_DELAY if observed is None else observed, settings.LLM_HEDGE_MIN_DELAY)
+
+    async def call(  # noqa: PLR0913
+        self,
+        model: str,
+        namespace: str,
+        fn: Callable[[], Awaitable[T]],
+        hedged: bool = False,
+        can_hedge: Callable[[], bool] = lambda: True,
+    ) -> T:
+        """
+        LLM_RESILIENCE_ENABLED時は一時的なエラーを再試行し、失敗をサーキットブレーカーに記録する
+        hedgedかつLLM_HEDGING_ENABLED時は各試行をヘッジする
+        """
+        tracker = self.latency(namespace)
+
+        async def attempt() -> T:
+            # キャンセルされた試行は含めず、返ってきた試行のレイテンシだけを記録する
+            started = time.perf_counter()
+            result = await fn()
+            tracker.observe(time.perf_counter() - started)
+            return result
+
+        if not settings.LLM_RESILIENCE_ENABLED:
+            return await self._hedged(namespace, attempt, hedged, can_hedge)
+
+        breaker = self.breaker(model)
+        for retry in range(settings.LLM_RETRY_ATTEMPTS + 1):
+            breaker.before_call()
+            try:
+                result = await self._hedged(namespace, attempt, hedged, can_hedge)
+            except (openai.APIConnectionError, openai.InternalServerError, asyncio.TimeoutError) as e:
+                breaker.record_failure()
+                if not is_transient(e) or retry == settings.LLM_RETRY_ATTEMPTS or breaker.state == OPEN:
+                    raise
+                RETRIES.inc(model=model, error=type(e).__name__)
+                await asyncio.sleep(backoff_delay(retry, settings.LLM_RETRY_BASE_DELAY, settings.LLM_RETRY_MAX_DELAY))
+                continue
+            except BaseException:
+                # キャンセルや上流の障害ではない失敗（流量制御での拒否、4xxなど）はブレーカーに数えない
+                breaker.record_cancel()
+                raise
+            breaker.record_success()
+            return result
+        raise AssertionError("unreachable")
+
+    async def _hedged(self, namespace: str, fn: Callable[[], Awaitable[T]], hedged: bool, can_hedge: Callable[[], bool]) -> T:
+        if not (hedged and settings.LLM_HEDGING_ENABLED):
+            return await fn()
+        delay = self.hedge_delay(namespace)
+        started = time.perf_counter()
+        fired = False
+
+        def fire() -> bool:
+            nonlocal fired
+            fired = can_hedge()
+            if fired:
+                HEDGES.inc(namespace=namespace, outcome="fired")
+                HEDGE_DELAY.observe(delay, namespace=namespace)
+            return fired
+
+        result, winner = await hedge(fn, delay, fire)
+        if fired:
+            HEDGES.inc(namespace=namespace, outcome="won" if winner == "hedge" else "lost")
+        if winner == "hedge":
+            # 1本目はまだ返っていないため、直近でこの経過時間を超えた呼び出しの平均までかかったとみなす
+            elapsed = time.perf_counter() - started
+            expected = self.latency(namespace).mean_above(elapsed)
+            if expected is not None:
+                HEDGE_SAVED.observe(expected - elapsed, namespace=namespace)
+        return result
+
+    def states(self) -> dict:
+        values = {}
+        for loop_state in list(self._states.values()):
+            for breaker in loop_state.breakers.values():
+                values[(breaker.model,)] = _STATE_VALUES[breaker.state]
+        return values
+
+
+resilience = ResiliencePolicy()
+
+registry.register(
+    CallbackMetric("llm_circuit_state", "Circuit breaker state per model (0=closed, 1=half_open, 2=open)", "gauge", resilience.states, ("model",))
+)
@@ -0,0 +1,336 @@
+"""
+判定・PubMedクエリなど決定的なLLM呼び出しの応答キャッシュ
+バックエンドはメモリ / SQLite / Redisプロトコルから選択する
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+from urllib.parse import urlparse
+
+from app.core.config import get_settings
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+
+class CacheBackend:
+    """
+    キャッシュバックエンドの共通インターフェース
+    """
+
+    async def get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    async def set(self, key: str, value: str, ttl: float):
+        raise NotImplementedError
+
+    async def clear(self):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class MemoryBackend(CacheBackend):
+    """
+    プロセス内のLRU + TTLキャッシュ
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+
+    async def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: str, ttl: float):
+        self._entries[key] = (time.time() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def clear(self):
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SQLiteBackend(CacheBackend):
+    """
+    ディスク上のSQLiteによるLRU + TTLキャッシュ（プロセス再起動後も保持される）
+    """
+
+    def __init__(self, path: str, max_entries: int):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS response_cache_accessed_at ON response_cache (accessed_at)")
+        self._conn.commit()
+
+    def _get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, expires_at FROM response_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] <= now:
+                self._conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            self._conn.execute("UPDATE response_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            return row[0]
+
+    def _set(self, key: str, value: str, ttl: float):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, now + ttl, now),
+            )
+            # 期限切れを掃除し、上限を超えた分は最も古くアクセスされたものから削除
+            self._conn.execute("DELETE FROM response_cache WHERE expires_at <= ?", (now,))
+            self._conn.execute(
+                "DELETE FROM response_cache WHERE key IN (SELECT key FROM response_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._conn.commit()
+
+    def _clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM response_cache")
+            self._conn.commit()
+
+    async def get(self, key: str) -> Optional[str]:
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, value: str, ttl: float):
+        await asyncio.to_thread(self._set, key, value, ttl)
+
+    async def clear(self):
+        await asyncio.to_thread(self._clear)
+
+    async def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class RedisBackend(CacheBackend):
+    """
+    Redisプロトコル (RESP) を話すサーバーへのキャッシュ
+    TTLはPXで指定し、件数上限はサーバー側のmaxmemory-policy (allkeys-lru) に任せる
+    """
+
+    def __init__(self, url: str, prefix: str = "response_cache:"):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.password = parsed.password
+        self.prefix = prefix
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._lock = asyncio.Lock()
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            await self._send("AUTH", self.password)
+        if self.db:
+            await self._send("SELECT", str(self.db))
+
+    async def _send(self, *args: str):
+        assert self._writer is not None
+        payload = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg.encode("utf-8")
+            payload.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        self._writer.write(b"".join(payload))
+        await self._writer.drain()
+        return await self._read_reply()
+
+    async def _read_reply(self):
+        assert self._reader is not None
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError("Redis connection closed")
+        kind, body = line[:1], line[1:-2]
+        if kind == b"+":
+            return body.decode()
+        if kind == b"-":
+            raise RuntimeError(body.decode())
+        if kind == b":":
+            return int(body)
+        if kind == b"$":
+            length = int(body)
+            if length < 0:
+                return None
+            data = await self._reader.readexactly(length + 2)
+            return data[:-2].decode("utf-8")
+        if kind == b"*":
+            length = int(body)
+            if length < 0:
+                return None
+            return [await self._read_reply() for _ in range(length)]
+        raise RuntimeError(f"Unexpected Redis reply: {line!r}")
+
+    async def _command(self, *args: str):
+        async with self._lock:
+            try:
+                if self._writer is None:
+                    await self._connect()
+                try:
+                    return await self._send(*args)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    # 切断されていた場合は一度だけ再接続する
+                    await self.close()
+                    await self._connect()
+                    return await self._send(*args)
+            except BaseException:
+                # 送信後に応答を読む前にキャンセルされた場合などは応答がソケットに残り、
+                # 次のコマンドが前のコマンドの応答を読んでしまうため、失敗時は常に接続を捨てる
+                await self.close()
+                raise
+
+    async def get(self, key: str) -> Optional[str]:
+        return await self._command("GET", self.prefix + key)
+
+    async def set(self, key: str, value: str, ttl: float):
+        await self._command("SET", self.prefix + key, value, "PX", str(int(ttl * 1000)))
+
+    async def clear(self):
+        # KEYSは共有のRedisを止めるため、SCANのカーソルで少しずつ消す
+        cursor = "0"
+        while True:
+            cursor, keys = await self._command("SCAN", cursor, "MATCH", self.prefix + "*", "COUNT", "1000")
+            if keys:
+                await self._command("DEL", *keys)
+            if cursor == "0":
+                break
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._reader = self._writer = None
+
+
+class ResponseCache:
+    """
+    正規化したリクエストのハッシュをキーに応答文字列をキャッシュする
+    バックエンドの障害時はキャッシュなしとして動作する
+    """
+
+    def __init__(self, backend: CacheBackend, ttl: float, max_value_bytes: int):
+        self.backend = backend
+        self.ttl = ttl
+        self.max_value_bytes = max_value_bytes
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    @staticmethod
+    def make_key(endpoint: str, prompt_version: str, model_name: str, temperature: float, messages: list) -> str:
+        canonical = json.dumps(
+            {
+                "endpoint": endpoint,
+                "prompt_version": prompt_version,
+                "model": model_name,
+                "temperature": float(temperature),
+                "messages": [{"role": msg["role"], "content": msg["content"]} for msg in messages],
+            },
+            ensure_ascii=False,
+            sort_keys=True,
+            separators=(",", ":"),
+        )
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    async def get(self, key: str) -> Optional[str]:
+        try:
+            value = await self.backend.get(key)
+        except Exception as e:
+            self.errors += 1
+            logger.warning("Response cache get failed: %s", e)
+            return None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key: str, value: str):
+        if len(value.encode("utf-8")) > self.max_value_bytes:
+            return
+        try:
+            await self.backend.set(key, value, self.ttl)
+        except Exception as e:
+            self.errors += 1
+            logger.warning("Response cache set failed: %s", e)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    async def close(self):
+        await self.backend.close()
+
+
+_response_cache: dict[str, ResponseCache] = {}
+
+
+def create_backend(name: str) -> CacheBackend:
+    if name == "memory":
+        return MemoryBackend(max_entries=settings.RESPONSE_CACHE_MAX_ENTRIES)
+    if name == "sqlite":
+        return SQLiteBackend(settings.RESPONSE_CACHE_SQLITE_PATH, max_entries=settings.RESPONSE_CACHE_MAX_ENTRIES)
+    if name == "redis":
+        return RedisBackend(settings.RESPONSE_CACHE_REDIS_URL)
+    raise ValueError(f"Unknown response cache backend: {name}")
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """
+    設定で有効化されている場合のみ共有キャッシュを返す
+    """
+    if not settings.RESPONSE_CACHE_ENABLED:
+        return None
+    cache = _response_cache.get("default")
+    if cache is None:
+        cache = ResponseCache(
+            create_backend(settings.RESPONSE_CACHE_BACKEND),
+            ttl=settings.RESPONSE_CACHE_TTL,
+            max_value_bytes=settings.RESPONSE_CACHE_MAX_VALUE_BYTES,
+        )
+        _response_cache["default"] = cache
+    return cache
+
+
+async def close_response_cache():
+    cache = _response_cache.pop("default", None)
+    if cache is not None:
+        await cache.close()
@@ -0,0 +1,156 @@
+"""
+RAGの検索（Streamlitのapp.py）で使うキャッシュとハイブリッド検索
+- クエリの埋め込み: 正規化したクエリ文字列をキーにしたLRU
+- 検索結果: (正規化したクエリ, k) をキーにしたTTL付きLRU
+- ハイブリッド検索: ベクトル検索と語彙インデックス（BM25）の結果を逆順位融合（RRF）で並べ替える
+Streamlitはスクリプトを複数のスレッドで実行するため、いずれもスレッドセーフにする
+"""
+
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Generic, Optional, TypeVar
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+V = TypeVar("V")
+
+
+def normalize_query(text: str) -> str:
+    # 全角・半角の違いと前後・連続する空白をならす（意味が変わりうる大文字・小文字はそのまま）
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+class TTLCache(Generic[V]):
+    """
+    スレッドセーフなLRU + TTLキャッシュ（ttlがNoneなら期限なし）
+    """
+
+    def __init__(self, max_entries: int, ttl: Optional[float] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Any, tuple[float, V]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Any) -> Optional[V]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (self.ttl is not None and entry[0] + self.ttl <= time.monotonic()):
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Any, value: V):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class CachedQueryEmbeddings(Embeddings):
+    """
+    埋め込みモデルのラッパー。同じクエリ（正規化後）の埋め込みは再計算しない
+    文書の埋め込み（登録時）はキャッシュせずそのまま委譲する
+    """
+
+    def __init__(self, embeddings: Embeddings, max_entries: int = 1024):
+        self.embeddings = embeddings
+        self.cache: TTLCache[list[float]] = TTLCache(max_entries)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        key = normalize_query(text)
+        vector = self.cache.get(key)
+        if vector is None:
+            vector = self.embeddings.embed_query(key)
+            self.cache.set(key, vector)
+        return vector
+
+
+class CachedRetriever:
+    """
+    ベクトルストアのsimilarity_search_with_scoreの結果をttl秒キャッシュする
+    インデックスを更新した直後はclear()で捨てるか、ttlの経過を待つ
+    """
+
+    def __init__(self, vectorstore: Any, max_entries: int = 1024, ttl: float = 300.0):
+        self.vectorstore = vectorstore
+        self.cache: TTLCache[list] = TTLCache(max_entries, ttl)
+
+    def search(self, query: str, k: int = 4) -> list:
+        key = (normalize_query(query), k)
+        results = self.cache.get(key)
+        if results is None:
+            results = self.vectorstore.similarity_search_with_score(key[0], k=k)
+            self.cache.set(key, results)
+        return results
+
+    def clear(self):
+        self.cache.clear()
+
+
+def reciprocal_rank_fusion(rankings: list[list[Any]], k: int = 60) -> list[tuple[Any, float]]:
+    """
+    各ランキングでの順位rに1/(k+r)を足し合わせたスコアの大きい順に (キー, スコア) を返す
+    スコアの尺度が違う検索（コサイン類似度とBM25）を順位だけで組み合わせられる
+    """
+    scores: dict[Any, float] = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+def _document_key(document: Document) -> str:
+    # 取り込み時に付けたチャンクのIDで突き合わせる（IDのない古いチャンクは本文で）
+    return document.metadata.get("chunk_id") or document.page_content
+
+
+class HybridRetriever:
+    """
+    ベクトル検索と語彙インデックスの上位candidates件ずつをRRFで融合する
+    薬剤名・遺伝子記号・PMIDなど語として一致するチャンクを拾い、両方で上位のチャンクを優先する
+    similarity_search_with_scoreを持つため、ベクトルストアの代わりにCachedRetrieverに渡せる（スコアはRRFのスコア）
+    """
+
+    def __init__(self, vectorstore: Any, lexical_index: Any, candidates: int = 20, rrf_k: int = 60):
+        self.vectorstore = vectorstore
+        self.lexical_index = lexical_index
+        self.candidates = candidates
+        self.rrf_k = rrf_k
+        # ベクトル検索（ネットワーク待ち）の間に語彙インデックスを引く
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="lexical-search")
+
+    def similarity_search_with_score(self, query: str, k: int = 4) -> list[tuple[Document, float]]:
+        lexical_future = self._executor.submit(self.lexical_index.search, query, self.candidates)
+        vector_hits = self.vectorstore.similarity_search_with_score(query, k=self.candidates)
+        lexical_hits = lexical_future.result()
+
+        documents: dict[str, Document] = {}
+        for document, _ in vector_hits:
+            documents.setdefault(_document_key(document), document)
+        for chunk_id, _, document in lexical_hits:
+            documents.setdefault(chunk_id, document)
+        fused = reciprocal_rank_fusion(
+            [[_document_key(document) for document, _ in vector_hits], [chunk_id for chunk_id, _, _ in lexical_hits]], self.rrf_k
+        )
+        return [(documents[key], score) for key, score in fused[:k]]
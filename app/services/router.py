@@ -0,0 +1,152 @@
+"""
+エンドポイントごとのモデルのルーティング
+MODEL_ROUTESの候補を先頭から順に、直近のエラー率・レイテンシが基準内のモデルを選ぶ
+呼び出しが一時的なエラーで失敗した場合は、同じリクエストを次の候補のモデルで再実行する
+"""
+
+import asyncio
+import time
+from collections import deque
+from collections.abc import Awaitable
+from typing import Callable, Optional, TypeVar
+
+import openai
+
+from app.core.config import get_settings
+from app.services.admission import AdmissionRejectedError
+from app.services.metrics import CallbackMetric, Counter, registry
+from app.services.resilience import CircuitOpenError
+
+settings = get_settings()
+
+T = TypeVar("T")
+
+ROUTE_ASSISTANT = "assistant"
+ROUTE_JUDGE = "judge"
+ROUTE_PUBMED_QUERY = "pubmed_query"
+
+# 次の候補のモデルで再実行するエラー（上流の障害・タイムアウト・レート制限）
+FAILOVER_ERRORS = (openai.APIConnectionError, openai.InternalServerError, asyncio.TimeoutError, AdmissionRejectedError, CircuitOpenError)
+
+ROUTE_DECISIONS = registry.register(
+    Counter(
+        "llm_route_decisions_total",
+        "Model chosen per route (primary, fallback = primary unhealthy, failover = retried after an error)",
+        ("route", "model", "reason"),
+    )
+)
+
+
+class ModelHealth:
+    """
+    1ルート・1モデル分の直近window秒の呼び出し結果（レイテンシと成否）
+    """
+
+    def __init__(self, window: float):
+        self.window = window
+        self._samples: deque = deque()  # (時刻, レイテンシ, 成功したか)
+
+    def record(self, latency: Optional[float], ok: bool):
+        self._samples.append((time.monotonic(), latency, ok))
+        self._prune()
+
+    def _prune(self):
+        cutoff = time.monotonic() - self.window
+        while self._samples and self._samples[0][0] < cutoff:
+            self._samples.popleft()
+
+    def __len__(self) -> int:
+        self._prune()
+        return len(self._samples)
+
+    def error_rate(self) -> float:
+        self._prune()
+        if not self._samples:
+            return 0.0
+        return sum(1 for _, _, ok in self._samples if not ok) / len(self._samples)
+
+    def latency_percentile(self, q: float) -> Optional[float]:
+        self._prune()
+        latencies = sorted(latency for _, latency, ok in self._samples if ok and latency is not None)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * q / 100))]
+
+
+class ModelRouter:
+    def __init__(self):
+        self._health: dict[tuple[str, str], ModelHealth] = {}
+
+    def candidates(self, route: str) -> list[str]:
+        return settings.MODEL_ROUTES.get(route) or [settings.MODEL_NAME]
+
+    def health(self, route: str, model: str) -> ModelHealth:
+        key = (route, model)
+        if key not in self._health:
+            self._health[key] = ModelHealth(settings.MODEL_ROUTER_WINDOW)
+        return self._health[key]
+
+    def is_healthy(self, route: str, model: str) -> bool:
+        health = self.health(route, model)
+        if len(health) < settings.MODEL_ROUTER_MIN_SAMPLES:
+            return True
+        if health.error_rate() > settings.MODEL_ROUTER_MAX_ERROR_RATE:
+            return False
+        max_latency = settings.MODEL_ROUTER_MAX_LATENCY.get(route)
+        latency = health.latency_percentile(settings.MODEL_ROUTER_LATENCY_PERCENTILE)
+        return max_latency is None or latency is None or latency <= max_latency
+
+    def choose(self, route: str, exclude: tuple = ()) -> str:
+        """
+        候補のうち正常な最初のモデルを返す（すべて不調なら優先順位が最も高いモデル）
+        不調なモデルの記録はwindow秒で消えるため、時間が経てば優先のモデルに戻る
+        """
+        candidates = [model for model in self.candidates(route) if model not in exclude] or self.candidates(route)
+        model = next((model for model in candidates if self.is_healthy(route, model)), candidates[0])
+        reason = "failover" if exclude else ("primary" if model == self.candidates(route)[0] else "fallback")
+        ROUTE_DECISIONS.inc(route=route, model=model, reason=reason)
+        return model
+
+    def record(self, route: str, model: str, latency: Optional[float], ok: bool):
+        self.health(route, model).record(latency, ok)
+
+    async def call(self, route: str, fn: Callable[[str], Awaitable[T]]) -> T:
+        """
+        選んだモデルでfn(model)を呼び、一時的なエラーの場合はまだ試していない候補で再実行する
+        """
+        tried: tuple = ()
+        while True:
+            model = self.choose(route, exclude=tried)
+            tried = (*tried, model)
+            started = time.perf_counter()
+            try:
+                result = await fn(model)
+            except FAILOVER_ERRORS:
+                self.record(route, model, None, ok=False)
+                if len(tried) >= len(self.candidates(route)):
+                    raise
+                continue
+            self.record(route, model, time.perf_counter() - started, ok=True)
+            return result
+
+    def stats(self) -> dict:
+        values: dict[tuple, float] = {}
+        for (route, model), health in list(self._health.items()):
+            values[(route, model, "error_rate")] = health.error_rate()
+            latency = health.latency_percentile(settings.MODEL_ROUTER_LATENCY_PERCENTILE)
+            if latency is not None:
+                values[(route, model, "latency")] = latency
+        return values
+
+
+model_router = ModelRouter()
+
+registry.register(
+    CallbackMetric(
+        "llm_route_model_health",
+        "Rolling error rate and latency percentile (seconds, TTFT for streams) per route and model",
+        "gauge",
+        model_router.stats,
+        ("route", "model", "stat"),
+    )
+)
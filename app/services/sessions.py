@@ -0,0 +1,209 @@
+"""
+サーバー側の会話セッション
+session_idを指定したクライアントはnew_messageだけを送り、履歴はサーバーで保持する
+"""
+
+import asyncio
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional
+
+from langchain.schema.messages import BaseMessage
+
+from app.core.config import get_settings
+from app.services.llm_service import to_langchain_messages
+
+settings = get_settings()
+
+
+@dataclass
+class Session:
+    session_id: str
+    messages: list = field(default_factory=list)  # role/contentの辞書
+    langchain_messages: list[BaseMessage] = field(default_factory=list)  # 変換済みのメッセージ（ターン間で再利用する）
+    updated_at: float = field(default_factory=time.time)
+
+    def extend(self, messages: list):
+        self.messages.extend(messages)
+        self.langchain_messages.extend(to_langchain_messages(messages))
+        self.updated_at = time.time()
+
+
+class SessionStore:
+    """
+    プロセス内のLRU + TTLでセッションを保持する
+    """
+
+    def __init__(self, max_sessions: int, ttl: float):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions: OrderedDict[str, Session] = OrderedDict()
+
+    def _get_cached(self, session_id: str) -> Optional[Session]:
+        session = self._sessions.get(session_id)
+        if session is None:
+            return None
+        if session.updated_at + self.ttl <= time.time():
+            del self._sessions[session_id]
+            return None
+        self._sessions.move_to_end(session_id)
+        return session
+
+    def _put_cached(self, session: Session):
+        self._sessions[session.session_id] = session
+        self._sessions.move_to_end(session.session_id)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    async def get(self, session_id: str) -> Optional[Session]:
+        return self._get_cached(session_id)
+
+    async def create(self, session_id: Optional[str] = None) -> Session:
+        session = Session(session_id=session_id or uuid.uuid4().hex)
+        self._put_cached(session)
+        return session
+
+    async def append(self, session: Session, messages: list):
+        session.extend(messages)
+        self._put_cached(session)
+
+    async def delete(self, session_id: str) -> bool:
+        return self._sessions.pop(session_id, None) is not None
+
+    async def close(self):
+        pass
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    SQLiteに永続化するセッションストア
+    最近使ったセッションはメモリ上にも保持し、変換済みのメッセージを再利用する
+    """
+
+    def __init__(self, path: str, max_sessions: int, ttl: float, cache_size: int):
+        super().__init__(max_sessions=cache_size, ttl=ttl)
+        self.max_persisted_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, updated_at REAL NOT NULL)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS session_messages "
+            "(session_id TEXT NOT NULL, seq INTEGER NOT NULL, role TEXT NOT NULL, content TEXT NOT NULL, PRIMARY KEY (session_id, seq))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)")
+        self._conn.commit()
+
+    def _load(self, session_id: str) -> Optional[Session]:
+        with self._lock:
+            row = self._conn.execute("SELECT updated_at FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+            if row is None or row[0] + self.ttl <= time.time():
+                return None
+            rows = self._conn.execute("SELECT role, content FROM session_messages WHERE session_id = ? ORDER BY seq", (session_id,)).fetchall()
+        session = Session(session_id=session_id, updated_at=row[0])
+        session.extend([{"role": role, "content": content} for role, content in rows])
+        return session
+
+    def _save(self, session_id: str, start: int, messages: list, updated_at: float):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO sessions (session_id, updated_at) VALUES (?, ?)", (session_id, updated_at))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO session_messages (session_id, seq, role, content) VALUES (?, ?, ?, ?)",
+                [(session_id, start + index, msg["role"], msg["content"]) for index, msg in enumerate(messages)],
+            )
+            # 期限切れと上限を超えた古いセッションを削除する
+            stale = self._conn.execute(
+                "SELECT session_id FROM sessions WHERE updated_at <= ? "
+                "UNION SELECT session_id FROM (SELECT session_id FROM sessions ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+                (updated_at - self.ttl, self.max_persisted_sessions),
+            ).fetchall()
+            self._conn.executemany("DELETE FROM sessions WHERE session_id = ?", stale)
+            self._conn.executemany("DELETE FROM session_messages WHERE session_id = ?", stale)
+            self._conn.commit()
+
+    def _delete(self, session_id: str) -> bool:
+        with self._lock:
+            deleted = self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,)).rowcount
+            self._conn.execute("DELETE FROM session_messages WHERE session_id = ?", (session_id,))
+            self._conn.commit()
+        return deleted > 0
+
+    async def get(self, session_id: str) -> Optional[Session]:
+        session = self._get_cached(session_id)
+        if session is None:
+            session = await asyncio.to_thread(self._load, session_id)
+            if session is not None:
+                self._put_cached(session)
+        return session
+
+    async def create(self, session_id: Optional[str] = None) -> Session:
+        session = await super().create(session_id)
+        await asyncio.to_thread(self._save, session.session_id, 0, [], session.updated_at)
+        return session
+
+    async def append(self, session: Session, messages: list):
+        # 連番はメモリ上の追加と同時に確定させ、並行する追記と衝突しないようにする
+        start = len(session.messages)
+        await super().append(session, messages)
+        await asyncio.to_thread(self._save, session.session_id, start, messages, session.updated_at)
+
+    async def delete(self, session_id: str) -> bool:
+        in_memory = await super().delete(session_id)
+        return await asyncio.to_thread(self._delete, session_id) or in_memory
+
+    async def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_session_store: dict[str, SessionStore] = {}
+
+
+def create_session_store(name: str) -> SessionStore:
+    if name == "memory":
+        return SessionStore(max_sessions=settings.SESSION_MAX_SESSIONS, ttl=settings.SESSION_TTL)
+    if name == "sqlite":
+        return SQLiteSessionStore(
+            settings.SESSION_SQLITE_PATH, max_sessions=settings.SESSION_MAX_SESSIONS, ttl=settings.SESSION_TTL, cache_size=settings.SESSION_CACHE_SIZE
+        )
+    raise ValueError(f"Unknown session backend: {name}")
+
+
+def get_session_store() -> SessionStore:
+    store = _session_store.get("default")
+    if store is None:
+        store = create_session_store(settings.SESSION_BACKEND)
+        _session_store["default"] = store
+    return store
+
+
+async def close_session_store():
+    store = _session_store.pop("default", None)
+    if store is not None:
+        await store.close()
+
+
+async def load_conversation(session_id: Optional[str], message_log: list, new_message: str) -> tuple[Optional[Session], list]:
+    """
+    会話履歴（末尾にnew_messageを追加したもの）を返す
+    session_idがあればサーバー側の履歴を使い、未知のsession_idならmessage_logを初期履歴としてセッションを作る
+    """
+    new_turn = {"role": "user", "content": new_message}
+    log = [{"role": msg.role, "content": msg.content} for msg in message_log]
+    if session_id is None:
+        return None, [*log, new_turn]
+
+    store = get_session_store()
+    session = await store.get(session_id)
+    if session is None:
+        session = await store.create(session_id)
+        if log:
+            await store.append(session, log)
+    return session, [*session.messages, new_turn]
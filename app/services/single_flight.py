@@ -0,0 +1,181 @@
+"""
+同一リクエストの実行中LLM呼び出しをまとめる (single-flight)
+非ストリーミング呼び出しは結果を共有し、ストリーミング呼び出しは途中から参加したクライアントに
+それまでの出力を再送してから以降の出力を配信する
+"""
+
+import asyncio
+from collections.abc import AsyncIterator, Awaitable
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+@dataclass
+class _Call:
+    task: asyncio.Task
+    waiters: int = 0
+
+
+class SingleFlight:
+    """
+    同じキーで実行中の呼び出しがあれば、新たに実行せずその結果を待つ
+    待っている呼び出し元が全員キャンセルされた場合のみ上流の呼び出しもキャンセルする
+    """
+
+    def __init__(self):
+        self._calls: dict[tuple[int, str], _Call] = {}
+        self.leaders = 0  # 実際に上流を呼び出した回数
+        self.shared = 0  # 実行中の呼び出しに相乗りした回数
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        # イベントループごとに分ける（別ループのタスクは待てないため）
+        call_key = (id(asyncio.get_running_loop()), key)
+        call = self._calls.get(call_key)
+        if call is None:
+            call = _Call(task=asyncio.ensure_future(fn()))
+            self._calls[call_key] = call
+            call.task.add_done_callback(lambda _: self._forget(call_key, call))
+            self.leaders += 1
+        else:
+            self.shared += 1
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                call.task.cancel()
+
+    def _forget(self, call_key: tuple[int, str], call: _Call):
+        if self._calls.get(call_key) is call:
+            del self._calls[call_key]
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+
+@dataclass
+class _Broadcast:
+    chunks: list = field(default_factory=list)
+    context: dict = field(default_factory=dict)  # 配信元が共有したい値（計測値など）
+    outcome: Optional[str] = None  # completed / aborted / error
+    error: Optional[BaseException] = None
+    subscribers: int = 0
+    task: Optional[asyncio.Task] = None
+    changed: asyncio.Event = field(default_factory=asyncio.Event)
+
+    def publish(self, chunk: Any):
+        self.chunks.append(chunk)
+        self._notify()
+
+    def finish(self, outcome: str, error: Optional[BaseException] = None):
+        self.outcome = outcome
+        self.error = error
+        self._notify()
+
+    def _notify(self):
+        # 待機中の購読者を起こし、次の更新用に新しいイベントを用意する
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+class Subscription:
+    """
+    配信中ストリームの購読（先頭から再送し、その後はライブで受け取る）
+    """
+
+    def __init__(self, fanout: "StreamFanout", key: tuple[int, str], broadcast: _Broadcast, is_disconnected: Optional[Callable[[], Awaitable[bool]]]):
+        self._fanout = fanout
+        self._key = key
+        self._broadcast = broadcast
+        self._is_disconnected = is_disconnected
+        self.outcome = "aborted"
+
+    @property
+    def context(self) -> dict:
+        return self._broadcast.context
+
+    async def __aiter__(self) -> AsyncIterator[Any]:
+        broadcast = self._broadcast
+        index = 0
+        try:
+            while True:
+                if index < len(broadcast.chunks):
+                    index += 1
+                    yield broadcast.chunks[index - 1]
+                    continue
+                if broadcast.outcome is not None:
+                    self.outcome = broadcast.outcome
+                    if broadcast.error is not None:
+                        raise broadcast.error
+                    return
+                try:
+                    await asyncio.wait_for(broadcast.changed.wait(), timeout=self._fanout.poll_interval)
+                except asyncio.TimeoutError:
+                    if self._is_disconnected is not None and await self._is_disconnected():
+                        return
+        finally:
+            self._fanout._unsubscribe(self._key, broadcast)
+
+
+class StreamFanout:
+    """
+    同じキーのストリーミング呼び出しを1本の上流ストリームにまとめて配信する
+    購読者が全員いなくなった時点で上流のストリームを止める
+    """
+
+    def __init__(self, poll_interval: float):
+        self.poll_interval = poll_interval
+        self._broadcasts: dict[tuple[int, str], _Broadcast] = {}
+        self.leaders = 0
+        self.joiners = 0
+
+    def subscribe(
+        self, key: str, source: Callable[[dict], AsyncIterator[Any]], is_disconnected: Optional[Callable[[], Awaitable[bool]]] = None
+    ) -> Subscription:
+        """
+        sourceは配信を開始するときだけ呼ばれ、共有のcontext辞書を受け取る
+        """
+        broadcast_key = (id(asyncio.get_running_loop()), key)
+        broadcast = self._broadcasts.get(broadcast_key)
+        if broadcast is None:
+            broadcast = _Broadcast()
+            self._broadcasts[broadcast_key] = broadcast
+            broadcast.task = asyncio.create_task(self._produce(broadcast_key, broadcast, source))
+            self.leaders += 1
+        else:
+            self.joiners += 1
+        broadcast.subscribers += 1
+        return Subscription(self, broadcast_key, broadcast, is_disconnected)
+
+    async def _produce(self, key: tuple[int, str], broadcast: _Broadcast, source: Callable[[dict], AsyncIterator[Any]]):
+        try:
+            async for chunk in source(broadcast.context):
+                broadcast.publish(chunk)
+            broadcast.finish("completed")
+        except asyncio.CancelledError:
+            broadcast.finish("aborted")
+            raise
+        except Exception as e:
+            broadcast.finish("error", e)
+        finally:
+            self._forget(key, broadcast)
+
+    def _unsubscribe(self, key: tuple[int, str], broadcast: _Broadcast):
+        broadcast.subscribers -= 1
+        if broadcast.subscribers == 0 and broadcast.task is not None and not broadcast.task.done():
+            self._forget(key, broadcast)
+            broadcast.task.cancel()
+
+    def is_streaming(self, key: str) -> bool:
+        return (id(asyncio.get_running_loop()), key) in self._broadcasts
+
+    def _forget(self, key: tuple[int, str], broadcast: _Broadcast):
+        if self._broadcasts.get(key) is broadcast:
+            del self._broadcasts[key]
+
+    def __len__(self) -> int:
+        return len(self._broadcasts)
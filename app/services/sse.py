@@ -0,0 +1,43 @@
+"""
+Server-Sent Events 形式でのストリーミング出力のヘルパー
+"""
+
+import json
+
+COMPLETED_MARKER = "<<COMPLETED>>"
+
+
+def format_sse(event: str, data: dict) -> bytes:
+    """
+    1つのSSEフレームを作る
+    """
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode()
+
+
+class CompletionMarkerFilter:
+    """
+    ストリーミング中のテキストから完了マーカーを取り除き、検出したかどうかを記録する
+    マーカーがチャンクの境界をまたぐ場合に備え、マーカーの先頭と一致する末尾は次のチャンクまで保留する
+    """
+
+    def __init__(self, marker: str = COMPLETED_MARKER):
+        self.marker = marker
+        self.found = False
+        self._pending = ""
+
+    def feed(self, text: str) -> str:
+        data = self._pending + text
+        if self.marker in data:
+            self.found = True
+            data = data.replace(self.marker, "")
+        keep = 0
+        for length in range(min(len(self.marker) - 1, len(data)), 0, -1):
+            if data.endswith(self.marker[:length]):
+                keep = length
+                break
+        self._pending = data[len(data) - keep :]
+        return data[: len(data) - keep]
+
+    def flush(self) -> str:
+        pending, self._pending = self._pending, ""
+        return pending
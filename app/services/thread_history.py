@@ -0,0 +1,113 @@
+"""
+RAG（Streamlitのapp.py）の会話履歴
+session_idごとにメッセージを追記のみで保存し、LangSmithのrunを検索せずに直近の履歴を取り出す
+直近のスレッドは最新max_messages件をメモリ上にも保持するため、履歴の取得はスレッドの長さによらない
+"""
+
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Optional
+
+
+class ThreadHistoryStore:
+    """
+    SQLiteの追記専用のメッセージログ（session_id, seq）と、最近使ったスレッドの末尾のメモリキャッシュ
+    Streamlitはスクリプトを複数のスレッドで実行するため同期APIでロックを取る
+    """
+
+    def __init__(self, path: str, max_messages: int = 50, cache_size: int = 1000):
+        self.max_messages = max_messages
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS thread_messages "
+            "(session_id TEXT NOT NULL, seq INTEGER NOT NULL, role TEXT NOT NULL, content TEXT NOT NULL, created_at REAL NOT NULL, "
+            "PRIMARY KEY (session_id, seq))"
+        )
+        # 取り込み元を確認済みのスレッド（取り込むメッセージがなかったスレッドを毎回確認しないため）
+        self._conn.execute("CREATE TABLE IF NOT EXISTS thread_backfills (session_id TEXT PRIMARY KEY, checked_at REAL NOT NULL)")
+        self._conn.commit()
+        # session_id -> (次の連番, 末尾のmax_messages件)
+        self._threads: OrderedDict[str, tuple[int, deque]] = OrderedDict()
+
+    def _load(self, session_id: str) -> tuple[int, deque]:
+        cached = self._threads.get(session_id)
+        if cached is None:
+            # 主キーのインデックスを逆順にたどり、末尾のmax_messages件だけを読む
+            rows = self._conn.execute(
+                "SELECT seq, role, content FROM thread_messages WHERE session_id = ? ORDER BY seq DESC LIMIT ?", (session_id, self.max_messages)
+            ).fetchall()
+            next_seq = rows[0][0] + 1 if rows else 0
+            cached = (next_seq, deque(({"role": role, "content": content} for _, role, content in reversed(rows)), maxlen=self.max_messages))
+            self._threads[session_id] = cached
+        self._threads.move_to_end(session_id)
+        while len(self._threads) > self.cache_size:
+            self._threads.popitem(last=False)
+        return cached
+
+    def latest(self, session_id: str, limit: Optional[int] = None) -> Optional[list]:
+        """
+        直近のlimit件（省略時はmax_messages件）のメッセージを古い順に返す。記録のないスレッドはNone
+        """
+        with self._lock:
+            next_seq, messages = self._load(session_id)
+            recent = list(messages)
+        if next_seq == 0:
+            return None
+        if limit is not None:
+            recent = recent[len(recent) - min(limit, len(recent)) :]
+        return recent
+
+    def append(self, session_id: str, messages: list):
+        if not messages:
+            return
+        now = time.time()
+        with self._lock:
+            next_seq, recent = self._load(session_id)
+            self._conn.executemany(
+                "INSERT INTO thread_messages (session_id, seq, role, content, created_at) VALUES (?, ?, ?, ?, ?)",
+                [(session_id, next_seq + index, msg["role"], msg["content"], now) for index, msg in enumerate(messages)],
+            )
+            self._conn.commit()
+            recent.extend({"role": msg["role"], "content": msg["content"]} for msg in messages)
+            self._threads[session_id] = (next_seq + len(messages), recent)
+
+    def mark_checked(self, session_id: str):
+        """
+        取り込み元を確認する必要のないスレッドとして記録する（新しく作ったスレッドなど）
+        """
+        with self._lock:
+            self._conn.execute("INSERT OR IGNORE INTO thread_backfills (session_id, checked_at) VALUES (?, ?)", (session_id, time.time()))
+            self._conn.commit()
+
+    def _checked(self, session_id: str) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM thread_backfills WHERE session_id = ?", (session_id,)).fetchone() is not None
+
+    def get_or_backfill(self, session_id: str, fetch: Callable[[], list]) -> list:
+        """
+        記録のないスレッドだけfetch（LangSmithなど）から取得して保存し、以降はローカルの記録を使う
+        取得したメッセージが空でも確認済みとして記録し、fetchは1スレッドにつき1回だけ呼ぶ
+        """
+        messages = self.latest(session_id)
+        if messages is not None:
+            return messages
+        if self._checked(session_id):
+            return []
+        # 過去のrunの入力に含まれるシステムメッセージ（検索結果）は履歴に含めない
+        fetched = [
+            {"role": msg["role"], "content": msg["content"]}
+            for msg in fetch()
+            if msg.get("role") in ("user", "assistant") and isinstance(msg.get("content"), str)
+        ]
+        self.append(session_id, fetched)
+        self.mark_checked(session_id)
+        return fetched[-self.max_messages :]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,63 @@
+"""
+トークン数の計測
+履歴の圧縮やメトリクスで共通して使う
+"""
+
+import logging
+import threading
+from functools import lru_cache
+from typing import Optional
+
+import tiktoken
+
+from app.core.config import get_settings
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+# OpenAIのチャット形式で1メッセージごとに加算されるトークン数
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+class TokenCounter:
+    """
+    tiktokenによるトークン数の計測
+    エンコーディングを取得できない環境（オフラインなど）では1文字1トークンとして見積もる
+    """
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+        self._encoding: Optional[tiktoken.Encoding] = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def load(self) -> Optional[tiktoken.Encoding]:
+        with self._lock:
+            if not self._loaded:
+                try:
+                    try:
+                        self._encoding = tiktoken.encoding_for_model(self.model_name)
+                    except KeyError:
+                        self._encoding = tiktoken.get_encoding("cl100k_base")
+                except Exception as e:
+                    logger.warning("tiktoken encoding unavailable, estimating tokens by characters: %s", e)
+                self._loaded = True
+        return self._encoding
+
+    def count_text(self, text: str) -> int:
+        return _count_text_tokens(self, text)
+
+    def count_message(self, message: dict) -> int:
+        return self.count_text(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+
+@lru_cache(maxsize=4096)
+def _count_text_tokens(counter: TokenCounter, text: str) -> int:
+    # 同じ履歴が繰り返し送られるため、メッセージ単位でトークン数をキャッシュする
+    encoding = counter.load()
+    if encoding is None:
+        return len(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+token_counter = TokenCounter(settings.MODEL_NAME)
@@ -0,0 +1,3 @@
+"""
+Testing and benchmarking utilities
+"""
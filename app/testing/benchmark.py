@@ -0,0 +1,242 @@
+"""
+FastAPIアプリのレイテンシ・スループット計測
+
+app.main:app を同じイベントループ上のuvicornで起動してHTTPで呼び出し、上流には代替OpenAIサーバーを使う。
+エンドポイント・同時実行数ごとに p50/p95/p99 のレイテンシ、TTFT、スループット、
+イベントループの遅延を計測し、JSONに保存する。
+
+    python -m app.testing.benchmark --concurrency 1 8 32 --requests 64 --ttft 0.2 --inter-token-delay 0.005 --output bench.json
+
+一部の応答だけ遅い上流でヘッジの効果を見る場合（--hedgingの有無でp99を比べる）:
+    python -m app.testing.benchmark --endpoints db_evidence_requirements --ttft 0.1 --slow-rate 0.05 --slow-ttft 2 --hedging
+
+記録した応答で計測する場合（上流の待ち時間を除いたアプリ自体のオーバーヘッド）:
+    python -m app.testing.benchmark --llm-mode record --live --output live.json
+    python -m app.testing.benchmark --llm-mode replay --output replay.json
+"""
+
+import argparse
+import asyncio
+import json
+import platform
+import statistics
+import time
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from typing import Optional
+
+import httpx
+
+from app.core.config import get_settings
+from app.testing.fake_openai import FakeOpenAIConfig, run_fake_openai_server
+from app.testing.server import serve_in_running_loop
+
+# 計測対象のエンドポイント（assistant-responseはストリーミング）
+ENDPOINTS = ["db_evidence_requirements", "pubmed-query", "plan", "assistant-response"]
+STREAMING_ENDPOINTS = {"assistant-response"}
+
+BASE_MESSAGE = "糖尿病の治療法について教えてください"
+LOOP_LAG_INTERVAL = 0.01  # イベントループ遅延の計測間隔（秒）
+
+
+@dataclass
+class Sample:
+    latency: float
+    ttft: Optional[float]
+    ok: bool
+
+
+@dataclass
+class BenchmarkResult:
+    endpoint: str
+    concurrency: int
+    requests: int
+    errors: int
+    duration_s: float
+    throughput_rps: float
+    latency_ms: dict = field(default_factory=dict)
+    ttft_ms: dict = field(default_factory=dict)
+    loop_lag_ms: dict = field(default_factory=dict)
+
+
+def percentile(values: list, q: float) -> float:
+    """
+    線形補間による百分位数（q は 0〜100）
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    position = (len(ordered) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def summarize(values: list) -> dict:
+    """
+    秒単位の値をミリ秒の要約統計に変換する
+    """
+    if not values:
+        return {}
+    return {
+        "p50": round(percentile(values, 50) * 1000, 2),
+        "p95": round(percentile(values, 95) * 1000, 2),
+        "p99": round(percentile(values, 99) * 1000, 2),
+        "mean": round(statistics.fmean(values) * 1000, 2),
+        "max": round(max(values) * 1000, 2),
+    }
+
+
+async def _monitor_loop_lag(samples: list):
+    # 指定間隔で眠り、予定より遅れて起きた分をイベントループの遅延とする
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        samples.append(max(0.0, time.perf_counter() - started - LOOP_LAG_INTERVAL))
+
+
+async def _request(client: httpx.AsyncClient, endpoint: str, payload: dict) -> Sample:
+    started = time.perf_counter()
+    ttft = None
+    try:
+        if endpoint in STREAMING_ENDPOINTS:
+            async with client.stream("POST", f"/api/{endpoint}", json=payload) as response:
+                async for chunk in response.aiter_bytes():
+                    if ttft is None and chunk:
+                        ttft = time.perf_counter() - started
+                ok = response.status_code == httpx.codes.OK
+        else:
+            response = await client.post(f"/api/{endpoint}", json=payload)
+            ok = response.status_code == httpx.codes.OK
+            ttft = time.perf_counter() - started
+    except httpx.HTTPError:
+        ok = False
+    return Sample(latency=time.perf_counter() - started, ttft=ttft, ok=ok)
+
+
+async def run_level(base_url: str, endpoint: str, concurrency: int, requests: int, unique_messages: bool = True) -> BenchmarkResult:
+    """
+    1エンドポイント・1同時実行数分の計測
+    unique_messagesを有効にすると、キャッシュやsingle-flightで呼び出しがまとめられないよう質問を毎回変える
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    samples: list[Sample] = []
+    lag_samples: list = []
+
+    async def worker(index: int, client: httpx.AsyncClient):
+        message = f"{BASE_MESSAGE} ({index})" if unique_messages else BASE_MESSAGE
+        async with semaphore:
+            samples.append(await _request(client, endpoint, {"new_message": message, "message_log": []}))
+
+    # ASGITransportはレスポンス全体をまとめて返しTTFTを測れないため、実際のHTTP接続を使う
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=120, limits=limits) as client:
+        monitor = asyncio.create_task(_monitor_loop_lag(lag_samples))
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(index, client) for index in range(requests)))
+        duration = time.perf_counter() - started
+        monitor.cancel()
+
+    succeeded = [sample for sample in samples if sample.ok]
+    return BenchmarkResult(
+        endpoint=endpoint,
+        concurrency=concurrency,
+        requests=requests,
+        errors=len(samples) - len(succeeded),
+        duration_s=round(duration, 4),
+        throughput_rps=round(len(succeeded) / duration, 2) if duration > 0 else 0.0,
+        latency_ms=summarize([sample.latency for sample in succeeded]),
+        ttft_ms=summarize([sample.ttft for sample in succeeded if sample.ttft is not None]),
+        loop_lag_ms=summarize(lag_samples),
+    )
+
+
+async def run_benchmark(app, endpoints: list, concurrency_levels: list, requests: int, unique_messages: bool = True) -> list[BenchmarkResult]:
+    results = []
+    # lifespanで接続プールの準備と後始末が行われる
+    async with serve_in_running_loop(app) as base_url:
+        for endpoint in endpoints:
+            for concurrency in concurrency_levels:
+                results.append(await run_level(base_url, endpoint, concurrency, requests, unique_messages))
+    return results
+
+
+def build_report(results: list[BenchmarkResult], fake_config: Optional[FakeOpenAIConfig]) -> dict:
+    fake = None
+    if fake_config is not None:
+        fake = {key: value for key, value in asdict(fake_config).items() if key not in ("stats", "response_text")}
+        fake["response_chars"] = len(fake_config.response_text)
+    return {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "fake_openai": fake,
+        "hedging": get_settings().LLM_HEDGING_ENABLED,
+        "results": [asdict(result) for result in results],
+    }
+
+
+def main():
+    from app.main import app
+
+    parser = argparse.ArgumentParser(description="FastAPIアプリのレイテンシ・スループット計測")
+    parser.add_argument("--endpoints", nargs="+", default=ENDPOINTS, choices=ENDPOINTS)
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=64, help="同時実行数ごとのリクエスト数")
+    parser.add_argument("--ttft", type=float, default=0.2)
+    parser.add_argument("--inter-token-delay", type=float, default=0.005)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="ttftの代わりにslow-ttftだけ待つ応答の割合")
+    parser.add_argument("--slow-ttft", type=float, default=2.0)
+    parser.add_argument("--hedging", action="store_true", help="判定・PubMedクエリのヘッジ・再試行・サーキットブレーカーを有効にする")
+    parser.add_argument("--response-text", default=FakeOpenAIConfig.response_text * 20)
+    parser.add_argument("--same-message", action="store_true", help="全リクエストで同じ質問を送る（キャッシュ・single-flightの効果を見る）")
+    parser.add_argument("--live", action="store_true", help="代替サーバーを使わず設定済みのOpenAI APIを呼ぶ")
+    parser.add_argument(
+        "--llm-mode",
+        choices=["live", "record", "replay"],
+        default=None,
+        help="LLM_MODEを上書きする（replayでは記録から応答し、アプリ自体のオーバーヘッドのみを計測する）",
+    )
+    parser.add_argument("--output", default="benchmark.json")
+    args = parser.parse_args()
+
+    settings = get_settings()
+    unique = not args.same_message
+    if args.llm_mode is not None:
+        settings.LLM_MODE = args.llm_mode
+    if args.hedging:
+        settings.LLM_HEDGING_ENABLED = settings.LLM_RESILIENCE_ENABLED = True
+
+    if args.live or settings.LLM_MODE == "replay":
+        fake_config = None
+        results = asyncio.run(run_benchmark(app, args.endpoints, args.concurrency, args.requests, unique))
+    else:
+        fake_config = FakeOpenAIConfig(
+            response_text=args.response_text,
+            ttft=args.ttft,
+            inter_token_delay=args.inter_token_delay,
+            error_rate=args.error_rate,
+            slow_rate=args.slow_rate,
+            slow_ttft=args.slow_ttft,
+            seed=0,
+        )
+        with run_fake_openai_server(fake_config) as base_url:
+            settings.OPENAI_BASE_URL = base_url
+            settings.OPENAI_API_KEY = settings.OPENAI_API_KEY or "benchmark"
+            results = asyncio.run(run_benchmark(app, args.endpoints, args.concurrency, args.requests, unique))
+
+    report = build_report(results, fake_config)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    for result in results:
+        print(
+            f"{result.endpoint:<26} c={result.concurrency:<4} rps={result.throughput_rps:<8} "
+            f"p50={result.latency_ms.get('p50')}ms p99={result.latency_ms.get('p99')}ms "
+            f"ttft_p50={result.ttft_ms.get('p50')}ms loop_lag_p99={result.loop_lag_ms.get('p99')}ms errors={result.errors}"
+        )
+    print(f"Saved results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""
+OpenAI Chat Completions API のローカル代替サーバー
+テストやベンチマークで実際のOpenAI APIを呼ばずにアプリを動かすために使う
+
+単体で起動する場合:
+    python -m app.testing.fake_openai --port 8001 --ttft 0.3 --inter-token-delay 0.02
+    OPENAI_BASE_URL=http://127.0.0.1:8001/v1 OPENAI_API_KEY=dummy uvicorn app.main:app
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from app.testing.server import run_server_in_thread
+
+
+@dataclass
+class FakeOpenAIStats:
+    requests: int = 0
+    errors: int = 0  # error_rateにより失敗させたリクエスト数
+    streams_completed: int = 0
+    streams_cancelled: int = 0  # クライアント側で途中切断されたストリーム数
+    last_cancelled_at: Optional[float] = None
+
+
+@dataclass
+class FakeOpenAIConfig:
+    response_text: str = "これはテスト用の応答です。"
+    ttft: float = 0.0  # 最初のトークン（非ストリーミング時は応答全体）を返すまでの待ち時間（秒）
+    inter_token_delay: float = 0.0  # ストリーミング時の1文字ごとの待ち時間（秒）
+    error_rate: float = 0.0  # 0〜1の確率で error_status のエラーを返す
+    error_status: int = 500
+    slow_rate: float = 0.0  # 0〜1の確率でttftの代わりにslow_ttftだけ待つ（テールレイテンシの再現用）
+    slow_ttft: float = 0.0
+    error_models: tuple = ()  # 常にerror_statusのエラーを返すモデル（フェイルオーバーの確認用）
+    seed: Optional[int] = None  # エラー発生の乱数シード（再現性のため）
+    stats: FakeOpenAIStats = field(default_factory=FakeOpenAIStats)
+
+
+def create_app(config: FakeOpenAIConfig) -> FastAPI:
+    app = FastAPI()
+    rng = random.Random(config.seed)
+
+    @app.get("/v1/models")
+    async def list_models():
+        return {"object": "list", "data": [{"id": "gpt-4o-mini", "object": "model", "created": 0, "owned_by": "fake"}]}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        config.stats.requests += 1
+        model = body.get("model", "gpt-4o-mini")
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+
+        slow = config.slow_rate > 0 and rng.random() < config.slow_rate
+        await asyncio.sleep(config.slow_ttft if slow else config.ttft)
+
+        if model in config.error_models or (config.error_rate > 0 and rng.random() < config.error_rate):
+            config.stats.errors += 1
+            return JSONResponse(
+                status_code=config.error_status,
+                content={"error": {"message": "Injected error from fake OpenAI server", "type": "server_error", "param": None, "code": None}},
+            )
+
+        if not body.get("stream"):
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [
+                    {"index": 0, "message": {"role": "assistant", "content": config.response_text}, "logprobs": None, "finish_reason": "stop"}
+                ],
+                "usage": {"prompt_tokens": 0, "completion_tokens": len(config.response_text), "total_tokens": len(config.response_text)},
+            }
+
+        def chunk(delta: dict, finish_reason=None) -> str:
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "logprobs": None, "finish_reason": finish_reason}],
+            }
+            return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+        async def generate():
+            try:
+                yield chunk({"role": "assistant", "content": ""})
+                if config.inter_token_delay > 0:
+                    for char in config.response_text:
+                        yield chunk({"content": char})
+                        await asyncio.sleep(config.inter_token_delay)
+                else:
+                    yield chunk({"content": config.response_text})
+                yield chunk({}, finish_reason="stop")
+                yield "data: [DONE]\n\n"
+                config.stats.streams_completed += 1
+            except asyncio.CancelledError:
+                config.stats.streams_cancelled += 1
+                config.stats.last_cancelled_at = time.monotonic()
+                raise
+
+        return StreamingResponse(generate(), media_type="text/event-stream")
+
+    return app
+
+
+@contextmanager
+def run_fake_openai_server(config: FakeOpenAIConfig, host: str = "127.0.0.1") -> Iterator[str]:
+    """
+    バックグラウンドスレッドで代替サーバーを起動し、base_url (…/v1) を返す
+    """
+    with run_server_in_thread(create_app(config), host=host) as base_url:
+        yield f"{base_url}/v1"
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="OpenAI Chat Completions API のローカル代替サーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--response-text", default=FakeOpenAIConfig.response_text)
+    parser.add_argument("--ttft", type=float, default=0.0)
+    parser.add_argument("--inter-token-delay", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--slow-rate", type=float, default=0.0)
+    parser.add_argument("--slow-ttft", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    config = FakeOpenAIConfig(
+        response_text=args.response_text,
+        ttft=args.ttft,
+        inter_token_delay=args.inter_token_delay,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        slow_rate=args.slow_rate,
+        slow_ttft=args.slow_ttft,
+        seed=args.seed,
+    )
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Redisプロトコル (RESP) のローカル代替サーバー
+RedisBackendのテスト用に、GET/SET/DEL/KEYS/SCANなど最低限のコマンドのみ実装する
+"""
+
+import asyncio
+import fnmatch
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from typing import Optional
+
+
+class FakeRedisServer:
+    def __init__(self, reply_delay: float = 0.0):
+        self.data: dict[str, tuple[Optional[float], bytes]] = {}
+        # SCANのカーソルが指すキーの順（途中で削除されても残りのキーの位置がずれないよう追記のみ）
+        self.scan_order: list[str] = []
+        # 応答を返すまでの待ち時間（応答待ちのキャンセルを再現する）
+        self.reply_delay = reply_delay
+
+    def _get(self, key: str) -> Optional[bytes]:
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at is not None and expires_at <= time.time():
+            del self.data[key]
+            return None
+        return value
+
+    def execute(self, args: list[bytes]) -> bytes:
+        handler = getattr(self, f"_command_{args[0].decode().lower()}", None)
+        if handler is None:
+            return b"-ERR unknown command '%s'\r\n" % args[0]
+        return handler([arg.decode() for arg in args[1:]], args[1:])
+
+    def _command_ping(self, keys: list[str], raw: list[bytes]) -> bytes:
+        return b"+PONG\r\n"
+
+    def _command_auth(self, keys: list[str], raw: list[bytes]) -> bytes:
+        return b"+OK\r\n"
+
+    _command_select = _command_auth
+
+    def _command_get(self, keys: list[str], raw: list[bytes]) -> bytes:
+        value = self._get(keys[0])
+        return b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value)
+
+    def _command_set(self, keys: list[str], raw: list[bytes]) -> bytes:
+        expires_at = None
+        options = [option.upper() for option in keys[2:]]
+        if "PX" in options:
+            expires_at = time.time() + int(keys[2 + options.index("PX") + 1]) / 1000
+        elif "EX" in options:
+            expires_at = time.time() + int(keys[2 + options.index("EX") + 1])
+        if keys[0] not in self.data:
+            self.scan_order.append(keys[0])
+        self.data[keys[0]] = (expires_at, raw[1])
+        return b"+OK\r\n"
+
+    def _command_del(self, keys: list[str], raw: list[bytes]) -> bytes:
+        removed = sum(1 for key in keys if self.data.pop(key, None) is not None)
+        return b":%d\r\n" % removed
+
+    def _command_keys(self, keys: list[str], raw: list[bytes]) -> bytes:
+        matched = [key.encode() for key in list(self.data) if fnmatch.fnmatchcase(key, keys[0]) and self._get(key) is not None]
+        return b"*%d\r\n" % len(matched) + b"".join(b"$%d\r\n%s\r\n" % (len(key), key) for key in matched)
+
+    def _command_scan(self, keys: list[str], raw: list[bytes]) -> bytes:
+        # カーソルはscan_orderの位置
+        options = [option.upper() for option in keys[1:]]
+        pattern = keys[1 + options.index("MATCH") + 1] if "MATCH" in options else "*"
+        count = int(keys[1 + options.index("COUNT") + 1]) if "COUNT" in options else 10
+        start = int(keys[0])
+        page = self.scan_order[start : start + count]
+        cursor = start + count if start + count < len(self.scan_order) else 0
+        matched = [key.encode() for key in dict.fromkeys(page) if fnmatch.fnmatchcase(key, pattern) and self._get(key) is not None]
+        cursor_bytes = str(cursor).encode()
+        return (
+            b"*2\r\n$%d\r\n%s\r\n" % (len(cursor_bytes), cursor_bytes)
+            + b"*%d\r\n" % len(matched)
+            + b"".join(b"$%d\r\n%s\r\n" % (len(key), key) for key in matched)
+        )
+
+    def _command_flushdb(self, keys: list[str], raw: list[bytes]) -> bytes:
+        self.data.clear()
+        return b"+OK\r\n"
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                args = []
+                for _ in range(int(line[1:-2])):
+                    length = int((await reader.readline())[1:-2])
+                    args.append((await reader.readexactly(length + 2))[:-2])
+                if self.reply_delay:
+                    await asyncio.sleep(self.reply_delay)
+                writer.write(self.execute(args))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+@contextmanager
+def run_fake_redis_server(host: str = "127.0.0.1", reply_delay: float = 0.0) -> Iterator[str]:
+    """
+    バックグラウンドスレッドで代替サーバーを起動し、redis:// URLを返す
+    """
+    fake = FakeRedisServer(reply_delay)
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(asyncio.start_server(fake.handle, host, 0))
+    port = server.sockets[0].getsockname()[1]
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    try:
+        yield f"redis://{host}:{port}/0"
+    finally:
+
+        async def shutdown():
+            server.close()
+            # 応答を待たせている接続の処理も止めてからループを閉じる
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        asyncio.run_coroutine_threadsafe(shutdown(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
@@ -0,0 +1,64 @@
+"""
+ASGIアプリをバックグラウンドスレッドのuvicornで起動するヘルパー
+"""
+
+import asyncio
+import socket
+import threading
+import time
+from collections.abc import AsyncIterator, Iterator
+from contextlib import asynccontextmanager, contextmanager
+
+import uvicorn
+
+
+@contextmanager
+def run_server_in_thread(app, host: str = "127.0.0.1", lifespan: str = "off") -> Iterator[str]:
+    """
+    空いているポートでアプリを起動し、ベースURL (http://host:port) を返す
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind((host, 0))
+    port = sock.getsockname()[1]
+
+    server = uvicorn.Server(uvicorn.Config(app, log_level="warning", lifespan=lifespan))
+    thread = threading.Thread(target=server.run, kwargs={"sockets": [sock]}, daemon=True)
+    thread.start()
+    while not server.started and thread.is_alive():
+        time.sleep(0.01)
+
+    try:
+        yield f"http://{host}:{port}"
+    finally:
+        server.should_exit = True
+        thread.join()
+        sock.close()
+
+
+class _EmbeddedServer(uvicorn.Server):
+    def install_signal_handlers(self):
+        # 呼び出し元のシグナル処理を上書きしない
+        pass
+
+
+@asynccontextmanager
+async def serve_in_running_loop(app, host: str = "127.0.0.1", lifespan: str = "on") -> AsyncIterator[str]:
+    """
+    実行中のイベントループ上でアプリを起動し、ベースURLを返す
+    クライアントと同じループで動くため、ループの遅延をアプリ側の処理込みで計測できる
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind((host, 0))
+    port = sock.getsockname()[1]
+
+    server = _EmbeddedServer(uvicorn.Config(app, log_level="warning", lifespan=lifespan))
+    task = asyncio.create_task(server.serve(sockets=[sock]))
+    while not server.started and not task.done():
+        await asyncio.sleep(0.01)
+
+    try:
+        yield f"http://{host}:{port}"
+    finally:
+        server.should_exit = True
+        await task
+        sock.close()
@@ -0,0 +1,176 @@
+"""
+ローカルのベクトルストア（app.services.local_vectorstore）の再現率・レイテンシの計測
+
+正解は全件をfloat32で比べる厳密な検索とし、int8量子化・IVF（nprobeごと）の設定の再現率@kと、
+1クエリずつ検索したときのp50/p95/p99のレイテンシ、まとめて検索したときのスループットをJSONに保存する。
+既定ではクラスタのある合成データを使う（--indexで既存のストアの埋め込みも使える）。
+
+    python -m app.testing.vector_benchmark --vectors 200000 --dim 1536 --nlist 512 --nprobe 4 16 64 --output vector_bench.json
+"""
+
+import argparse
+import json
+import platform
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from typing import Optional
+
+import numpy as np
+
+from app.services.local_vectorstore import LocalVectorStore
+from app.testing.benchmark import summarize
+
+
+@dataclass
+class VectorBenchmarkResult:
+    name: str
+    dtype: str
+    nprobe: Optional[int]
+    recall_at_k: float
+    latency_ms: dict
+    batch_qps: float
+    build_seconds: float
+
+
+def clustered_vectors(n: int, dim: int, clusters: int, seed: int = 0) -> np.ndarray:
+    """
+    クラスタのまわりに散らばった合成データ（実際の文書の埋め込みと同様に偏りがある）
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim))
+    return (centers[rng.integers(0, clusters, n)] + rng.normal(scale=0.5, size=(n, dim))).astype(np.float32)
+
+
+def recall(expected: np.ndarray, found: np.ndarray) -> float:
+    k = expected.shape[1]
+    return float(np.mean([len(set(a.tolist()) & set(b.tolist())) / k for a, b in zip(expected, found)]))
+
+
+def measure(store: LocalVectorStore, queries: np.ndarray, k: int, nprobe: Optional[int], batch_size: int) -> tuple[np.ndarray, list, float]:
+    """
+    1クエリずつの検索の結果とレイテンシ、batch_size件ずつまとめて検索したときのクエリ/秒を返す
+    """
+    rows = []
+    latencies = []
+    for query in queries:
+        started = time.perf_counter()
+        _, found = store.search_vectors(query[None, :], k, nprobe=nprobe)
+        latencies.append(time.perf_counter() - started)
+        rows.append(found[0])
+    started = time.perf_counter()
+    for start in range(0, len(queries), batch_size):
+        store.search_vectors(queries[start : start + batch_size], k, nprobe=nprobe)
+    elapsed = time.perf_counter() - started
+    return np.stack(rows), latencies, round(len(queries) / elapsed, 2) if elapsed else 0.0
+
+
+def build_store(path: str, vectors: np.ndarray, dtype: str, nlist: int) -> tuple[LocalVectorStore, float]:
+    started = time.perf_counter()
+    store = LocalVectorStore(path, dtype=dtype)
+    for start in range(0, len(vectors), 10000):
+        part = vectors[start : start + 10000]
+        store.add_embeddings([""] * len(part), part, ids=[str(start + i) for i in range(len(part))])
+    if nlist:
+        store.train_ivf(nlist)
+    return store, round(time.perf_counter() - started, 3)
+
+
+def run_vector_benchmark(  # noqa: PLR0913
+    vectors: np.ndarray,
+    queries: np.ndarray,
+    workdir: str,
+    k: int = 10,
+    dtypes: tuple[str, ...] = ("float32", "int8"),
+    nlist: int = 0,
+    nprobes: tuple[int, ...] = (),
+    batch_size: int = 64,
+) -> list[VectorBenchmarkResult]:
+    """
+    dtypeごとに厳密な検索と、nlist指定時はnprobeごとのIVFの検索を計測する（正解はfloat32の厳密な検索）
+    """
+    results = []
+    expected = None
+    for dtype in dtypes:
+        store, build_seconds = build_store(f"{workdir}/{dtype}", vectors, dtype, nlist)
+        # nprobeをnlist以上にすると全件を比べる厳密な検索になる
+        settings: list[tuple[str, Optional[int]]] = [("exact", max(nlist, 1))] + [("ivf", nprobe) for nprobe in nprobes if nlist]
+        for name, nprobe in settings:
+            found, latencies, qps = measure(store, queries, k, nprobe, batch_size)
+            if expected is None:
+                expected = found
+            results.append(
+                VectorBenchmarkResult(
+                    name=name,
+                    dtype=dtype,
+                    nprobe=nprobe if name == "ivf" else None,
+                    recall_at_k=round(recall(expected, found), 4),
+                    latency_ms=summarize(latencies),
+                    batch_qps=qps,
+                    build_seconds=build_seconds,
+                )
+            )
+        store.close()
+    return results
+
+
+def load_index_vectors(path: str) -> np.ndarray:
+    store = LocalVectorStore(path)
+    snapshot = store.snapshot(force=True)
+    return snapshot.block(np.flatnonzero(~snapshot.deleted))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ローカルのベクトルストアの再現率・レイテンシの計測")
+    parser.add_argument("--index", default=None, help="既存のストアの埋め込みを使う（省略時は合成データ）")
+    parser.add_argument("--vectors", type=int, default=100000, help="合成データの件数")
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--clusters", type=int, default=1000, help="合成データのクラスタ数")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--dtypes", nargs="+", default=["float32", "int8"], choices=["float32", "int8"])
+    parser.add_argument("--nlist", type=int, default=0, help="IVFの分割数（0でIVFを計測しない）")
+    parser.add_argument("--nprobe", nargs="+", type=int, default=[4, 16, 64])
+    parser.add_argument("--batch-size", type=int, default=64, help="まとめて検索するクエリ数")
+    parser.add_argument("--output", default="vector_benchmark.json")
+    args = parser.parse_args()
+
+    if args.index:
+        vectors = load_index_vectors(args.index)
+        rng = np.random.default_rng(1)
+        # 既存の埋め込みに少し雑音を加えたものをクエリにする
+        queries = vectors[rng.integers(0, len(vectors), args.queries)] + rng.normal(scale=0.01, size=(args.queries, vectors.shape[1]))
+    else:
+        data = clustered_vectors(args.vectors + args.queries, args.dim, args.clusters)
+        vectors, queries = data[: args.vectors], data[args.vectors :]
+
+    with tempfile.TemporaryDirectory() as workdir:
+        results = run_vector_benchmark(
+            vectors, queries.astype(np.float32), workdir, args.k, tuple(args.dtypes), args.nlist, tuple(args.nprobe), args.batch_size
+        )
+
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "vectors": len(vectors),
+        "dim": int(vectors.shape[1]),
+        "queries": len(queries),
+        "k": args.k,
+        "nlist": args.nlist,
+        "results": [asdict(result) for result in results],
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    for result in results:
+        print(
+            f"{result.name:<6} {result.dtype:<8} nprobe={result.nprobe!s:<5} recall@{args.k}={result.recall_at_k:<7} "
+            f"p50={result.latency_ms.get('p50')}ms p99={result.latency_ms.get('p99')}ms batch_qps={result.batch_qps}"
+        )
+    print(f"Saved results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import pytest
 from fastapi.testclient import TestClient
 
 from app.main import app
@@ -8,6 +9,12 @@ client = TestClient(app)
 HTTP_OK = 200
 
 
+@pytest.fixture(autouse=True)
+def _use_fake_openai(fake_openai):
+    # 実際のOpenAI APIの代わりにローカルの代替サーバーを使う
+    return fake_openai
+
+
 def test_assistant_response_endpoint():
     # テスト用のリクエストデータ
     request_data = {
@@ -0,0 +1,51 @@
+import time
+
+import httpx
+
+from app.core.config import get_settings
+from app.main import app
+from app.services.llm_service import stream_stats
+from app.testing.server import run_server_in_thread
+
+# HTTPステータスコードの定数
+HTTP_OK = 200
+
+# 切断から上流のストリームが閉じられるまでの許容時間（秒）
+MAX_CANCEL_DELAY = 1.0
+
+
+def test_client_disconnect_closes_upstream_stream(fake_openai, monkeypatch):
+    monkeypatch.setattr(get_settings(), "STREAM_DISCONNECT_POLL_INTERVAL", 0.05)
+    fake_openai.response_text = "糖尿病の治療法には食事療法、運動療法、薬物療法があります。" * 20
+    fake_openai.inter_token_delay = 0.02
+    aborted_before = stream_stats.aborted_streams
+    request_data = {"new_message": "糖尿病の治療法について教えてください", "message_log": []}
+
+    with run_server_in_thread(app, lifespan="on") as base_url:
+        with httpx.Client(base_url=base_url, timeout=10) as client:
+            with client.stream("POST", "/api/assistant-response", json=request_data) as response:
+                assert response.status_code == HTTP_OK
+                next(response.iter_bytes())
+            disconnected_at = time.monotonic()
+
+        while fake_openai.stats.streams_cancelled == 0 and time.monotonic() - disconnected_at < MAX_CANCEL_DELAY:
+            time.sleep(0.01)
+
+    assert fake_openai.stats.streams_cancelled == 1
+    assert fake_openai.stats.streams_completed == 0
+    assert fake_openai.stats.last_cancelled_at - disconnected_at < MAX_CANCEL_DELAY
+    assert stream_stats.aborted_streams == aborted_before + 1
+
+
+def test_completed_stream_is_counted(fake_openai):
+    fake_openai.response_text = "要約<<COMPLETED>>"
+    fake_openai.inter_token_delay = 0.001
+    completed_before = stream_stats.completed_streams
+    request_data = {"new_message": "糖尿病の治療法について教えてください", "message_log": []}
+
+    with run_server_in_thread(app, lifespan="on") as base_url:
+        response = httpx.post(f"{base_url}/api/assistant-response", json=request_data, timeout=10)
+
+    assert response.status_code == HTTP_OK
+    assert response.text == "要約<<COMPLETED>>"
+    assert stream_stats.completed_streams == completed_before + 1
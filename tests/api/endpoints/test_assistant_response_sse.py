@@ -0,0 +1,56 @@
+import json
+
+from fastapi.testclient import TestClient
+
+from app.core.config import get_settings
+from app.main import app
+
+# HTTPステータスコードの定数
+HTTP_OK = 200
+
+
+def parse_events(body: str) -> list[tuple[str, dict]]:
+    events = []
+    for frame in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in frame.split("\n"))
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+def test_assistant_response_sse_mode(fake_openai):
+    fake_openai.response_text = "糖尿病の治療法には食事療法、運動療法、薬物療法があります。<<COMPLETED>>"
+    fake_openai.inter_token_delay = 0.001
+    request_data = {"new_message": "糖尿病の治療法について教えてください", "message_log": []}
+
+    with TestClient(app) as client:
+        response = client.post("/api/assistant-response", json=request_data, headers={"Accept": "text/event-stream"})
+
+    assert response.status_code == HTTP_OK
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = parse_events(response.text)
+    deltas = [data["text"] for event, data in events if event == "delta"]
+    assert "".join(deltas) == "糖尿病の治療法には食事療法、運動療法、薬物療法があります。"
+    # 1文字ずつのデルタがまとめられている
+    assert len(deltas) < len(fake_openai.response_text) / 4
+    assert [event for event, _ in events][-2:] == ["completed", "usage"]
+    usage = events[-1][1]
+    assert usage["completion_tokens"] == len(fake_openai.response_text)
+    assert usage["frames"] <= usage["completion_tokens"]
+    assert usage["ttft_ms"] is not None
+
+
+def test_assistant_response_sse_reports_upstream_error(fake_openai, monkeypatch, caplog):
+    # 接続できない上流を指定する
+    monkeypatch.setattr(get_settings(), "OPENAI_BASE_URL", "http://127.0.0.1:1/v1")
+    monkeypatch.setattr(get_settings(), "LLM_MAX_RETRIES", 0)
+    request_data = {"new_message": "糖尿病の治療法について教えてください", "message_log": []}
+
+    with TestClient(app) as client:
+        response = client.post("/api/assistant-response", json=request_data, headers={"Accept": "text/event-stream"})
+
+    assert response.status_code == HTTP_OK
+    assert [event for event, _ in parse_events(response.text)] == ["error", "usage"]
+    # 標準出力ではなくトレースバック付きでログに残す
+    records = [record for record in caplog.records if record.name == "app.api.endpoints.assistant_response"]
+    assert [record.levelname for record in records] == ["WARNING"]
+    assert records[0].exc_info is not None
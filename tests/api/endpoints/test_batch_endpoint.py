@@ -0,0 +1,97 @@
+import asyncio
+import json
+
+import httpx
+from fastapi.testclient import TestClient
+
+from app.core.config import get_settings
+from app.main import app
+
+# HTTPステータスコードの定数
+HTTP_OK = 200
+HTTP_BAD_REQUEST = 400
+HTTP_REQUEST_ENTITY_TOO_LARGE = 413
+
+
+def _ndjson(records: list) -> str:
+    return "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+
+
+def test_batch_runs_pipeline_per_item(fake_openai):
+    fake_openai.response_text = "[DB_EVIDENCE:NEED] <<COMPLETED>>"
+    body = _ndjson([{"id": "a", "new_message": "糖尿病の治療について"}, {"new_message": "高血圧の薬について", "message_log": []}])
+
+    with TestClient(app) as client:
+        response = client.post("/api/batch?concurrency=2", content=body, headers={"Content-Type": "application/x-ndjson"})
+
+    assert response.status_code == HTTP_OK
+    assert response.headers["content-type"] == "application/x-ndjson"
+    results = {result["id"]: result for result in map(json.loads, response.text.splitlines())}
+    assert set(results) == {"a", "2"}
+    for result in results.values():
+        assert result["error"] is None
+        assert result["result"] == "[DB_EVIDENCE:NEED] <<COMPLETED>>"
+        assert result["pubmed_query"] is not None
+        assert result["response"] == "[DB_EVIDENCE:NEED]"
+        assert result["completed"] is True
+    # 判定・PubMedクエリ・回答の3回ずつ
+    assert fake_openai.stats.requests == 6  # noqa: PLR2004
+
+
+def test_batch_reports_item_errors_without_failing(fake_openai):
+    body = _ndjson([{"id": "bad"}])
+
+    with TestClient(app) as client:
+        response = client.post("/api/batch?assistant=false", content=body)
+
+    assert response.status_code == HTTP_OK
+    result = json.loads(response.text)
+    assert result["id"] == "bad"
+    assert result["error"].startswith("ValidationError")
+    assert fake_openai.stats.requests == 0
+
+
+def test_batch_rejects_invalid_json(client):
+    response = client.post("/api/batch", content='{"new_message": "ok"}\nnot json\n')
+
+    assert response.status_code == HTTP_BAD_REQUEST
+    assert "line 2" in response.json()["detail"]
+
+
+def test_batch_rejects_too_many_items_before_reading_the_whole_body(monkeypatch):
+    monkeypatch.setattr(get_settings(), "BATCH_MAX_ITEMS", 3)
+    sent = []
+
+    async def body():
+        for number in range(1000):
+            sent.append(number)
+            yield _ndjson([{"new_message": f"質問{number}"}]).encode("utf-8")
+
+    async def post() -> httpx.Response:
+        # TestClientは本文をすべて読んでからアプリを呼ぶため、受信を1チャンクずつ渡すASGITransportを使う
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://testserver") as client:
+            return await client.post("/api/batch", content=body())
+
+    response = asyncio.run(post())
+
+    assert response.status_code == HTTP_REQUEST_ENTITY_TOO_LARGE
+    assert "max 3" in response.json()["detail"]
+    # 上限を超えた時点で読むのをやめる
+    assert len(sent) < 10  # noqa: PLR2004
+
+
+def test_batch_reads_lines_split_across_chunks(fake_openai):
+    data = _ndjson([{"id": "a", "message_log": []}, {"id": "b"}]).encode("utf-8")
+
+    async def body():
+        for start in range(0, len(data), 7):
+            yield data[start : start + 7]
+
+    async def post() -> httpx.Response:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://testserver") as client:
+            return await client.post("/api/batch?assistant=false", content=body())
+
+    response = asyncio.run(post())
+
+    assert response.status_code == HTTP_OK
+    assert sorted(json.loads(line)["id"] for line in response.text.splitlines()) == ["a", "b"]
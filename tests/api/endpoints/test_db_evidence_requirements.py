@@ -1,3 +1,4 @@
+import pytest
 from fastapi.testclient import TestClient
 
 from app.main import app
@@ -8,6 +9,12 @@ client = TestClient(app)
 HTTP_OK = 200
 
 
+@pytest.fixture(autouse=True)
+def _use_fake_openai(fake_openai):
+    # 実際のOpenAI APIの代わりにローカルの代替サーバーを使う
+    fake_openai.response_text = "[DB_EVIDENCE:NEED]"
+
+
 def test_db_evidence_requirements_endpoint():
     # テスト用のリクエストデータ
     request_data = {"new_message": "糖尿病の治療法について教えてください", "message_log": []}
@@ -0,0 +1,62 @@
+import json
+
+from fastapi.testclient import TestClient
+
+from app.core.config import get_settings
+from app.main import app
+from app.services.judge_classifier import train
+
+# HTTPステータスコードの定数
+HTTP_OK = 200
+
+
+def _enable_classifier(monkeypatch, tmp_path):
+    texts = ["糖尿病の治療法を教えて", "高血圧の薬の副作用は", "肺がんの予後は", "こんにちは", "ありがとうございました", "よろしくお願いします"]
+    classifier = train(texts, [1, 1, 1, 0, 0, 0], min_df=1)
+    path = tmp_path / "judge_classifier.json"
+    classifier.save(str(path))
+    settings = get_settings()
+    monkeypatch.setattr(settings, "JUDGE_CLASSIFIER_ENABLED", True)
+    monkeypatch.setattr(settings, "JUDGE_CLASSIFIER_PATH", str(path))
+    monkeypatch.setattr(settings, "JUDGE_CLASSIFIER_NEED_THRESHOLD", 0.6)
+    monkeypatch.setattr(settings, "JUDGE_CLASSIFIER_NOT_THRESHOLD", 0.6)
+    monkeypatch.setattr(settings, "JUDGE_DECISION_LOG_PATH", str(tmp_path / "decisions.jsonl"))
+
+
+def test_judge_answers_locally_when_confident(fake_openai, monkeypatch, tmp_path):
+    _enable_classifier(monkeypatch, tmp_path)
+
+    with TestClient(app) as client:
+        response = client.post("/api/db_evidence_requirements", json={"new_message": "ありがとうございました", "message_log": []})
+        metrics = client.get("/metrics").text
+
+    assert response.status_code == HTTP_OK
+    assert response.json() == {"result": "[DB_EVIDENCE:NOT]"}
+    assert fake_openai.stats.requests == 0
+    assert 'judge_classifier_decisions_total{outcome="not"}' in metrics
+
+
+def test_plan_skips_llm_when_classifier_says_not(fake_openai, monkeypatch, tmp_path):
+    _enable_classifier(monkeypatch, tmp_path)
+
+    with TestClient(app) as client:
+        response = client.post("/api/plan", json={"new_message": "こんにちは", "message_log": []})
+
+    assert response.status_code == HTTP_OK
+    assert response.json() == {"result": "[DB_EVIDENCE:NOT]", "pubmed_query": None}
+    assert fake_openai.stats.requests == 0
+
+
+def test_llm_decisions_are_logged_for_training(fake_openai, monkeypatch, tmp_path):
+    _enable_classifier(monkeypatch, tmp_path)
+    monkeypatch.setattr(get_settings(), "JUDGE_CLASSIFIER_NOT_THRESHOLD", 1.0)
+    monkeypatch.setattr(get_settings(), "JUDGE_CLASSIFIER_NEED_THRESHOLD", 1.0)
+    fake_openai.response_text = "[DB_EVIDENCE:NEED]"
+
+    with TestClient(app) as client:
+        response = client.post("/api/db_evidence_requirements", json={"new_message": "喘息の吸入薬について", "message_log": []})
+
+    assert response.json() == {"result": "[DB_EVIDENCE:NEED]"}
+    assert fake_openai.stats.requests == 1
+    records = [json.loads(line) for line in (tmp_path / "decisions.jsonl").read_text(encoding="utf-8").splitlines()]
+    assert [(record["text"], record["result"]) for record in records] == [("喘息の吸入薬について", "[DB_EVIDENCE:NEED]")]
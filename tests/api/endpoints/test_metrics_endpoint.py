@@ -0,0 +1,38 @@
+from fastapi.testclient import TestClient
+
+from app.main import app
+
+# HTTPステータスコードの定数
+HTTP_OK = 200
+
+
+def test_metrics_include_request_and_llm_measurements(fake_openai):
+    fake_openai.response_text = "[DB_EVIDENCE:NEED]"
+
+    with TestClient(app) as client:
+        client.post("/api/db_evidence_requirements", json={"new_message": "メトリクス計測の確認です", "message_log": []})
+        client.post("/api/assistant-response", json={"new_message": "メトリクス計測の確認です", "message_log": []})
+        client.post(
+            "/api/assistant-response", json={"new_message": "SSEの計測の確認です", "message_log": []}, headers={"Accept": "text/event-stream"}
+        )
+        response = client.get("/metrics")
+
+    assert response.status_code == HTTP_OK
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    body = response.text
+    assert 'http_request_duration_seconds_count{endpoint="/api/db_evidence_requirements",method="POST",status="200"}' in body
+    assert 'http_time_to_first_byte_seconds_count{endpoint="/api/assistant-response",method="POST"}' in body
+    assert 'app_stage_duration_seconds_count{endpoint="/api/db_evidence_requirements",stage="history"}' in body
+    # プロンプトの組み立て・上流・最初のトークンまで・生成・整形を段階ごとに分けて記録する
+    for endpoint, stages in [
+        ("/api/db_evidence_requirements", ["prompt", "upstream"]),
+        ("/api/assistant-response", ["history", "prompt", "ttft", "streaming", "serialize"]),
+    ]:
+        for stage in stages:
+            assert f'app_stage_duration_seconds_count{{endpoint="{endpoint}",stage="{stage}"}}' in body
+    assert 'llm_request_duration_seconds_count{endpoint="/api/db_evidence_requirements",model="gpt-4o-mini",kind="invoke"}' in body
+    assert 'llm_time_to_first_token_seconds_count{endpoint="/api/assistant-response",model="gpt-4o-mini"}' in body
+    assert 'llm_streams_total{endpoint="/api/assistant-response",outcome="completed"}' in body
+    assert 'llm_completion_tokens_total{endpoint="/api/db_evidence_requirements",model="gpt-4o-mini"}' in body
+    # /metrics 自体は計測しない
+    assert 'endpoint="/metrics"' not in body
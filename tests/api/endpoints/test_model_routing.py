@@ -0,0 +1,35 @@
+from fastapi.testclient import TestClient
+
+from app.core.config import get_settings
+from app.main import app
+
+# HTTPステータスコードの定数
+HTTP_OK = 200
+
+
+def test_judge_fails_over_to_fallback_model(fake_openai, monkeypatch):
+    settings = get_settings()
+    monkeypatch.setattr(settings, "MODEL_ROUTES", {"judge": ["gpt-4o", "gpt-4o-mini"]})
+    monkeypatch.setattr(settings, "LLM_MAX_RETRIES", 0)
+    fake_openai.response_text = "[DB_EVIDENCE:NEED]"
+    fake_openai.error_models = ("gpt-4o",)
+
+    with TestClient(app) as client:
+        response = client.post("/api/db_evidence_requirements", json={"new_message": "フェイルオーバーの確認です", "message_log": []})
+        metrics = client.get("/metrics").text
+
+    assert response.status_code == HTTP_OK
+    assert response.json() == {"result": "[DB_EVIDENCE:NEED]"}
+    assert fake_openai.stats.requests == 2  # noqa: PLR2004
+    assert 'llm_route_decisions_total{route="judge",model="gpt-4o-mini",reason="failover"}' in metrics
+
+
+def test_assistant_uses_configured_model(fake_openai, monkeypatch):
+    monkeypatch.setattr(get_settings(), "MODEL_ROUTES", {"assistant": ["gpt-4o"]})
+
+    with TestClient(app) as client:
+        response = client.post("/api/assistant-response", json={"new_message": "モデル指定の確認です", "message_log": []})
+        metrics = client.get("/metrics").text
+
+    assert response.status_code == HTTP_OK
+    assert 'llm_route_decisions_total{route="assistant",model="gpt-4o",reason="primary"}' in metrics
@@ -0,0 +1,74 @@
+import asyncio
+
+import httpx
+
+from app.core.config import get_settings
+from app.main import app
+from app.services.llm_service import close_llm_clients
+
+# HTTPステータスコードの定数
+HTTP_OK = 200
+HTTP_TOO_MANY_REQUESTS = 429
+HTTP_INTERNAL_SERVER_ERROR = 500
+HTTP_SERVICE_UNAVAILABLE = 503
+
+REQUEST_DATA = {"new_message": "糖尿病の治療法について教えてください", "message_log": []}
+
+
+async def _post_concurrently(path: str, count: int) -> list[httpx.Response]:
+    transport = httpx.ASGITransport(app=app)
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver", timeout=30) as client:
+            return await asyncio.gather(*(client.post(path, json=REQUEST_DATA) for _ in range(count)))
+    finally:
+        await close_llm_clients()
+
+
+def test_full_admission_queue_returns_429(fake_openai, monkeypatch):
+    settings = get_settings()
+    monkeypatch.setattr(settings, "SINGLE_FLIGHT_ENABLED", False)
+    monkeypatch.setattr(settings, "ADMISSION_MAX_CONCURRENCY", 1)
+    monkeypatch.setattr(settings, "ADMISSION_MAX_QUEUE", 0)
+    fake_openai.response_text = "[DB_EVIDENCE:NEED]"
+    fake_openai.ttft = 0.3
+
+    responses = asyncio.run(_post_concurrently("/api/db_evidence_requirements", 3))
+
+    assert sorted(response.status_code for response in responses) == [HTTP_OK, HTTP_TOO_MANY_REQUESTS, HTTP_TOO_MANY_REQUESTS]
+    rejected = next(response for response in responses if response.status_code == HTTP_TOO_MANY_REQUESTS)
+    assert int(rejected.headers["Retry-After"]) >= 1
+    assert fake_openai.stats.requests == 1
+
+
+def test_upstream_rate_limit_returns_429(fake_openai, monkeypatch):
+    monkeypatch.setattr(get_settings(), "LLM_MAX_RETRIES", 0)
+    monkeypatch.setattr(fake_openai, "error_status", HTTP_TOO_MANY_REQUESTS)
+    fake_openai.error_rate = 1.0
+
+    responses = asyncio.run(_post_concurrently("/api/pubmed-query", 1))
+
+    assert responses[0].status_code == HTTP_TOO_MANY_REQUESTS
+    assert int(responses[0].headers["Retry-After"]) >= 1
+
+
+def test_open_circuit_returns_503_without_calling_upstream(fake_openai, monkeypatch):
+    settings = get_settings()
+    monkeypatch.setattr(settings, "SINGLE_FLIGHT_ENABLED", False)
+    monkeypatch.setattr(settings, "LLM_RESILIENCE_ENABLED", True)
+    monkeypatch.setattr(settings, "LLM_RETRY_ATTEMPTS", 0)
+    monkeypatch.setattr(settings, "LLM_BREAKER_FAILURE_THRESHOLD", 2)
+    fake_openai.error_rate = 1.0
+
+    async def scenario() -> list[httpx.Response]:
+        transport = httpx.ASGITransport(app=app)
+        try:
+            async with httpx.AsyncClient(transport=transport, base_url="http://testserver", timeout=30) as client:
+                return [await client.post("/api/db_evidence_requirements", json=REQUEST_DATA) for _ in range(3)]
+        finally:
+            await close_llm_clients()
+
+    responses = asyncio.run(scenario())
+
+    assert [response.status_code for response in responses] == [HTTP_INTERNAL_SERVER_ERROR, HTTP_INTERNAL_SERVER_ERROR, HTTP_SERVICE_UNAVAILABLE]
+    assert int(responses[2].headers["Retry-After"]) >= 1
+    assert fake_openai.stats.requests == 2  # noqa: PLR2004
@@ -0,0 +1,83 @@
+import asyncio
+import time
+
+from fastapi.testclient import TestClient
+
+from app.api.endpoints import plan
+from app.main import app
+
+# HTTPステータスコードの定数
+HTTP_OK = 200
+
+UPSTREAM_LATENCY = 0.3
+
+
+def test_plan_endpoint_returns_judge_and_query(fake_openai):
+    fake_openai.response_text = "[DB_EVIDENCE:NEED]"
+    request_data = {"new_message": "糖尿病の治療法について教えてください", "message_log": []}
+
+    with TestClient(app) as client:
+        response = client.post("/api/plan", json=request_data)
+
+    assert response.status_code == HTTP_OK
+    assert response.json()["result"] == "[DB_EVIDENCE:NEED]"
+    assert isinstance(response.json()["pubmed_query"], str)
+
+
+def test_plan_endpoint_skips_query_when_not_needed(fake_openai):
+    fake_openai.response_text = "[DB_EVIDENCE:NOT]"
+    request_data = {"new_message": "今日の天気はどうですか？", "message_log": []}
+
+    with TestClient(app) as client:
+        response = client.post("/api/plan", json=request_data)
+
+    assert response.status_code == HTTP_OK
+    assert response.json() == {"result": "[DB_EVIDENCE:NOT]", "pubmed_query": None}
+
+
+def test_plan_endpoint_cancels_query_when_not_needed(fake_openai, monkeypatch):
+    fake_openai.response_text = "[DB_EVIDENCE:NOT]"
+    events = []
+
+    async def slow_pubmed_query(message_log):
+        events.append("started")
+        try:
+            await asyncio.sleep(UPSTREAM_LATENCY * 10)
+        except asyncio.CancelledError:
+            # 接続の後始末などキャンセル後にも時間がかかる処理を模す
+            await asyncio.sleep(UPSTREAM_LATENCY)
+            events.append("cancelled")
+            raise
+        events.append("completed")
+        return "query"
+
+    monkeypatch.setattr(plan, "_pubmed_query", slow_pubmed_query)
+    request_data = {"new_message": "今日の天気はどうですか？", "message_log": []}
+
+    with TestClient(app) as client:
+        started = time.perf_counter()
+        response = client.post("/api/plan", json=request_data)
+        elapsed = time.perf_counter() - started
+
+    assert response.json() == {"result": "[DB_EVIDENCE:NOT]", "pubmed_query": None}
+    # クエリ生成は判定の応答を待たずにキャンセルされ、後始末まで終えてから応答を返す
+    assert events == ["started", "cancelled"]
+    assert fake_openai.stats.requests == 1
+    assert elapsed < UPSTREAM_LATENCY * 10
+
+
+def test_plan_endpoint_runs_calls_concurrently(fake_openai):
+    fake_openai.response_text = "[DB_EVIDENCE:NEED]"
+    request_data = {"new_message": "高血圧の最新の治療法について教えてください", "message_log": []}
+
+    with TestClient(app) as client:
+        # 接続確立の時間を除くため一度呼び出しておく
+        client.post("/api/plan", json=request_data)
+        fake_openai.ttft = UPSTREAM_LATENCY
+        started = time.perf_counter()
+        response = client.post("/api/plan", json=request_data)
+        elapsed = time.perf_counter() - started
+
+    assert response.status_code == HTTP_OK
+    # 逐次実行なら 2 * UPSTREAM_LATENCY 秒以上かかる
+    assert elapsed < UPSTREAM_LATENCY * 1.8
@@ -0,0 +1,39 @@
+from fastapi.testclient import TestClient
+
+from app.main import app
+
+# HTTPステータスコードの定数
+HTTP_OK = 200
+HTTP_NOT_FOUND = 404
+
+
+def test_assistant_response_appends_turns_to_session(fake_openai):
+    fake_openai.response_text = "回答です。"
+
+    with TestClient(app) as client:
+        session_id = client.post("/api/sessions").json()["session_id"]
+        for question in ("糖尿病の治療法について教えてください", "副作用はありますか？"):
+            response = client.post("/api/assistant-response", json={"new_message": question, "session_id": session_id})
+            assert response.status_code == HTTP_OK
+        session = client.get(f"/api/sessions/{session_id}").json()
+
+    assert [msg["role"] for msg in session["message_log"]] == ["user", "assistant", "user", "assistant"]
+    assert session["message_log"][2]["content"] == "副作用はありますか？"
+    assert session["message_log"][3]["content"] == "回答です。"
+
+
+def test_judge_does_not_modify_session(fake_openai):
+    fake_openai.response_text = "[DB_EVIDENCE:NEED]"
+
+    with TestClient(app) as client:
+        session_id = client.post("/api/sessions").json()["session_id"]
+        response = client.post("/api/db_evidence_requirements", json={"new_message": "糖尿病について", "session_id": session_id})
+        session = client.get(f"/api/sessions/{session_id}").json()
+
+    assert response.json() == {"result": "[DB_EVIDENCE:NEED]"}
+    assert session["message_log"] == []
+
+
+def test_unknown_session_returns_404(client):
+    assert client.get("/api/sessions/unknown").status_code == HTTP_NOT_FOUND
+    assert client.delete("/api/sessions/unknown").status_code == HTTP_NOT_FOUND
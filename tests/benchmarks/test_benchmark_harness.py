@@ -0,0 +1,55 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from app.main import app
+from app.testing.benchmark import build_report, percentile, run_benchmark
+
+# HTTPステータスコードの定数
+HTTP_INTERNAL_SERVER_ERROR = 500
+
+UPSTREAM_TTFT = 0.05
+
+
+def test_percentile_interpolates():
+    values = [1.0, 2.0, 3.0, 4.0]
+    assert percentile(values, 50) == pytest.approx(2.5)
+    assert percentile(values, 100) == pytest.approx(4.0)
+    assert percentile([], 99) == 0.0
+
+
+def test_benchmark_reports_latency_ttft_and_loop_lag(fake_openai, tmp_path):
+    fake_openai.ttft = UPSTREAM_TTFT
+    fake_openai.inter_token_delay = 0.001
+
+    results = asyncio.run(run_benchmark(app, ["db_evidence_requirements", "assistant-response"], [2], requests=4))
+    report = build_report(results, fake_openai)
+    path = tmp_path / "benchmark.json"
+    path.write_text(json.dumps(report, ensure_ascii=False))
+
+    saved = json.loads(path.read_text())
+    assert saved["fake_openai"]["ttft"] == UPSTREAM_TTFT
+    assert [(result["endpoint"], result["concurrency"]) for result in saved["results"]] == [
+        ("db_evidence_requirements", 2),
+        ("assistant-response", 2),
+    ]
+    for result in saved["results"]:
+        assert result["errors"] == 0
+        assert result["throughput_rps"] > 0
+        assert result["latency_ms"]["p50"] >= UPSTREAM_TTFT * 1000
+        assert set(result["latency_ms"]) == {"p50", "p95", "p99", "mean", "max"}
+        assert result["ttft_ms"]
+        assert result["loop_lag_ms"]
+
+
+def test_fake_openai_injects_errors(fake_openai, fake_openai_server):
+    _, base_url = fake_openai_server
+    fake_openai.error_rate = 1.0
+
+    response = httpx.post(f"{base_url}/chat/completions", json={"model": "gpt-4o-mini", "messages": []})
+
+    assert response.status_code == HTTP_INTERNAL_SERVER_ERROR
+    assert response.json()["error"]["type"] == "server_error"
+    assert fake_openai.stats.errors == 1
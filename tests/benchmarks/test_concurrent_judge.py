@@ -0,0 +1,75 @@
+import asyncio
+import time
+
+import httpx
+
+from app.core.config import get_settings
+from app.main import app
+from app.services.llm_service import close_llm_clients
+
+# HTTPステータスコードの定数
+HTTP_OK = 200
+HTTP_GATEWAY_TIMEOUT = 504
+
+CONCURRENCY = 8
+UPSTREAM_LATENCY = 0.5
+
+
+async def _post_concurrently(path: str) -> tuple[list[httpx.Response], float]:
+    request_data = {"new_message": "糖尿病の治療法について教えてください", "message_log": []}
+    transport = httpx.ASGITransport(app=app)
+    try:
+        # ASGITransportはlifespanを実行しないため、サーバーと同じく起動時の準備（接続・エンコーディングの読み込み）を済ませてから計る
+        async with app.router.lifespan_context(app), httpx.AsyncClient(transport=transport, base_url="http://testserver", timeout=30) as client:
+            started = time.perf_counter()
+            responses = await asyncio.gather(*(client.post(path, json=request_data) for _ in range(CONCURRENCY)))
+            elapsed = time.perf_counter() - started
+    finally:
+        await close_llm_clients()
+    return responses, elapsed
+
+
+def test_concurrent_judge_calls_overlap(fake_openai, monkeypatch):
+    # 同一リクエストをまとめずに、上流呼び出し自体が並行に実行されることを確認する
+    monkeypatch.setattr(get_settings(), "SINGLE_FLIGHT_ENABLED", False)
+    fake_openai.response_text = "[DB_EVIDENCE:NEED]"
+    fake_openai.ttft = UPSTREAM_LATENCY
+
+    responses, elapsed = asyncio.run(_post_concurrently("/api/db_evidence_requirements"))
+
+    assert all(response.status_code == HTTP_OK for response in responses)
+    assert all(response.json()["result"] == "[DB_EVIDENCE:NEED]" for response in responses)
+    # 逐次実行なら CONCURRENCY * UPSTREAM_LATENCY 秒かかる
+    assert elapsed < UPSTREAM_LATENCY * 2, f"{CONCURRENCY} concurrent judge calls took {elapsed:.2f}s (serial: {CONCURRENCY * UPSTREAM_LATENCY:.2f}s)"
+    assert fake_openai.stats.requests == CONCURRENCY
+
+
+def test_identical_judge_calls_share_one_upstream_call(fake_openai):
+    fake_openai.response_text = "[DB_EVIDENCE:NEED]"
+    fake_openai.ttft = UPSTREAM_LATENCY
+
+    responses, _ = asyncio.run(_post_concurrently("/api/db_evidence_requirements"))
+
+    assert all(response.json()["result"] == "[DB_EVIDENCE:NEED]" for response in responses)
+    assert fake_openai.stats.requests == 1
+
+
+def test_concurrent_pubmed_query_calls_overlap(fake_openai, monkeypatch):
+    monkeypatch.setattr(get_settings(), "SINGLE_FLIGHT_ENABLED", False)
+    fake_openai.response_text = '"Diabetes Mellitus"[MeSH Terms]'
+    fake_openai.ttft = UPSTREAM_LATENCY
+
+    responses, elapsed = asyncio.run(_post_concurrently("/api/pubmed-query"))
+
+    assert all(response.status_code == HTTP_OK for response in responses)
+    assert elapsed < UPSTREAM_LATENCY * 2
+
+
+def test_judge_times_out(fake_openai, monkeypatch):
+    monkeypatch.setattr(get_settings(), "LLM_CALL_TIMEOUT", 0.1)
+    fake_openai.ttft = 1.0
+
+    responses, elapsed = asyncio.run(_post_concurrently("/api/db_evidence_requirements"))
+
+    assert all(response.status_code == HTTP_GATEWAY_TIMEOUT for response in responses)
+    assert elapsed < 1.0
@@ -0,0 +1,23 @@
+from app.testing.vector_benchmark import clustered_vectors, run_vector_benchmark
+
+
+def test_vector_benchmark_reports_recall_against_exact_search(tmp_path):
+    data = clustered_vectors(1020, 16, clusters=10)
+
+    results = run_vector_benchmark(data[:1000], data[1000:], str(tmp_path), k=5, nlist=10, nprobes=(2, 10), batch_size=8)
+
+    assert [(result.name, result.dtype, result.nprobe) for result in results] == [
+        ("exact", "float32", None),
+        ("ivf", "float32", 2),
+        ("ivf", "float32", 10),
+        ("exact", "int8", None),
+        ("ivf", "int8", 2),
+        ("ivf", "int8", 10),
+    ]
+    assert results[0].recall_at_k == 1.0
+    # 全分割を探すIVFは厳密な検索と同じ結果になる
+    assert results[2].recall_at_k == 1.0
+    for result in results:
+        assert result.recall_at_k >= 0.8  # noqa: PLR2004
+        assert result.latency_ms["p50"] > 0
+        assert result.batch_qps > 0
@@ -1,9 +1,38 @@
 import pytest
 from fastapi.testclient import TestClient
 
+from app.core.config import get_settings
 from app.main import app
+from app.testing.fake_openai import FakeOpenAIConfig, FakeOpenAIStats, run_fake_openai_server
 
 
 @pytest.fixture
 def client():
     return TestClient(app)
+
+
+@pytest.fixture(scope="session")
+def fake_openai_server():
+    config = FakeOpenAIConfig()
+    with run_fake_openai_server(config) as base_url:
+        yield config, base_url
+
+
+@pytest.fixture
+def fake_openai(fake_openai_server, monkeypatch):
+    """
+    ローカルの代替OpenAIサーバーにLLM呼び出しを向ける
+    """
+    config, base_url = fake_openai_server
+    settings = get_settings()
+    monkeypatch.setattr(settings, "OPENAI_API_KEY", "test-key")
+    monkeypatch.setattr(settings, "OPENAI_BASE_URL", base_url)
+    monkeypatch.setattr(config, "response_text", FakeOpenAIConfig.response_text)
+    monkeypatch.setattr(config, "ttft", FakeOpenAIConfig.ttft)
+    monkeypatch.setattr(config, "error_rate", FakeOpenAIConfig.error_rate)
+    monkeypatch.setattr(config, "error_status", FakeOpenAIConfig.error_status)
+    monkeypatch.setattr(config, "slow_rate", FakeOpenAIConfig.slow_rate)
+    monkeypatch.setattr(config, "error_models", FakeOpenAIConfig.error_models)
+    monkeypatch.setattr(config, "inter_token_delay", FakeOpenAIConfig.inter_token_delay)
+    monkeypatch.setattr(config, "stats", FakeOpenAIStats())
+    return config
@@ -0,0 +1,94 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+from app.services.admission import PRIORITY_HIGH, PRIORITY_LOW, AdmissionRejectedError, ModelLimiter, retry_after_from_headers
+
+
+def _limiter(max_concurrency: int = 1, tokens_per_minute: int = 0, max_queue: int = 10, max_wait: float = 5.0) -> ModelLimiter:
+    return ModelLimiter("gpt-4o-mini", max_concurrency, tokens_per_minute, max_queue, max_wait)
+
+
+def test_high_priority_waiters_are_admitted_first():
+    async def scenario():
+        limiter = _limiter()
+        order = []
+        first = await limiter.acquire(10, PRIORITY_LOW)
+
+        async def call(name: str, priority: int):
+            ticket = await limiter.acquire(10, priority)
+            order.append(name)
+            ticket.release()
+
+        tasks = [asyncio.create_task(call("assistant", PRIORITY_LOW)), asyncio.create_task(call("judge", PRIORITY_HIGH))]
+        await asyncio.sleep(0)
+        assert limiter.queued == len(tasks)
+        first.release()
+        await asyncio.gather(*tasks)
+        return order, limiter
+
+    order, limiter = asyncio.run(scenario())
+    assert order == ["judge", "assistant"]
+    assert (limiter.active, limiter.queued) == (0, 0)
+
+
+def test_full_queue_rejects_immediately_with_retry_after():
+    async def scenario():
+        limiter = _limiter(max_queue=0)
+        await limiter.acquire(10, PRIORITY_HIGH)
+        with pytest.raises(AdmissionRejectedError) as exc_info:
+            await limiter.acquire(10, PRIORITY_HIGH)
+        return exc_info.value
+
+    error = asyncio.run(scenario())
+    assert (error.reason, error.retry_after) == ("queue_full", 1)
+
+
+def test_waiter_is_rejected_after_max_wait_and_leaves_queue():
+    async def scenario():
+        limiter = _limiter(max_wait=0.05)
+        await limiter.acquire(10, PRIORITY_HIGH)
+        with pytest.raises(AdmissionRejectedError) as exc_info:
+            await limiter.acquire(10, PRIORITY_HIGH)
+        return exc_info.value, limiter
+
+    error, limiter = asyncio.run(scenario())
+    assert error.reason == "timeout"
+    assert limiter.queued == 0
+
+
+def test_token_rate_limit_delays_until_refilled():
+    async def scenario():
+        limiter = _limiter(max_concurrency=10, tokens_per_minute=6000)  # 100トークン/秒
+        (await limiter.acquire(6000)).release()
+        started = time.monotonic()
+        (await limiter.acquire(10)).release()
+        return time.monotonic() - started
+
+    assert 0.05 < asyncio.run(scenario()) < 0.5  # noqa: PLR2004
+
+
+def test_upstream_rate_limit_pauses_and_halves_concurrency():
+    async def scenario():
+        limiter = _limiter(max_concurrency=4)
+        limiter.on_rate_limited(0.1)
+        limiter.on_rate_limited(0.1)  # 同じ一時停止中の429では半減させない
+        started = time.monotonic()
+        ticket = await limiter.acquire(10)
+        waited = time.monotonic() - started
+        ticket.release()
+        return waited, limiter
+
+    waited, limiter = asyncio.run(scenario())
+    assert waited >= 0.09  # noqa: PLR2004
+    assert limiter.concurrency_limit == 2  # noqa: PLR2004
+
+
+def test_retry_after_from_headers():
+    assert retry_after_from_headers(httpx.Headers({"retry-after-ms": "1500"})) == 1.5  # noqa: PLR2004
+    assert retry_after_from_headers(httpx.Headers({"retry-after": "3"})) == 3  # noqa: PLR2004
+    headers = httpx.Headers({"x-ratelimit-remaining-tokens": "0", "x-ratelimit-reset-tokens": "1m30.5s", "x-ratelimit-reset-requests": "20ms"})
+    assert retry_after_from_headers(headers) == 90.5  # noqa: PLR2004
+    assert retry_after_from_headers(httpx.Headers({})) is None
@@ -0,0 +1,83 @@
+import asyncio
+import json
+import subprocess
+import sys
+
+from app.services.batch import load_checkpoint, map_unordered, read_items, run_batch_file
+
+
+def _collect(fn, items, concurrency):
+    async def run():
+        return [result async for result in map_unordered(fn, items, concurrency)]
+
+    return asyncio.run(run())
+
+
+def test_map_unordered_bounds_concurrency_and_reads_lazily():
+    pulled = []
+    running = 0
+    peak = 0
+
+    def items():
+        for i in range(10):
+            pulled.append(i)
+            yield i
+
+    async def work(i: int) -> int:
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        # 同時実行数を超えて入力を先読みしていない
+        assert len(pulled) <= i + 3
+        await asyncio.sleep(0.01 * (i % 3))
+        running -= 1
+        return i * 2
+
+    results = _collect(work, items(), concurrency=3)
+
+    assert sorted(results) == [i * 2 for i in range(10)]
+    assert peak == 3  # noqa: PLR2004
+
+
+def test_checkpoint_truncates_partial_line_and_retries_errors(tmp_path):
+    path = tmp_path / "results.jsonl"
+    path.write_text('{"id": "1"}\n{"id": "2", "error": "boom"}\n{"id": "3"', encoding="utf-8")
+
+    assert load_checkpoint(str(path)) == {"1", "2"}
+    assert path.read_text(encoding="utf-8") == '{"id": "1"}\n{"id": "2", "error": "boom"}\n'
+    assert load_checkpoint(str(path), retry_errors=True) == {"1"}
+
+
+def test_read_items_uses_ids_and_text_field(tmp_path):
+    path = tmp_path / "requests.jsonl"
+    path.write_text('{"request_id": "user-001", "body": "質問1"}\n\n{"body": "質問2"}\n', encoding="utf-8")
+
+    items = list(read_items(str(path), text_field="body", skip_ids=frozenset({"user-001"})))
+
+    assert items == [{"id": "3", "new_message": "質問2", "message_log": []}]
+
+
+def test_run_batch_file_resumes_from_checkpoint(tmp_path):
+    input_path = tmp_path / "questions.jsonl"
+    output_path = tmp_path / "results.jsonl"
+    input_path.write_text("".join(json.dumps({"id": str(i), "new_message": f"質問{i}"}) + "\n" for i in range(5)), encoding="utf-8")
+    output_path.write_text('{"id": "0", "response": "済"}\n{"id": "1", "response": "済"}\n', encoding="utf-8")
+    calls = []
+
+    async def answer(item: dict) -> dict:
+        calls.append(item["id"])
+        return {"id": item["id"], "response": item["new_message"]}
+
+    summary = asyncio.run(run_batch_file(answer, str(input_path), str(output_path), concurrency=2, progress_interval=0))
+
+    assert sorted(calls) == ["2", "3", "4"]
+    assert summary["done"] == 3  # noqa: PLR2004
+    assert summary["skipped"] == 2  # noqa: PLR2004
+    results = [json.loads(line) for line in output_path.read_text(encoding="utf-8").splitlines()]
+    assert sorted(result["id"] for result in results) == ["0", "1", "2", "3", "4"]
+
+
+def test_cli_help():
+    result = subprocess.run([sys.executable, "-m", "app.services.batch", "--help"], capture_output=True, text=True, check=False)
+    assert result.returncode == 0
+    assert "--retry-errors" in result.stdout
@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.core.config import get_settings
+from app.main import app
+from app.services.cassette import CassetteCompletions, CassetteMissError, CassetteStore, request_hash
+
+# HTTPステータスコードの定数
+HTTP_OK = 200
+HTTP_INTERNAL_SERVER_ERROR = 500
+
+JUDGE_REQUEST = {"new_message": "糖尿病の治療法について教えてください", "message_log": []}
+
+
+def test_record_then_replay_without_network(fake_openai, monkeypatch, tmp_path):
+    settings = get_settings()
+    monkeypatch.setattr(settings, "LLM_CASSETTE_PATH", str(tmp_path / "cassettes.sqlite3"))
+    monkeypatch.setattr(settings, "LLM_MODE", "record")
+    fake_openai.response_text = "[DB_EVIDENCE:NEED]"
+    fake_openai.inter_token_delay = 0.001
+
+    with TestClient(app) as client:
+        recorded_judge = client.post("/api/db_evidence_requirements", json=JUDGE_REQUEST).json()
+        recorded_stream = client.post("/api/assistant-response", json=JUDGE_REQUEST).text
+    upstream_requests = fake_openai.stats.requests
+
+    # 再生モードでは上流に到達できなくても記録から応答する
+    monkeypatch.setattr(settings, "LLM_MODE", "replay")
+    monkeypatch.setattr(settings, "OPENAI_BASE_URL", "http://127.0.0.1:9/v1")
+    with TestClient(app) as client:
+        replayed_judge = client.post("/api/db_evidence_requirements", json=JUDGE_REQUEST)
+        replayed_stream = client.post("/api/assistant-response", json=JUDGE_REQUEST)
+        missing = client.post("/api/db_evidence_requirements", json={"new_message": "未記録の質問", "message_log": []})
+
+    assert replayed_judge.status_code == HTTP_OK
+    assert replayed_judge.json() == recorded_judge
+    assert replayed_stream.text == recorded_stream == "[DB_EVIDENCE:NEED]"
+    assert missing.status_code == HTTP_INTERNAL_SERVER_ERROR
+    assert fake_openai.stats.requests == upstream_requests
+
+
+def test_replay_keeps_recorded_chunk_timing(tmp_path):
+    store = CassetteStore(str(tmp_path / "cassettes.sqlite3"))
+    params = {"model": "gpt-4o-mini", "messages": [{"role": "user", "content": "質問"}], "stream": True}
+    key = request_hash(params)
+    store.put(key, params, {"stream": True, "model": "gpt-4o-mini", "events": [[0.05, "回", None], [0.1, "答", None], [0.1, None, "stop"]]})
+
+    async def replay(speed: float):
+        completions = CassetteCompletions(None, store, "replay", replay_speed=speed)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        chunks = [chunk async for chunk in await completions.create(**params)]
+        return chunks, loop.time() - started
+
+    chunks, elapsed = asyncio.run(replay(1.0))
+    assert [chunk["choices"][0]["delta"].get("content") for chunk in chunks] == ["回", "答", None]
+    assert elapsed >= 0.1  # noqa: PLR2004
+    assert asyncio.run(replay(0.0))[1] < 0.05  # noqa: PLR2004
+
+    async def miss():
+        await CassetteCompletions(None, store, "replay").create(model="gpt-4o-mini", messages=[], stream=False)
+
+    with pytest.raises(CassetteMissError):
+        asyncio.run(miss())
+    store.close()
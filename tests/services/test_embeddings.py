@@ -0,0 +1,78 @@
+import threading
+
+from langchain_core.embeddings import Embeddings
+
+from app.services.embeddings import BatchedEmbeddings, EmbeddingCache, RateBudget, token_batches
+from app.services.ingest import chunk_ids
+
+
+class CountingEmbeddings(Embeddings):
+    def __init__(self):
+        self.calls: list[list[str]] = []
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        with self._lock:
+            self.calls.append(texts)
+        return [[float(len(text)), 0.5] for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return [float(len(text)), 1.0]
+
+
+def test_batched_embeddings_dedupes_and_reuses_cache(tmp_path):
+    upstream = CountingEmbeddings()
+    path = str(tmp_path / "embeddings.sqlite3")
+    embeddings = BatchedEmbeddings(upstream, "test-model", EmbeddingCache(path), max_batch_tokens=1000, max_batch_items=2)
+
+    vectors = embeddings.embed_documents(["a", "bb", "a", "ccc"])
+
+    assert vectors == [[1.0, 0.5], [2.0, 0.5], [1.0, 0.5], [3.0, 0.5]]
+    # 重複を除いた3件を2件ずつのバッチで埋め込む
+    assert sorted(text for call in upstream.calls for text in call) == ["a", "bb", "ccc"]
+    assert len(upstream.calls) == 2  # noqa: PLR2004
+
+    # 別のプロセスで開き直してもキャッシュから返し、上流は呼ばない
+    reopened = BatchedEmbeddings(upstream, "test-model", EmbeddingCache(path))
+    assert reopened.embed_documents(["ccc", "a"]) == [[3.0, 0.5], [1.0, 0.5]]
+    assert len(upstream.calls) == 2  # noqa: PLR2004
+    assert reopened.stats()["cache_hits"] == 2  # noqa: PLR2004
+
+    # モデルが違えば別のキーになる
+    BatchedEmbeddings(upstream, "other-model", EmbeddingCache(path)).embed_documents(["a"])
+    assert upstream.calls[-1] == ["a"]
+
+
+def test_token_batches_respects_token_and_item_limits():
+    assert token_batches([3, 3, 3, 10, 1], max_tokens=6, max_items=10) == [[0, 1], [2], [3], [4]]
+    assert token_batches([1, 1, 1], max_tokens=100, max_items=2) == [[0, 1], [2]]
+
+
+def test_rate_budget_waits_for_tokens(monkeypatch):
+    now = [0.0]
+    sleeps: list[float] = []
+
+    def sleep(seconds: float):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    monkeypatch.setattr("app.services.embeddings.time.sleep", sleep)
+    budget = RateBudget(tokens_per_minute=600, max_concurrency=2, clock=lambda: now[0])
+
+    budget.acquire(600)
+    budget.release()
+    assert sleeps == []
+    # バケットが空なので60トークン分（6秒）補充されるまで待つ
+    budget.acquire(60)
+    budget.release()
+    assert sleeps == [6.0]
+
+
+def test_chunk_ids_are_stable_and_distinguish_duplicates():
+    ids = chunk_ids("a.pdf", ["x", "y", "x"])
+
+    assert ids == chunk_ids("a.pdf", ["x", "y", "x"])
+    assert len(set(ids)) == 3  # noqa: PLR2004
+    # 他のチャンクが変わっても同じ本文のIDは変わらない
+    assert chunk_ids("a.pdf", ["z", "x"])[1] == ids[0]
+    assert chunk_ids("b.pdf", ["x"])[0] != ids[0]
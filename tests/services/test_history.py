@@ -0,0 +1,81 @@
+import asyncio
+
+from app.services.history import SUMMARY_ROLE, HistoryCompactor
+from app.services.llm_service import to_langchain_messages
+
+
+def count_chars(message: dict) -> int:
+    return len(message["content"])
+
+
+def make_messages(count: int) -> list:
+    roles = ("user", "assistant")
+    return [{"role": roles[index % 2], "content": f"{index:02d}" * 5} for index in range(count)]
+
+
+class FakeSummarizer:
+    def __init__(self, fail: bool = False):
+        self.calls: list = []
+        self.fail = fail
+
+    async def __call__(self, previous_summary, messages):
+        self.calls.append((previous_summary, [msg["content"] for msg in messages]))
+        if self.fail:
+            raise RuntimeError("summarizer unavailable")
+        return f"{previous_summary or ''}+{len(messages)}"
+
+
+def make_compactor(summarizer) -> HistoryCompactor:
+    return HistoryCompactor(count_message=count_chars, summarize=summarizer, summary_reserve_tokens=10, cache_size=10, cache_ttl=60)
+
+
+def test_history_within_budget_is_unchanged():
+    summarizer = FakeSummarizer()
+    messages = make_messages(4)
+    assert asyncio.run(make_compactor(summarizer).compact(messages, budget=40)) == messages
+    assert summarizer.calls == []
+
+
+def test_older_turns_are_replaced_with_summary():
+    summarizer = FakeSummarizer()
+    messages = make_messages(6)
+
+    compacted = asyncio.run(make_compactor(summarizer).compact(messages, budget=40))
+
+    # 予算40 - 要約用10 = 30文字分（3件）の最新ターンが残る
+    assert compacted[0] == {"role": SUMMARY_ROLE, "content": "+3"}
+    assert compacted[1:] == messages[3:]
+
+
+def test_rolling_summary_reuses_cached_prefix():
+    summarizer = FakeSummarizer()
+    compactor = make_compactor(summarizer)
+    messages = make_messages(8)
+
+    async def scenario():
+        await compactor.compact(messages[:6], budget=40)
+        await compactor.compact(messages[:6], budget=40)
+        return await compactor.compact(messages, budget=40)
+
+    compacted = asyncio.run(scenario())
+
+    # 2回目は同じプレフィックスなので要約しない。3回目は溢れた2件だけを追加で要約する
+    assert summarizer.calls == [(None, ["00" * 5, "01" * 5, "02" * 5]), ("+3", ["03" * 5, "04" * 5])]
+    assert compacted[0]["content"] == "+3+2"
+
+
+def test_last_message_is_kept_even_if_over_budget():
+    compacted = asyncio.run(make_compactor(FakeSummarizer()).compact([{"role": "user", "content": "x" * 100}], budget=40))
+    assert compacted == [{"role": "user", "content": "x" * 100}]
+
+
+def test_summarizer_failure_drops_older_turns():
+    messages = make_messages(6)
+    assert asyncio.run(make_compactor(FakeSummarizer(fail=True)).compact(messages, budget=40)) == messages[3:]
+
+
+def test_summary_is_passed_as_system_message():
+    converted = to_langchain_messages([{"role": SUMMARY_ROLE, "content": "要約"}, {"role": "user", "content": "質問"}])
+    assert converted[0].type == "system"
+    assert "要約" in converted[0].content
+    assert converted[1].type == "human"
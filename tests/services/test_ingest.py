@@ -0,0 +1,113 @@
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from app.services.ingest import Pipeline, Stage, expand_paths, parallel_map_stage
+
+
+def test_expand_paths_handles_files_directories_and_globs(tmp_path):
+    (tmp_path / "a").mkdir()
+    (tmp_path / "a" / "1.pdf").write_bytes(b"")
+    (tmp_path / "a" / "note.txt").write_bytes(b"")
+    (tmp_path / "b.PDF").write_bytes(b"")
+
+    paths = list(expand_paths([str(tmp_path / "a"), str(tmp_path / "*.PDF"), str(tmp_path / "a" / "1.pdf")]))
+
+    assert paths == [os.path.realpath(tmp_path / "a" / "1.pdf"), os.path.realpath(tmp_path / "b.PDF")]
+
+
+def test_expand_paths_normalizes_spellings_of_the_same_file(tmp_path, monkeypatch):
+    (tmp_path / "a").mkdir()
+    (tmp_path / "a" / "1.pdf").write_bytes(b"")
+    (tmp_path / "link").symlink_to(tmp_path / "a")
+    monkeypatch.chdir(tmp_path)
+
+    paths = list(expand_paths(["a/1.pdf", "./a/../a/1.pdf", str(tmp_path / "link" / "1.pdf"), "link"]))
+
+    assert paths == [os.path.realpath(tmp_path / "a" / "1.pdf")]
+
+
+def test_pipeline_batches_and_reports_stage_stats():
+    upserted = []
+
+    def split(text: str) -> list:
+        return text.split()
+
+    def upsert(batch: list) -> list:
+        upserted.append(batch)
+        return batch
+
+    pipeline = Pipeline([Stage("split", split, workers=2), Stage("upsert", upsert, batch_size=3)], queue_size=2)
+    report = pipeline.run(["a b", "c d", "e"])
+
+    assert sorted(word for batch in upserted for word in batch) == ["a", "b", "c", "d", "e"]
+    assert [len(batch) for batch in upserted] == [3, 2]
+    assert report["stages"]["split"]["items_in"] == 3  # noqa: PLR2004
+    assert report["stages"]["split"]["items_out"] == 5  # noqa: PLR2004
+    assert report["stages"]["upsert"]["items_in"] == 2  # noqa: PLR2004
+
+
+def test_pipeline_applies_backpressure():
+    produced = []
+    in_flight_peak = 0
+    lock = threading.Lock()
+
+    def source():
+        for i in range(20):
+            produced.append(i)
+            yield i
+
+    def slow(item: int) -> list:
+        nonlocal in_flight_peak
+        with lock:
+            # 後段が遅い間、入力はキューの上限とワーカー数の分しか先に読まれない
+            in_flight_peak = max(in_flight_peak, len(produced) - item)
+        time.sleep(0.005)
+        return [item]
+
+    Pipeline([Stage("pass", lambda item: [item]), Stage("slow", slow)], queue_size=2).run(source())
+
+    assert in_flight_peak <= 8  # noqa: PLR2004
+
+
+def test_pipeline_propagates_stage_errors():
+    def fail(item: int) -> list:
+        if item == 3:  # noqa: PLR2004
+            raise ValueError("broken pdf")
+        return [item]
+
+    with pytest.raises(ValueError, match="broken pdf"):
+        Pipeline([Stage("parse", fail), Stage("sink", lambda item: [item])], queue_size=1).run(range(100))
+
+
+def test_pipeline_skips_items_passed_to_on_error():
+    failed = []
+
+    def fail(item: int) -> list:
+        if item % 10 == 3:  # noqa: PLR2004
+            raise ValueError("broken pdf")
+        return [item]
+
+    results = []
+    report = Pipeline(
+        [Stage("parse", fail, on_error=lambda item, e: failed.append((item, str(e)))), Stage("sink", lambda item: results.append(item) or [])],
+        queue_size=1,
+    ).run(range(30))
+
+    assert sorted(failed) == [(3, "broken pdf"), (13, "broken pdf"), (23, "broken pdf")]
+    assert len(results) == 27  # noqa: PLR2004
+    assert report["stages"]["parse"]["items_in"] == 30  # noqa: PLR2004
+    assert report["stages"]["parse"]["errors"] == 3  # noqa: PLR2004
+
+
+def test_parallel_map_stage_runs_in_process_pool():
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        results = []
+        pipeline = Pipeline([parallel_map_stage("parse", list, executor, workers=2), Stage("collect", lambda item: results.append(item) or [])])
+        report = pipeline.run(["ab", "cd"])
+
+    assert sorted(results) == ["a", "b", "c", "d"]
+    assert report["stages"]["parse"]["items_out"] == 4  # noqa: PLR2004
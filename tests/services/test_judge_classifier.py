@@ -0,0 +1,114 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import zlib
+
+from app.core.config import get_settings
+from app.services import judge_classifier
+from app.services.judge_classifier import (
+    NEED_TAG,
+    NOT_TAG,
+    JudgeClassifier,
+    alog_judge_decision,
+    evaluate,
+    label_of,
+    read_cassette_decisions,
+    split_held_out,
+    train,
+)
+
+DISEASES = ["糖尿病", "高血圧", "肺がん", "乳がん", "心房細動", "関節リウマチ", "うつ病", "喘息", "慢性腎臓病", "胃潰瘍"]
+TEMPLATES = ["{}の最新の治療法を教えてください", "{}の薬の副作用について知りたい", "{}のガイドラインはどうなっていますか", "{}の予後は？"]
+SMALL_TALK = [
+    "こんにちは",
+    "ありがとうございました",
+    "おはようございます",
+    "了解しました",
+    "助かりました、ありがとう",
+    "こんばんは",
+    "よろしくお願いします",
+    "わかりました",
+    "さようなら",
+    "どうもありがとう",
+]
+
+
+def _dataset() -> tuple[list[str], list[int]]:
+    need = [template.format(disease) for disease in DISEASES for template in TEMPLATES]
+    texts = need + SMALL_TALK * 2
+    return texts, [1] * len(need) + [0] * len(SMALL_TALK) * 2
+
+
+def test_label_of():
+    assert label_of("[DB_EVIDENCE:NEED]") == 1
+    assert label_of(" [DB_EVIDENCE:NOT]\n") == 0
+    assert label_of("わかりません") is None
+
+
+def test_classifier_learns_decisions_and_round_trips(tmp_path):
+    texts, labels = _dataset()
+    classifier = train(texts, labels, min_df=1)
+
+    assert classifier.decide("パーキンソン病の治療法を教えてください", 0.8, 0.8) == NEED_TAG
+    assert classifier.decide("ありがとうございました！", 0.8, 0.8) == NOT_TAG
+    # 確信度が低い場合はLLMに任せる
+    assert classifier.decide("ありがとうございました！", 0.8, 1.0) is None
+
+    path = tmp_path / "judge_classifier.json"
+    classifier.save(str(path))
+    loaded = JudgeClassifier.load(str(path))
+    assert loaded.predict_proba("喘息の薬") == classifier.predict_proba("喘息の薬")
+
+
+def test_evaluate_reports_agreement_and_coverage():
+    texts, labels = _dataset()
+    train_set, held_out = split_held_out(zip(texts, labels), test_fraction=0.3, seed=0)
+    classifier = train([text for text, _ in train_set], [label for _, label in train_set], min_df=1)
+
+    report = evaluate(classifier, [text for text, _ in held_out], [label for _, label in held_out], 0.5, 0.5)
+
+    assert report["examples"] == len(held_out)
+    assert report["coverage"] == 1.0
+    assert report["agreement"] >= 0.9  # noqa: PLR2004
+    assert report["false_not"] == 0
+    assert not {text for text, _ in train_set} & {text for text, _ in held_out}
+
+
+def test_reads_judge_decisions_from_cassettes(tmp_path):
+    path = tmp_path / "cassettes.sqlite3"
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE cassettes (key TEXT PRIMARY KEY, request BLOB NOT NULL, response BLOB NOT NULL, recorded_at REAL NOT NULL)")
+
+    def put(key: str, system: str, user: str, content: str):
+        request = {"messages": [{"role": "system", "content": system}, {"role": "user", "content": user}]}
+        response = {"choices": [{"message": {"role": "assistant", "content": content}}]}
+        conn.execute(
+            "INSERT INTO cassettes VALUES (?, ?, ?, 0)",
+            (key, zlib.compress(json.dumps(request).encode()), zlib.compress(json.dumps(response).encode())),
+        )
+
+    put("a", "必要なら[DB_EVIDENCE:NEED]を返す", "喘息の治療は？", "[DB_EVIDENCE:NEED]")
+    put("b", "必要なら[DB_EVIDENCE:NEED]を返す", "ありがとう", "[DB_EVIDENCE:NOT]")
+    put("c", "PubMedのクエリを作成する", "喘息の治療は？", "asthma treatment")
+    conn.commit()
+    conn.close()
+
+    assert sorted(read_cassette_decisions(str(path))) == [("ありがとう", 0), ("喘息の治療は？", 1)]
+
+
+def test_decisions_are_written_off_the_event_loop(tmp_path, monkeypatch):
+    monkeypatch.setattr(get_settings(), "JUDGE_DECISION_LOG_PATH", str(tmp_path / "decisions.jsonl"))
+    writers = []
+    log_judge_decision = judge_classifier.log_judge_decision
+
+    def record_thread(text: str, result: str):
+        writers.append(threading.current_thread())
+        log_judge_decision(text, result)
+
+    monkeypatch.setattr(judge_classifier, "log_judge_decision", record_thread)
+    asyncio.run(alog_judge_decision("喘息の吸入薬について", NEED_TAG))
+
+    assert writers and writers[0] is not threading.current_thread()
+    records = [json.loads(line) for line in (tmp_path / "decisions.jsonl").read_text(encoding="utf-8").splitlines()]
+    assert [(record["text"], record["result"]) for record in records] == [("喘息の吸入薬について", NEED_TAG)]
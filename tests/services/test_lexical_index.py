@@ -0,0 +1,94 @@
+from app.services import lexical_index
+from app.services.lexical_index import LexicalIndex, terms
+
+
+def test_terms_keep_identifiers_and_split_japanese_into_bigrams():
+    assert terms("ＥＧＦＲ変異 PMID:12345678") == ["egfr", "変異", "pmid", "12345678"]
+    assert terms("メトホルミン") == ["メト", "トホ", "ホル", "ルミ", "ミン"]
+    assert terms("薬 A") == ["薬", "a"]
+
+
+def test_search_ranks_exact_identifiers(tmp_path):
+    index = LexicalIndex(str(tmp_path / "lexical"))
+    index.add(
+        ["c1", "c2", "c3", "c4"],
+        ["EGFR変異陽性の肺がんにオシメルチニブを投与した", "KRAS変異の大腸がん", "糖尿病にメトホルミンを投与した", "高血圧の治療"],
+        [{"page": 1}, {"page": 2}, {"page": 3}, {"page": 4}],
+    )
+    assert index.search("EGFR") == []
+    index.flush()
+
+    results = index.search("EGFR変異", k=2)
+    assert [chunk_id for chunk_id, _, _ in results] == ["c1", "c2"]
+    assert results[0][2].metadata == {"page": 1}
+    assert index.search("メトホルミン")[0][0] == "c3"
+
+
+def test_updates_deletes_and_merges_persist(tmp_path):
+    path = str(tmp_path / "lexical")
+    writer = LexicalIndex(path, max_segments=2)
+    reader = LexicalIndex(path, refresh_interval=0)
+    writer.add(["c1", "c2"], ["オシメルチニブ 第1版", "ゲフィチニブ"])
+    writer.flush()
+    # 同じIDの追加は置き換え、削除したものは返らない
+    writer.add(["c1"], ["オシメルチニブ 第2版"])
+    writer.flush()
+    writer.delete(["c2"])
+
+    assert [document.page_content for _, _, document in reader.search("オシメルチニブ")] == ["オシメルチニブ 第2版"]
+    assert "c2" not in [chunk_id for chunk_id, _, _ in reader.search("ゲフィチニブ")]
+
+    writer.add(["c3"], ["エルロチニブ"])
+    writer.flush()
+    # セグメントがmax_segmentsを超えたので1つにまとまり、削除済みの文書は除かれる
+    assert writer.stats()["segments"] == 1
+    assert writer.stats()["live_docs"] == 2  # noqa: PLR2004
+    reopened = LexicalIndex(path)
+    assert [chunk_id for chunk_id, _, _ in reopened.search("チニブ")] in (["c1", "c3"], ["c3", "c1"])
+    assert reopened.search("第2版")[0][0] == "c1"
+
+
+def test_reader_reloads_when_a_merge_removes_segments_while_loading(tmp_path, monkeypatch):
+    path = str(tmp_path / "lexical")
+    writer = LexicalIndex(path)
+    writer.add(["c1"], ["オシメルチニブ"])
+    writer.flush()
+    writer.add(["c2"], ["ゲフィチニブ"])
+    writer.flush()
+    reader = LexicalIndex(path)
+    segment_class = lexical_index.Segment
+    merged = []
+
+    def open_segment(name, segment_path):
+        # 読み手がSQLiteからセグメントの一覧を読んだ後、ファイルを開く前に統合される
+        if not merged:
+            merged.append(name)
+            writer.merge()
+        return segment_class(name, segment_path)
+
+    monkeypatch.setattr(lexical_index, "Segment", open_segment)
+
+    assert [chunk_id for chunk_id, _, _ in reader.search("チニブ")] in (["c1", "c2"], ["c2", "c1"])
+    assert reader.stats()["segments"] == 1
+    assert merged
+
+
+def test_reader_keeps_the_previous_snapshot_when_segments_cannot_be_opened(tmp_path, monkeypatch):
+    path = str(tmp_path / "lexical")
+    writer = LexicalIndex(path)
+    writer.add(["c1"], ["オシメルチニブ"])
+    writer.flush()
+    reader = LexicalIndex(path, refresh_interval=0)
+    assert reader.search("オシメルチニブ")[0][0] == "c1"
+    writer.add(["c2"], ["ゲフィチニブ"])
+    writer.flush()
+
+    def missing_segment(name, segment_path):
+        raise FileNotFoundError(segment_path)
+
+    monkeypatch.setattr(lexical_index, "Segment", missing_segment)
+    assert reader.search("ゲフィ") == []
+    assert reader.search("オシメルチニブ")[0][0] == "c1"
+
+    monkeypatch.undo()
+    assert reader.search("ゲフィ")[0][0] == "c2"
@@ -0,0 +1,115 @@
+import asyncio
+import threading
+
+import pytest
+from langchain.schema.messages import AIMessage, HumanMessage, SystemMessage
+
+from app.api.endpoints.assistant_response import ASSISTANT_CHAT_PROMPT
+from app.core.config import get_settings
+from app.services.llm_service import (
+    close_llm_clients,
+    compile_chat_prompt,
+    get_chain,
+    get_llm,
+    llm_registry,
+    to_langchain_messages,
+)
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    monkeypatch.setattr(get_settings(), "OPENAI_API_KEY", "test-key")
+    yield llm_registry
+    asyncio.run(close_llm_clients())
+
+
+def test_get_llm_returns_shared_instance():
+    assert get_llm(model_name="gpt-4o-mini", temperature=0.7) is get_llm(model_name="gpt-4o-mini", temperature=0.7)
+
+
+def test_get_llm_keys_by_model_temperature_and_streaming():
+    base = get_llm(model_name="gpt-4o-mini", temperature=0.7)
+    assert get_llm(model_name="gpt-4o", temperature=0.7) is not base
+    assert get_llm(model_name="gpt-4o-mini", temperature=0) is not base
+    assert get_llm(model_name="gpt-4o-mini", temperature=0.7, streaming=False) is not base
+
+
+def test_all_llms_share_one_connection_pool(registry):
+    first = get_llm(model_name="gpt-4o-mini", temperature=0.7)
+    second = get_llm(model_name="gpt-4o", temperature=0)
+    assert first.async_client._completions is second.async_client._completions
+    assert first.async_client._completions._client is registry.openai_client
+
+
+def test_close_resets_registry(registry):
+    llm = get_llm(model_name="gpt-4o-mini", temperature=0.7)
+    http_client = registry._http_client
+    asyncio.run(close_llm_clients())
+    assert http_client.is_closed
+    assert get_llm(model_name="gpt-4o-mini", temperature=0.7) is not llm
+
+
+def test_compiled_prompt_takes_history_as_variable():
+    prompt = compile_chat_prompt("あなたは医学分野の専門家です。PMID:{{PMID}}")
+    messages = to_langchain_messages(
+        [
+            {"role": "user", "content": "糖尿病について教えてください"},
+            {"role": "assistant", "content": "糖尿病は..."},
+            {"role": "system", "content": "無視される"},
+        ]
+    )
+
+    rendered = prompt.format_messages(messages=messages)
+
+    assert prompt.input_variables == ["messages"]
+    assert [type(m) for m in rendered] == [SystemMessage, HumanMessage, AIMessage]
+    assert rendered[0].content == "あなたは医学分野の専門家です。PMID:{PMID}"
+
+
+def test_get_chain_is_built_once_per_endpoint():
+    first = get_chain(ASSISTANT_CHAT_PROMPT, model_name="gpt-4o-mini", temperature=0.7)
+    assert get_chain(ASSISTANT_CHAT_PROMPT, model_name="gpt-4o-mini", temperature=0.7) is first
+    assert get_chain(ASSISTANT_CHAT_PROMPT, model_name="gpt-4o-mini", temperature=0.7, streaming=False) is not first
+
+
+def test_client_of_a_previous_loop_is_closed_when_the_loop_changes(registry):
+    async def current_http_client():
+        get_llm(model_name="gpt-4o-mini", temperature=0.7)
+        return registry._http_client
+
+    old = asyncio.run(current_http_client())
+
+    async def switch_loop():
+        new = await current_http_client()
+        # 破棄したクライアントを閉じるタスクを実行させる
+        await asyncio.gather(*registry._closing)
+        return new
+
+    new = asyncio.run(switch_loop())
+
+    assert new is not old
+    assert old.is_closed
+    assert not new.is_closed
+
+
+def test_client_of_a_loop_running_in_another_thread_is_closed_on_that_loop(registry):
+    async def current_http_client():
+        get_llm(model_name="gpt-4o-mini", temperature=0.7)
+        return registry._http_client
+
+    other = asyncio.new_event_loop()
+    thread = threading.Thread(target=other.run_forever, daemon=True)
+    thread.start()
+    try:
+        old = asyncio.run_coroutine_threadsafe(current_http_client(), other).result()
+
+        async def switch_loop():
+            await current_http_client()
+            await asyncio.gather(*registry._closing)
+
+        asyncio.run(switch_loop())
+        assert old.is_closed
+    finally:
+        other.call_soon_threadsafe(other.stop)
+        thread.join()
+        other.close()
@@ -0,0 +1,158 @@
+import threading
+
+import numpy as np
+import pytest
+from langchain_core.embeddings import Embeddings
+
+from app.services.local_vectorstore import LocalVectorStore
+from app.testing.vector_benchmark import clustered_vectors
+
+WORDS = ("insulin", "metformin", "statin", "aspirin")
+
+
+class KeywordEmbeddings(Embeddings):
+    """
+    語ごとに決まった軸を持つ埋め込み（同じ語を含む文ほど近い）
+    """
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return [float(text.count(word)) + 0.01 for word in WORDS]
+
+
+@pytest.mark.parametrize("dtype", ["float32", "int8"])
+def test_search_upsert_delete_and_reopen(tmp_path, dtype):
+    store = LocalVectorStore(str(tmp_path / "index"), KeywordEmbeddings(), dtype=dtype)
+    store.add_texts(["insulin therapy", "metformin dose", "statin trial"], [{"page": 1}, {"page": 2}, {"page": 3}], ids=["a", "b", "c"])
+
+    results = store.similarity_search_with_score("insulin", k=2)
+    assert results[0][0].page_content == "insulin therapy"
+    assert results[0][0].metadata == {"page": 1}
+    assert results[0][1] > results[1][1]
+
+    # 同じIDは置き換わり、削除したものは返らない
+    store.add_texts(["aspirin study"], ids=["a"])
+    store.delete(ids=["b"])
+    assert [doc.page_content for doc in store.similarity_search("insulin metformin aspirin", k=5)] == ["aspirin study", "statin trial"]
+
+    reopened = LocalVectorStore(str(tmp_path / "index"), KeywordEmbeddings(), dtype="float32")
+    assert reopened.dtype == dtype
+    assert reopened.similarity_search("aspirin", k=1)[0].page_content == "aspirin study"
+    assert reopened.stats()["live"] == 2  # noqa: PLR2004
+
+    reopened.compact()
+    assert reopened.stats() == {"dtype": dtype, "count": 2, "live": 2, "dim": 4, "nlist": 0}
+    assert reopened.similarity_search("statin", k=1)[0].page_content == "statin trial"
+
+
+def test_readers_see_writes_from_another_instance(tmp_path):
+    reader = LocalVectorStore(str(tmp_path / "index"), KeywordEmbeddings(), refresh_interval=0)
+    writer = LocalVectorStore(str(tmp_path / "index"), KeywordEmbeddings())
+    assert reader.similarity_search("insulin", k=1) == []
+
+    writer.add_texts(["insulin therapy"], ids=["a"])
+
+    assert reader.similarity_search("insulin", k=1)[0].page_content == "insulin therapy"
+
+
+def test_int8_and_ivf_search_match_exact_search(tmp_path):
+    vectors = clustered_vectors(2000, 32, clusters=20)
+    queries = clustered_vectors(50, 32, clusters=20, seed=1)
+    exact = LocalVectorStore(str(tmp_path / "exact"))
+    exact.add_embeddings([str(i) for i in range(len(vectors))], vectors.tolist())
+    quantized = LocalVectorStore(str(tmp_path / "int8"), dtype="int8")
+    quantized.add_embeddings([str(i) for i in range(len(vectors))], vectors.tolist())
+
+    _, expected = exact.search_vectors(queries, k=10)
+    _, rows = quantized.search_vectors(queries, k=10)
+    assert np.mean([len(set(a) & set(b)) / 10 for a, b in zip(expected, rows)]) >= 0.9  # noqa: PLR2004
+
+    exact.train_ivf(nlist=20)
+    _, rows = exact.search_vectors(queries, k=10, nprobe=4)
+    assert np.mean([len(set(a) & set(b)) / 10 for a, b in zip(expected, rows)]) >= 0.9  # noqa: PLR2004
+
+    # 学習後に追加した行も分割に割り当てられて見つかる
+    exact.add_embeddings(["new"], [queries[0].tolist()], ids=["new"])
+    assert exact.similarity_search_by_vector(queries[0].tolist(), k=1)[0].page_content == "new"
+
+
+def test_reader_reloads_when_a_compaction_removes_files_while_loading(tmp_path, monkeypatch):
+    writer = LocalVectorStore(str(tmp_path / "index"), KeywordEmbeddings())
+    writer.add_texts(["insulin therapy", "metformin dose"], ids=["a", "b"])
+    reader = LocalVectorStore(str(tmp_path / "index"), KeywordEmbeddings(), refresh_interval=0)
+    assert reader.similarity_search("metformin", k=1)[0].page_content == "metformin dose"
+    writer.delete(ids=["a"])
+    read_meta = reader._meta
+    compacted = []
+
+    def meta_then_compact():
+        # 読み手が版を読んだ後、ファイルを開く前に書き手が古い世代のファイルを消す
+        meta = read_meta()
+        if not compacted:
+            compacted.append(meta["data_gen"])
+            writer.compact()
+        return meta
+
+    monkeypatch.setattr(reader, "_meta", meta_then_compact)
+
+    assert [doc.page_content for doc in reader.similarity_search("insulin metformin", k=2)] == ["metformin dose"]
+    assert reader.stats()["count"] == 1
+    assert compacted
+
+
+def test_reader_keeps_the_previous_snapshot_when_files_cannot_be_opened(tmp_path, monkeypatch):
+    writer = LocalVectorStore(str(tmp_path / "index"), KeywordEmbeddings())
+    writer.add_texts(["insulin therapy"], ids=["a"])
+    reader = LocalVectorStore(str(tmp_path / "index"), KeywordEmbeddings(), refresh_interval=0)
+    assert reader.similarity_search("insulin", k=1)[0].page_content == "insulin therapy"
+    writer.add_texts(["metformin dose"], ids=["b"])
+    read_meta = reader._meta
+    monkeypatch.setattr(reader, "_meta", lambda: {**read_meta(), "data_gen": "missing"})
+
+    assert [doc.page_content for doc in reader.similarity_search("insulin metformin", k=2)] == ["insulin therapy"]
+
+    monkeypatch.undo()
+    assert reader.similarity_search("metformin", k=1)[0].page_content == "metformin dose"
+
+
+def test_concurrent_upserts_keep_vectors_with_their_ids(tmp_path):
+    # add_document.pyの登録の段は複数のスレッドから同じストアに書き込む
+    store = LocalVectorStore(str(tmp_path / "index"))
+    vectors = clustered_vectors(2000, 16, clusters=50)
+    batches = [list(range(start, start + 100)) for start in range(0, len(vectors), 100)]
+    errors = []
+
+    def upsert(part: list[list[int]]):
+        try:
+            for rows in part:
+                store.add_embeddings([str(row) for row in rows], vectors[rows].tolist(), ids=[str(row) for row in rows])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=upsert, args=(batches[offset::2],)) for offset in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert store.stats()["live"] == len(vectors)
+    # 各ベクトルで検索すると、そのベクトルを登録したIDが最も近い
+    results = [store.similarity_search_by_vector(vector.tolist(), k=1)[0].page_content for vector in vectors[::50]]
+    assert results == [str(row) for row in range(0, len(vectors), 50)]
+
+
+def test_reader_with_an_old_snapshot_does_not_return_renumbered_rows(tmp_path):
+    writer = LocalVectorStore(str(tmp_path / "index"), KeywordEmbeddings())
+    writer.add_texts(["insulin therapy", "metformin dose", "statin trial"], ids=["a", "b", "c"])
+    # 版の確認を待つ間は古い版の行番号で検索する
+    reader = LocalVectorStore(str(tmp_path / "index"), KeywordEmbeddings(), refresh_interval=3600)
+    assert reader.similarity_search("statin", k=1)[0].page_content == "statin trial"
+
+    writer.delete(ids=["a"])
+    writer.compact()
+
+    assert reader.similarity_search("statin", k=1)[0].page_content == "statin trial"
+    assert [doc.page_content for doc in reader.similarity_search("insulin metformin statin", k=3)] == ["metformin dose", "statin trial"]
@@ -0,0 +1,49 @@
+from app.services.manifest import DocumentManifest, file_digest
+
+
+def test_file_digest_changes_with_content(tmp_path):
+    path = tmp_path / "a.pdf"
+    path.write_bytes(b"v1")
+    first = file_digest(str(path))
+    path.write_bytes(b"v2")
+
+    assert file_digest(str(path)) != first
+
+
+def test_manifest_records_file_after_all_new_chunks_are_added(tmp_path):
+    manifest = DocumentManifest(str(tmp_path / "manifest.sqlite3"))
+
+    new, stale = manifest.diff("a.pdf", ["c1", "c2", "c3"])
+    assert (new, stale) == (["c1", "c2", "c3"], [])
+    manifest.begin("a.pdf", "h1", new)
+
+    assert manifest.chunks_added([("a.pdf", "c1"), ("a.pdf", "c2")]) == []
+    # 途中で止まった場合はファイルは未登録のまま
+    assert not manifest.is_unchanged("a.pdf", "h1")
+    assert manifest.chunks_added([("a.pdf", "c3")]) == ["a.pdf"]
+    assert manifest.is_unchanged("a.pdf", "h1")
+
+
+def test_manifest_diff_returns_only_changed_chunks(tmp_path):
+    path = str(tmp_path / "manifest.sqlite3")
+    manifest = DocumentManifest(path)
+    manifest.begin("a.pdf", "h1", ["c1", "c2", "c3"])
+    manifest.chunks_added([("a.pdf", "c1"), ("a.pdf", "c2"), ("a.pdf", "c3")])
+    manifest.close()
+
+    reopened = DocumentManifest(path)
+    new, stale = reopened.diff("a.pdf", ["c1", "c3", "c4"])
+    assert (new, stale) == (["c4"], ["c2"])
+
+    reopened.remove_chunks("a.pdf", stale)
+    reopened.begin("a.pdf", "h2", new)
+    reopened.chunks_added([("a.pdf", "c4")])
+    assert reopened.chunk_ids("a.pdf") == {"c1", "c3", "c4"}
+    assert reopened.is_unchanged("a.pdf", "h2")
+
+    # チャンクが変わらなければその場で登録済みになる
+    reopened.begin("b.pdf", "hb", [])
+    assert reopened.paths() == ["a.pdf", "b.pdf"]
+    reopened.forget("a.pdf")
+    assert reopened.paths() == ["b.pdf"]
+    assert reopened.chunk_ids("a.pdf") == set()
@@ -0,0 +1,37 @@
+from app.services.metrics import CallbackMetric, Counter, Gauge, Histogram, MetricsRegistry
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = Histogram("latency_seconds", "Latency", ("endpoint",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 5.0):
+        histogram.observe(value, endpoint="/api/plan")
+
+    lines = histogram.render().splitlines()
+
+    assert lines[:2] == ["# HELP latency_seconds Latency", "# TYPE latency_seconds histogram"]
+    assert 'latency_seconds_bucket{endpoint="/api/plan",le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{endpoint="/api/plan",le="1"} 3' in lines
+    assert 'latency_seconds_bucket{endpoint="/api/plan",le="+Inf"} 4' in lines
+    assert 'latency_seconds_sum{endpoint="/api/plan"} 6.05' in lines
+    assert 'latency_seconds_count{endpoint="/api/plan"} 4' in lines
+
+
+def test_counter_and_gauge_track_values_per_label():
+    counter = Counter("errors_total", "Errors", ("error",))
+    counter.inc(error="TimeoutError")
+    counter.inc(2, error="TimeoutError")
+    gauge = Gauge("in_flight", "In flight")
+    gauge.inc()
+    gauge.inc()
+    gauge.dec()
+
+    assert counter.value(error="TimeoutError") == 3  # noqa: PLR2004
+    assert 'errors_total{error="TimeoutError"} 3' in counter.render()
+    assert gauge.render().splitlines()[-1] == "in_flight 1"
+
+
+def test_registry_renders_callback_metrics_with_escaped_labels():
+    registry = MetricsRegistry()
+    registry.register(CallbackMetric("lookups_total", "Lookups", "counter", lambda: {('say "hi"',): 2}, ("result",)))
+
+    assert registry.render() == '# HELP lookups_total Lookups\n# TYPE lookups_total counter\nlookups_total{result="say \\"hi\\""} 2\n'
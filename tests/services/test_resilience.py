@@ -0,0 +1,97 @@
+import asyncio
+import random
+
+import httpx
+import openai
+import pytest
+
+from app.core.config import get_settings
+from app.services.resilience import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError, ResiliencePolicy, backoff_delay, hedge
+
+
+def _slow_then_fast(delays: list, cancelled: list):
+    calls = iter(enumerate(delays))
+
+    async def fn():
+        index, delay = next(calls)
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            cancelled.append(index)
+            raise
+        return f"attempt-{index}"
+
+    return fn
+
+
+def test_hedge_returns_first_answer_and_cancels_the_loser():
+    cancelled: list = []
+    result = asyncio.run(hedge(_slow_then_fast([1.0, 0.01], cancelled), delay=0.05))
+
+    assert result == ("attempt-1", "hedge")
+    assert cancelled == [0]
+
+
+def test_hedge_is_not_fired_when_primary_answers_in_time():
+    cancelled: list = []
+    result = asyncio.run(hedge(_slow_then_fast([0.01, 0.01], cancelled), delay=0.5))
+
+    assert result == ("attempt-0", "primary")
+
+
+def test_hedge_waits_for_primary_when_not_allowed():
+    cancelled: list = []
+    result = asyncio.run(hedge(_slow_then_fast([0.1, 0.01], cancelled), delay=0.01, can_hedge=lambda: False))
+
+    assert result == ("attempt-0", "primary")
+
+
+def test_circuit_breaker_opens_then_allows_a_single_trial():
+    async def scenario():
+        breaker = CircuitBreaker("gpt-4o-mini", failure_threshold=2, reset_timeout=0.05)
+        for _ in range(2):
+            breaker.before_call()
+            breaker.record_failure()
+        assert breaker.state == OPEN
+        with pytest.raises(CircuitOpenError):
+            breaker.before_call()
+
+        await asyncio.sleep(0.06)
+        breaker.before_call()
+        assert breaker.state == HALF_OPEN
+        with pytest.raises(CircuitOpenError):
+            breaker.before_call()  # 試行中は他の呼び出しを通さない
+        breaker.record_success()
+        return breaker.state
+
+    assert asyncio.run(scenario()) == CLOSED
+
+
+def test_backoff_delay_uses_full_jitter_within_cap():
+    rng = random.Random(0)
+    delays = [backoff_delay(attempt, base_delay=0.2, max_delay=1.0, rng=rng) for attempt in range(6) for _ in range(20)]
+
+    assert all(0 <= delay <= 1.0 for delay in delays)
+    assert max(delays) > 0.5  # noqa: PLR2004
+
+
+def test_policy_retries_transient_errors(monkeypatch):
+    settings = get_settings()
+    monkeypatch.setattr(settings, "LLM_RESILIENCE_ENABLED", True)
+    monkeypatch.setattr(settings, "LLM_RETRY_BASE_DELAY", 0.0)
+    attempts = []
+
+    async def flaky():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise openai.APIConnectionError(request=httpx.Request("POST", "http://upstream/v1/chat/completions"))
+        return "ok"
+
+    async def scenario():
+        policy = ResiliencePolicy()
+        return await policy.call("gpt-4o-mini", "judge", flaky), policy.breaker("gpt-4o-mini")
+
+    result, breaker = asyncio.run(scenario())
+    assert result == "ok"
+    assert len(attempts) == 2  # noqa: PLR2004
+    assert (breaker.state, breaker.failures) == (CLOSED, 0)
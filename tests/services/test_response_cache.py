@@ -0,0 +1,136 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.core.config import get_settings
+from app.main import app
+from app.services.response_cache import MemoryBackend, RedisBackend, ResponseCache, SQLiteBackend
+from app.testing.fake_redis import run_fake_redis_server
+
+MESSAGES = [{"role": "user", "content": "糖尿病の治療法について教えてください"}]
+
+
+def test_make_key_is_canonical():
+    key = ResponseCache.make_key("db_evidence_requirements", "v1", "gpt-4o-mini", 0, MESSAGES)
+    assert key == ResponseCache.make_key("db_evidence_requirements", "v1", "gpt-4o-mini", 0.0, [dict(reversed(MESSAGES[0].items()))])
+    assert key != ResponseCache.make_key("pubmed_query", "v1", "gpt-4o-mini", 0, MESSAGES)
+    assert key != ResponseCache.make_key("db_evidence_requirements", "v2", "gpt-4o-mini", 0, MESSAGES)
+
+
+def test_memory_backend_evicts_least_recently_used():
+    async def scenario():
+        backend = MemoryBackend(max_entries=2)
+        await backend.set("a", "1", ttl=60)
+        await backend.set("b", "2", ttl=60)
+        await backend.get("a")
+        await backend.set("c", "3", ttl=60)
+        return [await backend.get(key) for key in ("a", "b", "c")]
+
+    assert asyncio.run(scenario()) == ["1", None, "3"]
+
+
+def test_memory_backend_expires_entries():
+    async def scenario():
+        backend = MemoryBackend(max_entries=2)
+        await backend.set("a", "1", ttl=0)
+        return await backend.get("a")
+
+    assert asyncio.run(scenario()) is None
+
+
+def test_sqlite_backend_persists_and_evicts(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+
+    async def scenario():
+        backend = SQLiteBackend(path, max_entries=2)
+        await backend.set("a", "1", ttl=60)
+        await backend.set("b", "2", ttl=60)
+        await backend.set("c", "3", ttl=60)
+        await backend.close()
+
+        reopened = SQLiteBackend(path, max_entries=2)
+        values = [await reopened.get(key) for key in ("a", "b", "c")]
+        await reopened.close()
+        return values
+
+    assert asyncio.run(scenario()) == [None, "2", "3"]
+
+
+def test_redis_backend_against_stand_in():
+    async def scenario(url):
+        cache = ResponseCache(RedisBackend(url), ttl=60, max_value_bytes=1024)
+        key = ResponseCache.make_key("pubmed_query", "v1", "gpt-4o-mini", 0, MESSAGES)
+        miss = await cache.get(key)
+        await cache.set(key, '"Diabetes Mellitus"[MeSH Terms]')
+        hit = await cache.get(key)
+        await cache.backend.clear()
+        cleared = await cache.get(key)
+        await cache.close()
+        return miss, hit, cleared, cache.stats()
+
+    with run_fake_redis_server() as url:
+        miss, hit, cleared, stats = asyncio.run(scenario(url))
+
+    assert miss is None
+    assert hit == '"Diabetes Mellitus"[MeSH Terms]'
+    assert cleared is None
+    assert stats["hits"] == 1
+    assert stats["misses"] == 2  # noqa: PLR2004
+
+
+def test_redis_backend_clears_keys_with_scan_cursor():
+    async def scenario(url):
+        backend = RedisBackend(url)
+        for index in range(2500):
+            await backend.set(f"key-{index}", "value", ttl=60)
+        await backend.clear()
+        remaining = [await backend.get(f"key-{index}") for index in (0, 1234, 2499)]
+        await backend.close()
+        return remaining
+
+    with run_fake_redis_server() as url:
+        assert asyncio.run(scenario(url)) == [None, None, None]
+
+
+def test_redis_backend_drops_connection_when_cancelled_before_reply():
+    async def scenario(url):
+        backend = RedisBackend(url)
+        await backend.set("a", "value-a", ttl=60)
+        await backend.set("b", "value-b", ttl=60)
+        # GETを送った後、応答を読む前にキャンセルする
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(backend.get("a"), timeout=0.05)
+        value = await backend.get("b")
+        await backend.close()
+        return value
+
+    with run_fake_redis_server(reply_delay=0.2) as url:
+        assert asyncio.run(scenario(url)) == "value-b"
+
+
+def test_unreachable_backend_is_treated_as_miss():
+    async def scenario():
+        cache = ResponseCache(RedisBackend("redis://127.0.0.1:1/0"), ttl=60, max_value_bytes=1024)
+        await cache.set("key", "value")
+        return await cache.get("key"), cache.stats()
+
+    value, stats = asyncio.run(scenario())
+    assert value is None
+    assert stats["errors"] == 2  # noqa: PLR2004
+
+
+@pytest.mark.parametrize("path", ["/api/db_evidence_requirements", "/api/pubmed-query"])
+def test_endpoint_serves_repeated_request_from_cache(fake_openai, monkeypatch, path):
+    monkeypatch.setattr(get_settings(), "RESPONSE_CACHE_ENABLED", True)
+    request_data = {"new_message": "糖尿病の治療法について教えてください", "message_log": []}
+
+    with TestClient(app) as client:
+        fake_openai.response_text = "[DB_EVIDENCE:NEED]"
+        first = client.post(path, json=request_data)
+        fake_openai.response_text = "[DB_EVIDENCE:NOT]"
+        second = client.post(path, json=request_data)
+        third = client.post(path, json={**request_data, "new_message": "今日の天気はどうですか？"})
+
+    assert first.json() == second.json()
+    assert third.json() != first.json()
@@ -0,0 +1,95 @@
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from app.services.retrieval import CachedQueryEmbeddings, CachedRetriever, HybridRetriever, TTLCache, normalize_query, reciprocal_rank_fusion
+
+
+class CountingEmbeddings(Embeddings):
+    def __init__(self):
+        self.queries: list[str] = []
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [[float(len(text))] for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        self.queries.append(text)
+        return [float(len(text))]
+
+
+class CountingVectorStore:
+    def __init__(self):
+        self.calls = 0
+
+    def similarity_search_with_score(self, query: str, k: int = 4):
+        self.calls += 1
+        return [(f"{query}:{i}", 1.0 - i / 10) for i in range(k)]
+
+
+def test_normalize_query():
+    assert normalize_query("  糖尿病の　治療 \n") == "糖尿病の 治療"
+    assert normalize_query("ＨｂＡ１ｃ") == "HbA1c"
+
+
+def test_query_embeddings_are_cached_by_normalized_text():
+    inner = CountingEmbeddings()
+    embeddings = CachedQueryEmbeddings(inner, max_entries=2)
+
+    assert embeddings.embed_query("糖尿病の治療") == embeddings.embed_query(" 糖尿病の治療　")
+    assert inner.queries == ["糖尿病の治療"]
+
+    embeddings.embed_query("高血圧")
+    embeddings.embed_query("喘息")
+    # 上限を超えた古いクエリは再計算する
+    embeddings.embed_query("糖尿病の治療")
+    assert inner.queries == ["糖尿病の治療", "高血圧", "喘息", "糖尿病の治療"]
+
+
+def test_retrieval_results_expire_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("app.services.retrieval.time.monotonic", lambda: now[0])
+    store = CountingVectorStore()
+    retriever = CachedRetriever(store, ttl=60.0)
+
+    first = retriever.search("糖尿病の治療")
+    assert retriever.search("糖尿病の治療 ") == first
+    assert len(retriever.search("糖尿病の治療", k=2)) == 2  # noqa: PLR2004
+    assert store.calls == 2  # noqa: PLR2004
+
+    now[0] += 61
+    retriever.search("糖尿病の治療")
+    assert store.calls == 3  # noqa: PLR2004
+
+
+def test_ttl_cache_counts_hits_and_misses():
+    cache: TTLCache[str] = TTLCache(max_entries=1)
+    cache.set("a", "1")
+    cache.set("b", "2")
+
+    assert cache.get("a") is None
+    assert cache.get("b") == "2"
+    assert (cache.hits, cache.misses, len(cache)) == (1, 1, 1)
+
+
+def test_reciprocal_rank_fusion_prefers_documents_ranked_by_both():
+    fused = reciprocal_rank_fusion([["a", "b", "c"], ["c", "d"]], k=60)
+
+    assert [key for key, _ in fused] == ["c", "a", "b", "d"]
+    assert fused[0][1] == 1 / 63 + 1 / 61
+
+
+def test_hybrid_retriever_merges_vector_and_lexical_hits():
+    def doc(chunk_id: str) -> Document:
+        return Document(page_content=f"text {chunk_id}", metadata={"chunk_id": chunk_id})
+
+    class VectorStore:
+        def similarity_search_with_score(self, query: str, k: int = 4):
+            return [(doc("a"), 0.9), (doc("b"), 0.8), (doc("c"), 0.7)]
+
+    class Lexical:
+        def search(self, query: str, k: int = 20):
+            # PMIDなどベクトル検索で拾えないチャンク
+            return [("c", 12.0, doc("c")), ("pmid", 9.0, doc("pmid"))]
+
+    results = HybridRetriever(VectorStore(), Lexical()).similarity_search_with_score("PMID 12345678", k=4)
+
+    assert [document.metadata["chunk_id"] for document, _ in results] == ["c", "a", "b", "pmid"]
@@ -0,0 +1,75 @@
+import asyncio
+
+import httpx
+import openai
+import pytest
+
+from app.core.config import get_settings
+from app.services.router import ModelRouter
+
+
+@pytest.fixture
+def routes(monkeypatch):
+    settings = get_settings()
+    monkeypatch.setattr(settings, "MODEL_ROUTES", {"judge": ["primary-model", "fallback-model"]})
+    monkeypatch.setattr(settings, "MODEL_ROUTER_MIN_SAMPLES", 4)
+    monkeypatch.setattr(settings, "MODEL_ROUTER_MAX_LATENCY", {"judge": 1.0})
+    return settings
+
+
+def test_routes_default_to_model_name(monkeypatch):
+    monkeypatch.setattr(get_settings(), "MODEL_ROUTES", {})
+    monkeypatch.setattr(get_settings(), "MODEL_NAME", "gpt-4o-mini")
+
+    assert ModelRouter().choose("assistant") == "gpt-4o-mini"
+
+
+def test_router_falls_back_when_primary_is_erroring(routes):
+    router = ModelRouter()
+    for ok in (True, False, False, False):
+        router.record("judge", "primary-model", 0.1, ok=ok)
+
+    assert router.choose("judge") == "fallback-model"
+
+
+def test_router_falls_back_when_primary_is_slow(routes):
+    router = ModelRouter()
+    for _ in range(4):
+        router.record("judge", "primary-model", 3.0, ok=True)
+
+    assert router.choose("judge") == "fallback-model"
+
+
+def test_router_returns_to_primary_after_window(routes, monkeypatch):
+    monkeypatch.setattr(routes, "MODEL_ROUTER_WINDOW", 0.05)
+    router = ModelRouter()
+    for _ in range(4):
+        router.record("judge", "primary-model", None, ok=False)
+    assert router.choose("judge") == "fallback-model"
+
+    asyncio.run(asyncio.sleep(0.06))
+    assert router.choose("judge") == "primary-model"
+
+
+def test_call_fails_over_to_next_candidate(routes):
+    called = []
+
+    async def invoke(model: str) -> str:
+        called.append(model)
+        if model == "primary-model":
+            raise openai.APIConnectionError(request=httpx.Request("POST", "http://upstream/v1/chat/completions"))
+        return f"answer from {model}"
+
+    router = ModelRouter()
+
+    assert asyncio.run(router.call("judge", invoke)) == "answer from fallback-model"
+    assert called == ["primary-model", "fallback-model"]
+    assert router.health("judge", "primary-model").error_rate() == 1.0
+
+
+def test_call_raises_when_all_candidates_fail(routes):
+    async def invoke(model: str) -> str:
+        raise asyncio.TimeoutError
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(ModelRouter().call("judge", invoke))
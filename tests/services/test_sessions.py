@@ -0,0 +1,63 @@
+import asyncio
+
+from app.services.sessions import SessionStore, SQLiteSessionStore
+
+TURN = [{"role": "user", "content": "糖尿病の治療法について教えてください"}, {"role": "assistant", "content": "要約: ..."}]
+
+
+def test_session_store_evicts_least_recently_used():
+    async def scenario():
+        store = SessionStore(max_sessions=2, ttl=60)
+        await store.create("a")
+        await store.create("b")
+        await store.get("a")
+        await store.create("c")
+        return [await store.get(session_id) is not None for session_id in ("a", "b", "c")]
+
+    assert asyncio.run(scenario()) == [True, False, True]
+
+
+def test_session_store_expires_sessions():
+    async def scenario():
+        store = SessionStore(max_sessions=2, ttl=0)
+        await store.create("a")
+        return await store.get("a")
+
+    assert asyncio.run(scenario()) is None
+
+
+def test_session_keeps_converted_messages():
+    async def scenario():
+        store = SessionStore(max_sessions=2, ttl=60)
+        session = await store.create("a")
+        await store.append(session, TURN)
+        return session
+
+    session = asyncio.run(scenario())
+    assert session.messages == TURN
+    assert [msg.type for msg in session.langchain_messages] == ["human", "ai"]
+
+
+def test_sqlite_session_store_persists_across_instances(tmp_path):
+    path = str(tmp_path / "sessions.sqlite3")
+
+    async def write():
+        store = SQLiteSessionStore(path, max_sessions=10, ttl=60, cache_size=2)
+        session = await store.create("a")
+        await store.append(session, TURN[:1])
+        await store.append(session, TURN[1:])
+        await store.close()
+
+    async def read():
+        store = SQLiteSessionStore(path, max_sessions=10, ttl=60, cache_size=2)
+        session = await store.get("a")
+        deleted = await store.delete("a")
+        missing = await store.get("a")
+        await store.close()
+        return session, deleted, missing
+
+    asyncio.run(write())
+    session, deleted, missing = asyncio.run(read())
+    assert session.messages == TURN
+    assert deleted
+    assert missing is None
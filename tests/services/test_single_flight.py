@@ -0,0 +1,112 @@
+import asyncio
+
+import pytest
+
+from app.services.single_flight import SingleFlight, StreamFanout
+
+
+def test_single_flight_shares_in_flight_call():
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "result"
+
+    async def scenario():
+        single_flight = SingleFlight()
+        results = await asyncio.gather(*(single_flight.do("key", fetch) for _ in range(5)))
+        return results, single_flight
+
+    results, single_flight = asyncio.run(scenario())
+    assert results == ["result"] * 5
+    assert calls == [1]
+    assert (single_flight.leaders, single_flight.shared, len(single_flight)) == (1, 4, 0)
+
+
+def test_single_flight_propagates_errors_to_all_waiters():
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("upstream error")
+
+    async def scenario():
+        single_flight = SingleFlight()
+        return await asyncio.gather(*(single_flight.do("key", fail) for _ in range(3)), return_exceptions=True)
+
+    assert all(isinstance(result, RuntimeError) for result in asyncio.run(scenario()))
+
+
+def test_single_flight_cancels_upstream_when_all_waiters_cancel():
+    async def scenario():
+        single_flight = SingleFlight()
+        upstream_cancelled = asyncio.Event()
+
+        async def slow():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                upstream_cancelled.set()
+                raise
+
+        waiters = [asyncio.create_task(single_flight.do("key", slow)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        waiters[0].cancel()
+        await asyncio.sleep(0.01)
+        first_cancel_stopped_upstream = upstream_cancelled.is_set()
+        waiters[1].cancel()
+        await asyncio.wait_for(upstream_cancelled.wait(), timeout=1)
+        return first_cancel_stopped_upstream
+
+    assert asyncio.run(scenario()) is False
+
+
+async def _tokens(context: dict, count: int, delay: float = 0.02):
+    context["started"] = context.get("started", 0) + 1
+    for index in range(count):
+        await asyncio.sleep(delay)
+        yield str(index)
+
+
+def test_stream_fanout_replays_prefix_to_late_joiners():
+    async def collect(fanout: StreamFanout, join_after: float):
+        await asyncio.sleep(join_after)
+        subscription = fanout.subscribe("key", lambda context: _tokens(context, 5))
+        chunks = [chunk async for chunk in subscription]
+        return chunks, subscription.outcome, subscription.context["started"]
+
+    async def scenario():
+        fanout = StreamFanout(poll_interval=0.5)
+        return await asyncio.gather(collect(fanout, 0), collect(fanout, 0.05)), fanout
+
+    results, fanout = asyncio.run(scenario())
+    for chunks, outcome, started in results:
+        assert chunks == ["0", "1", "2", "3", "4"]
+        assert outcome == "completed"
+        assert started == 1
+    assert (fanout.leaders, fanout.joiners, len(fanout)) == (1, 1, 0)
+
+
+def test_stream_fanout_stops_source_when_all_subscribers_leave():
+    async def scenario():
+        fanout = StreamFanout(poll_interval=0.5)
+        subscription = fanout.subscribe("key", lambda context: _tokens(context, 100))
+        iterator = subscription.__aiter__()
+        await iterator.__anext__()
+        await iterator.aclose()
+        await asyncio.sleep(0.01)
+        return fanout
+
+    assert len(asyncio.run(scenario())) == 0
+
+
+def test_stream_fanout_propagates_errors():
+    async def broken(context: dict):
+        yield "0"
+        raise RuntimeError("upstream error")
+
+    async def scenario():
+        subscription = StreamFanout(poll_interval=0.5).subscribe("key", broken)
+        return [chunk async for chunk in subscription]
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(scenario())
@@ -0,0 +1,24 @@
+from app.services.sse import CompletionMarkerFilter, format_sse
+
+
+def test_format_sse():
+    assert format_sse("delta", {"text": "要約"}) == 'event: delta\ndata: {"text": "要約"}\n\n'.encode()
+
+
+def test_marker_filter_strips_marker_split_across_chunks():
+    marker = CompletionMarkerFilter()
+    chunks = ["回答です。<", "<COMP", "LETED", ">>"]
+
+    visible = "".join(marker.feed(chunk) for chunk in chunks) + marker.flush()
+
+    assert visible == "回答です。"
+    assert marker.found
+
+
+def test_marker_filter_releases_partial_match():
+    marker = CompletionMarkerFilter()
+
+    visible = marker.feed("a << b") + marker.feed(" <") + marker.flush()
+
+    assert visible == "a << b <"
+    assert not marker.found
@@ -0,0 +1,71 @@
+from app.services.thread_history import ThreadHistoryStore
+
+
+def _turn(i: int) -> list:
+    return [{"role": "user", "content": f"質問{i}"}, {"role": "assistant", "content": f"回答{i}"}]
+
+
+def test_appends_and_returns_latest_messages(tmp_path):
+    store = ThreadHistoryStore(str(tmp_path / "history.sqlite3"), max_messages=4)
+
+    assert store.latest("s1") is None
+    for i in range(3):
+        store.append("s1", _turn(i))
+
+    assert store.latest("s1") == [*_turn(1), *_turn(2)]
+    assert store.latest("s1", limit=1) == [{"role": "assistant", "content": "回答2"}]
+    assert store.latest("s2") is None
+
+
+def test_history_survives_restart_and_cache_eviction(tmp_path):
+    path = str(tmp_path / "history.sqlite3")
+    store = ThreadHistoryStore(path, max_messages=3, cache_size=1)
+    store.append("s1", _turn(0))
+    store.append("s2", _turn(0))
+    store.append("s1", _turn(1))
+    store.close()
+
+    reopened = ThreadHistoryStore(path, max_messages=3)
+    assert reopened.latest("s1") == [_turn(0)[1], *_turn(1)]
+    # 連番は既存の記録の続きから振る
+    reopened.append("s1", _turn(2))
+    assert reopened.latest("s1") == [_turn(1)[1], *_turn(2)]
+
+
+def test_backfills_unknown_threads_once(tmp_path):
+    store = ThreadHistoryStore(str(tmp_path / "history.sqlite3"))
+    calls = []
+
+    def fetch() -> list:
+        calls.append(1)
+        return [{"role": "system", "content": "検索結果"}, *_turn(0), {"role": "assistant", "content": None}]
+
+    assert store.get_or_backfill("s1", fetch) == _turn(0)
+    assert store.get_or_backfill("s1", fetch) == _turn(0)
+    assert len(calls) == 1
+
+
+def test_threads_without_runs_are_checked_once(tmp_path):
+    path = str(tmp_path / "history.sqlite3")
+    store = ThreadHistoryStore(path)
+    calls = []
+
+    def fetch() -> list:
+        calls.append(1)
+        return []
+
+    assert store.get_or_backfill("s1", fetch) == []
+    assert store.get_or_backfill("s1", fetch) == []
+    store.close()
+    # 再起動後も確認済みの記録は残る
+    assert ThreadHistoryStore(path).get_or_backfill("s1", fetch) == []
+    assert len(calls) == 1
+
+
+def test_marked_threads_are_not_backfilled(tmp_path):
+    store = ThreadHistoryStore(str(tmp_path / "history.sqlite3"))
+    store.mark_checked("s1")
+
+    assert store.get_or_backfill("s1", lambda: _turn(0)) == []
+    store.append("s1", _turn(1))
+    assert store.get_or_backfill("s1", lambda: _turn(0)) == _turn(1)
@@ -0,0 +1,257 @@
+import hashlib
+import os
+import threading
+import time
+
+import pytest
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from app.services.embeddings import BatchedEmbeddings, EmbeddingCache, RateBudget
+from app.services.ingest import expand_paths
+from app.services.lexical_index import LexicalIndex
+from app.services.local_vectorstore import LocalVectorStore
+from app.services.manifest import DocumentManifest
+
+
+class HashEmbeddings(Embeddings):
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return [byte / 255 for byte in hashlib.sha256(text.encode()).digest()[:8]]
+
+
+@pytest.fixture
+def add_document(monkeypatch):
+    # 読み込み時にLangSmithのトレースを有効にするため、テストの後に元に戻す
+    monkeypatch.setenv("LANGSMITH_TRACING", "false")
+    import add_document
+
+    monkeypatch.setenv("LANGSMITH_TRACING", "false")
+    # PDFの代わりにテキストファイルを読む（processes=0なので同じプロセスで呼ばれる）
+    monkeypatch.setattr(add_document, "load_pdf", lambda path: [Document(page_content=open(path, encoding="utf-8").read())])
+    return add_document
+
+
+@pytest.fixture
+def stores(tmp_path):
+    vectorstore = LocalVectorStore(str(tmp_path / "vectors"), HashEmbeddings())
+    lexical_index = LexicalIndex(str(tmp_path / "lexical"))
+    manifest = DocumentManifest(str(tmp_path / "manifest.sqlite3"))
+    yield vectorstore, lexical_index, manifest
+    vectorstore.close()
+    lexical_index.close()
+    manifest.close()
+
+
+def paragraphs(*words: str) -> str:
+    # 1段落が1チャンクになるように段落ごとに十分な長さにする
+    return "\n\n".join(" ".join([word] * 40) for word in words)
+
+
+def ingest(add_document, stores, patterns):
+    vectorstore, lexical_index, manifest = stores
+    return add_document.ingest_documents(expand_paths(patterns), vectorstore, HashEmbeddings(), manifest, lexical_index, processes=0)
+
+
+def test_ingest_normalizes_spellings_of_the_same_file(add_document, stores, tmp_path, monkeypatch):
+    (tmp_path / "docs").mkdir()
+    (tmp_path / "docs" / "a.pdf").write_text(paragraphs("alpha", "beta"), encoding="utf-8")
+    (tmp_path / "link").symlink_to(tmp_path / "docs")
+    vectorstore, lexical_index, manifest = stores
+
+    monkeypatch.chdir(tmp_path)
+    ingest(add_document, stores, ["docs/a.pdf"])
+    report = ingest(add_document, stores, ["./docs/../docs/a.pdf", str(tmp_path / "link" / "a.pdf")])
+
+    assert report["manifest"]["files_unchanged"] == 1
+    assert manifest.paths() == [os.path.realpath(tmp_path / "docs" / "a.pdf")]
+    assert vectorstore.stats()["count"] == 2  # noqa: PLR2004
+    assert lexical_index.stats()["live_docs"] == 2  # noqa: PLR2004
+
+
+def test_prune_removes_paths_recorded_before_normalization(add_document, stores, tmp_path, monkeypatch):
+    (tmp_path / "docs").mkdir()
+    (tmp_path / "docs" / "a.pdf").write_text(paragraphs("alpha", "beta"), encoding="utf-8")
+    vectorstore, lexical_index, manifest = stores
+    # 正規化する前は入力どおりの相対パスで記録していた
+    vectorstore.add_texts(["alpha"], ids=["legacy"])
+    manifest.begin("docs/a.pdf", "legacy-hash", ["legacy"])
+    manifest.chunks_added([("docs/a.pdf", "legacy")])
+
+    monkeypatch.chdir(tmp_path)
+    ingest(add_document, stores, ["docs/a.pdf"])
+
+    assert add_document.prune_missing_files(vectorstore, manifest, lexical_index) == 1
+    assert manifest.paths() == [os.path.realpath(tmp_path / "docs" / "a.pdf")]
+    assert vectorstore.stats()["live"] == 2  # noqa: PLR2004
+
+
+def test_ingest_documents_skips_files_that_did_not_change(add_document, stores, tmp_path):
+    (tmp_path / "a.pdf").write_text(paragraphs("alpha", "beta"), encoding="utf-8")
+    (tmp_path / "b.pdf").write_text(paragraphs("gamma"), encoding="utf-8")
+    vectorstore, lexical_index, manifest = stores
+
+    first = ingest(add_document, stores, [str(tmp_path)])
+    second = ingest(add_document, stores, [str(tmp_path)])
+
+    assert first["manifest"] == {
+        "files_unchanged": 0,
+        "files_indexed": 2,
+        "files_failed": 0,
+        "chunks_unchanged": 0,
+        "chunks_deleted": 0,
+        "chunks_backfilled": 0,
+    }
+    assert first["stages"]["upsert"]["items_out"] == 3  # noqa: PLR2004
+    assert second["manifest"] == {
+        "files_unchanged": 2,
+        "files_indexed": 0,
+        "files_failed": 0,
+        "chunks_unchanged": 0,
+        "chunks_deleted": 0,
+        "chunks_backfilled": 0,
+    }
+    assert second["stages"]["parse"]["items_in"] == 0
+    assert vectorstore.stats()["count"] == 3  # noqa: PLR2004
+    assert lexical_index.stats()["live_docs"] == 3  # noqa: PLR2004
+    assert [doc.page_content.split()[0] for _, _, doc in lexical_index.search("gamma", k=5)] == ["gamma"]
+
+
+def test_ingest_documents_deletes_stale_chunks_of_edited_files(add_document, stores, tmp_path):
+    path = tmp_path / "a.pdf"
+    path.write_text(paragraphs("alpha", "beta"), encoding="utf-8")
+    vectorstore, lexical_index, manifest = stores
+    ingest(add_document, stores, [str(path)])
+
+    path.write_text(paragraphs("alpha", "delta"), encoding="utf-8")
+    report = ingest(add_document, stores, [str(path)])
+
+    assert report["manifest"] == {
+        "files_unchanged": 0,
+        "files_indexed": 1,
+        "files_failed": 0,
+        "chunks_unchanged": 1,
+        "chunks_deleted": 1,
+        "chunks_backfilled": 0,
+    }
+    assert report["stages"]["upsert"]["items_out"] == 1
+    assert vectorstore.stats()["live"] == 2  # noqa: PLR2004
+    assert lexical_index.search("beta") == []
+    assert [doc.page_content.split()[0] for _, _, doc in lexical_index.search("delta")] == ["delta"]
+    assert len(manifest.chunk_ids(os.path.realpath(path))) == 2  # noqa: PLR2004
+
+
+def test_ingest_documents_reindexes_chunks_left_out_by_an_interrupted_run(add_document, stores, tmp_path, monkeypatch):
+    (tmp_path / "a.pdf").write_text(paragraphs("alpha", "beta"), encoding="utf-8")
+    vectorstore, lexical_index, manifest = stores
+
+    # 最後に語彙インデックスのセグメントを書く前に止まった（ベクトルストアには登録済み）
+    def crash():
+        raise RuntimeError("interrupted")
+
+    monkeypatch.setattr(lexical_index, "flush", crash)
+    with pytest.raises(RuntimeError, match="interrupted"):
+        ingest(add_document, stores, [str(tmp_path)])
+    assert vectorstore.stats()["live"] == 2  # noqa: PLR2004
+    assert manifest.paths() == []
+
+    # 別のプロセスで再実行する（書かれなかった語彙インデックスのバッファは失われている）
+    restarted = (vectorstore, LexicalIndex(lexical_index.path), DocumentManifest(str(tmp_path / "manifest.sqlite3")))
+    report = ingest(add_document, restarted, [str(tmp_path)])
+
+    assert report["manifest"]["files_indexed"] == 1
+    assert report["stages"]["upsert"]["items_out"] == 2  # noqa: PLR2004
+    assert vectorstore.stats()["live"] == 2  # noqa: PLR2004
+    assert restarted[1].stats()["live_docs"] == 2  # noqa: PLR2004
+    assert len(restarted[2].chunk_ids(os.path.realpath(tmp_path / "a.pdf"))) == 2  # noqa: PLR2004
+    restarted[1].close()
+    restarted[2].close()
+
+
+def test_ingest_documents_backfills_the_lexical_index_for_files_ingested_without_it(add_document, stores, tmp_path):
+    (tmp_path / "a.pdf").write_text(paragraphs("alpha", "beta"), encoding="utf-8")
+    (tmp_path / "b.pdf").write_text(paragraphs("gamma"), encoding="utf-8")
+    vectorstore, lexical_index, manifest = stores
+    # 語彙インデックスを作る前に取り込んだ
+    add_document.ingest_documents(expand_paths([str(tmp_path)]), vectorstore, HashEmbeddings(), manifest, None, processes=0)
+    (tmp_path / "b.pdf").write_text(paragraphs("gamma", "delta"), encoding="utf-8")
+
+    report = ingest(add_document, stores, [str(tmp_path)])
+
+    assert report["manifest"] == {
+        "files_unchanged": 0,
+        "files_indexed": 2,
+        "files_failed": 0,
+        "chunks_unchanged": 3,
+        "chunks_deleted": 0,
+        "chunks_backfilled": 3,
+    }
+    # ベクトルストアには変わったファイルの新しいチャンクだけを登録する
+    assert report["stages"]["upsert"]["items_out"] == 1
+    assert vectorstore.stats()["count"] == 4  # noqa: PLR2004
+    assert lexical_index.stats()["live_docs"] == 4  # noqa: PLR2004
+    assert ingest(add_document, stores, [str(tmp_path)])["manifest"]["files_unchanged"] == 2  # noqa: PLR2004
+
+
+def test_ingest_documents_skips_files_that_fail_to_parse_or_split(add_document, stores, tmp_path, monkeypatch, caplog):
+    for name in "abc":
+        (tmp_path / f"{name}.pdf").write_text(paragraphs(f"{name}1", f"{name}2"), encoding="utf-8")
+    vectorstore, lexical_index, manifest = stores
+    load_text = add_document.load_pdf
+
+    def load_pdf(path: str) -> list:
+        if path.endswith("a.pdf"):
+            raise ValueError("broken pdf")
+        # 分割の段で失敗させる
+        return [None] if path.endswith("b.pdf") else load_text(path)
+
+    monkeypatch.setattr(add_document, "load_pdf", load_pdf)
+    report = ingest(add_document, stores, [str(tmp_path)])
+
+    assert report["manifest"]["files_failed"] == 2  # noqa: PLR2004
+    assert report["manifest"]["files_indexed"] == 1
+    assert report["stages"]["parse"]["errors"] == 1
+    assert report["stages"]["split"]["errors"] == 1
+    assert manifest.paths() == [os.path.realpath(tmp_path / "c.pdf")]
+    assert vectorstore.stats()["count"] == 1
+    failed = [record.args[0] for record in caplog.records if record.getMessage().startswith("Failed to ingest")]
+    assert sorted(failed) == [os.path.realpath(tmp_path / "a.pdf"), os.path.realpath(tmp_path / "b.pdf")]
+
+
+class SlowEmbeddings(HashEmbeddings):
+    """
+    同時に処理中のリクエスト数の最大を記録する
+    """
+
+    def __init__(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(0.05)
+        with self._lock:
+            self.in_flight -= 1
+        return super().embed_documents(texts)
+
+
+def test_ingest_documents_sends_embedding_requests_concurrently(add_document, stores, tmp_path):
+    for name in "abcd":
+        (tmp_path / f"{name}.pdf").write_text(paragraphs(*(f"{name}{number}" for number in range(4))), encoding="utf-8")
+    vectorstore, lexical_index, manifest = stores
+    upstream = SlowEmbeddings()
+    embeddings = BatchedEmbeddings(upstream, "test-model", EmbeddingCache(str(tmp_path / "embeddings.sqlite3")), budget=RateBudget(0, 3))
+
+    report = add_document.ingest_documents(
+        expand_paths([str(tmp_path)]), vectorstore, embeddings, manifest, lexical_index, processes=0, embed_batch_size=2
+    )
+
+    assert report["embeddings"]["requests"] == 4  # noqa: PLR2004
+    # 予算の同時実行数まで並行に送る
+    assert 1 < upstream.max_in_flight <= 3  # noqa: PLR2004
+    assert vectorstore.stats()["count"] == 8  # noqa: PLR2004